@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, UploadedFile, DownloadToken
+from .models import User, UploadedFile, DownloadToken, BatchDownloadToken, UploadSession, OutboundEmail, AuthToken, ProcessingJob
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
@@ -12,11 +12,36 @@ class CustomUserAdmin(UserAdmin):
 
 @admin.register(UploadedFile)
 class UploadedFileAdmin(admin.ModelAdmin):
-    list_display = ['original_filename', 'uploaded_by', 'file_type', 'file_size', 'uploaded_at']
-    list_filter = ['file_type', 'uploaded_at']
+    list_display = ['original_filename', 'uploaded_by', 'file_type', 'file_size', 'processing_status', 'uploaded_at']
+    list_filter = ['file_type', 'processing_status', 'uploaded_at']
     search_fields = ['original_filename', 'uploaded_by__username']
 
 @admin.register(DownloadToken)
 class DownloadTokenAdmin(admin.ModelAdmin):
-    list_display = ['file', 'user', 'created_at', 'expires_at', 'is_used']
+    list_display = ['file', 'user', 'created_at', 'expires_at', 'is_used', 'used_at']
     list_filter = ['is_used', 'created_at']
+
+@admin.register(BatchDownloadToken)
+class BatchDownloadTokenAdmin(admin.ModelAdmin):
+    list_display = ['user', 'created_at', 'expires_at', 'is_used', 'used_at']
+    list_filter = ['is_used', 'created_at']
+
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ['filename', 'user', 'file_size', 'chunk_size', 'created_at', 'expires_at', 'uploaded_file']
+    list_filter = ['created_at']
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'status', 'attempts', 'created_at', 'next_attempt_at', 'sent_at']
+    list_filter = ['status', 'created_at']
+
+@admin.register(ProcessingJob)
+class ProcessingJobAdmin(admin.ModelAdmin):
+    list_display = ['file', 'stage', 'status', 'attempts', 'created_at', 'next_attempt_at']
+    list_filter = ['status', 'stage', 'created_at']
+
+@admin.register(AuthToken)
+class AuthTokenAdmin(admin.ModelAdmin):
+    list_display = ['user', 'created_at', 'expires_at']
+    list_filter = ['created_at']
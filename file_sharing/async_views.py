@@ -0,0 +1,118 @@
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.utils import timezone
+from django.views.decorators.http import require_GET
+from datetime import timedelta
+import math
+
+from . import metrics
+from .authentication import aauthenticate
+from .compression import astored_blob
+from .models import BatchDownloadToken, UploadedFile
+from .storage import aexists
+from .throttling import throttle_wait
+from .tokens import InvalidDownloadToken, aissue_download_tokens, aresolve_download_token
+from .delivery import (
+    DownloadPlan,
+    RangeNotSatisfiable,
+    aclaim_download,
+    archive_entries,
+    archive_filename,
+    astream_archive,
+    batch_files,
+    download_link_data,
+    range_not_satisfiable,
+    refusal
+)
+
+# Native async versions of the download endpoints, routed in place of the DRF
+# views when ASYNC_VIEWS is enabled so one ASGI worker can hold many transfers
+
+@require_GET
+async def download_file(request, file_id):
+    """Generate secure download link for client users"""
+    user = await aauthenticate(request)
+    if user is None:
+        response = JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+        response['WWW-Authenticate'] = 'Token'
+        return response
+    
+    wait = throttle_wait('links', f'user-{user.pk}')
+    if wait:
+        response = JsonResponse({'detail': 'Request was throttled.'}, status=429)
+        response['Retry-After'] = str(math.ceil(wait))
+        return response
+    
+    if user.user_type != 'client':
+        return JsonResponse({'error': 'Only Client users can download files'}, status=403)
+    
+    try:
+        uploaded_file = await UploadedFile.objects.aget(id=file_id)
+    except UploadedFile.DoesNotExist:
+        return JsonResponse({'error': 'File not found'}, status=404)
+    
+    if uploaded_file.processing_status == 'failed':
+        return JsonResponse({'error': 'File failed validation'}, status=409)
+    
+    expires_at = timezone.now() + timedelta(hours=1)
+    issued = await aissue_download_tokens([uploaded_file], user, expires_at)
+    download_token, expires_at = issued[uploaded_file.id]
+    
+    return JsonResponse(download_link_data(request, download_token, expires_at))
+
+def refuse(outcome):
+    data, status = refusal(outcome)
+    return JsonResponse(data, status=status)
+
+@require_GET
+async def secure_download(request, token):
+    """Secure file download endpoint with Range and conditional request support"""
+    try:
+        download_token = await aresolve_download_token(token)
+    except InvalidDownloadToken:
+        return refuse('invalid')
+    
+    if download_token.is_expired():
+        return refuse('expired')
+    
+    uploaded_file = download_token.file
+    name, encoding = await astored_blob(uploaded_file)
+    if not await aexists(uploaded_file.file.storage, name):
+        return refuse('missing_file')
+    
+    try:
+        plan = DownloadPlan(request, uploaded_file, name, encoding)
+    except RangeNotSatisfiable as e:
+        return range_not_satisfiable(e.size)
+    
+    # Failed preconditions are answered before the link is used up
+    response = plan.precondition_response(request)
+    if response is not None:
+        return response
+    
+    if not await aclaim_download(download_token, plan):
+        return refuse('used')
+    
+    return plan.response(asynchronous=True)
+
+@require_GET
+async def secure_download_batch(request, token):
+    """Stream the files of a batch download link as a ZIP archive"""
+    try:
+        batch_token = await BatchDownloadToken.objects.aget(token=token)
+    except BatchDownloadToken.DoesNotExist:
+        return refuse('invalid')
+    
+    if batch_token.is_expired():
+        return refuse('expired')
+    
+    files = [uploaded_file async for uploaded_file in batch_files(batch_token)]
+    entries = await sync_to_async(archive_entries, thread_sensitive=False)(files)
+    if entries is None:
+        return refuse('missing_file')
+    
+    if not await batch_token.aclaim():
+        return refuse('used')
+    metrics.inc('download_token_validations_total', outcome='claimed')
+    
+    return astream_archive(entries, archive_filename())
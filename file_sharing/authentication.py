@@ -0,0 +1,226 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from datetime import timedelta
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+import copy
+import hashlib
+import threading
+import time
+
+from .models import AuthToken
+from .utils import generate_secure_token
+
+CACHE_KEY_PREFIX = 'auth-token:'
+REVOKED_KEY_PREFIX = 'auth-token-revoked:'
+
+
+class TokenCache:
+    """Two tier cache of authenticated users: an in-process LRU and an optional shared Django cache"""
+
+    # Invalidation only reaches the in-process tier of the worker that saw the change.
+    # With a shared tier it also leaves a revocation marker there for AUTH_TOKEN_CACHE_TTL,
+    # the longest any worker keeps a local entry, and local entries are only trusted while
+    # no marker exists. Without one, other workers may serve an entry for up to the TTL
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def cache_key(self, key_hash):
+        return CACHE_KEY_PREFIX + key_hash
+
+    def revoked_key(self, key_hash):
+        return REVOKED_KEY_PREFIX + key_hash
+
+    def shared_cache(self):
+        alias = settings.AUTH_TOKEN_CACHE_BACKEND
+        return caches[alias] if alias else None
+
+    def get(self, key_hash):
+        """Return the cached (user, token) pair for a hashed key, or None"""
+        cache_key = self.cache_key(key_hash)
+        shared = self.shared_cache()
+        entry = None
+        if shared is None or shared.get(self.revoked_key(key_hash)) is None:
+            entry = self.get_local(cache_key)
+        if entry is None and shared is not None:
+            entry = shared.get(cache_key)
+            if entry is not None:
+                self.shared_hits += 1
+                self.set_local(cache_key, entry)
+        return self.copy_or_miss(entry)
+
+    async def aget(self, key_hash):
+        """Async version of get"""
+        cache_key = self.cache_key(key_hash)
+        shared = self.shared_cache()
+        entry = None
+        if shared is None or await shared.aget(self.revoked_key(key_hash)) is None:
+            entry = self.get_local(cache_key)
+        if entry is None and shared is not None:
+            entry = await shared.aget(cache_key)
+            if entry is not None:
+                self.shared_hits += 1
+                self.set_local(cache_key, entry)
+        return self.copy_or_miss(entry)
+
+    def set(self, key_hash, user, token):
+        cache_key = self.cache_key(key_hash)
+        self.set_local(cache_key, (user, token))
+        shared = self.shared_cache()
+        if shared is not None:
+            shared.set(cache_key, (user, token), settings.AUTH_TOKEN_CACHE_TTL)
+
+    async def aset(self, key_hash, user, token):
+        cache_key = self.cache_key(key_hash)
+        self.set_local(cache_key, (user, token))
+        shared = self.shared_cache()
+        if shared is not None:
+            await shared.aset(cache_key, (user, token), settings.AUTH_TOKEN_CACHE_TTL)
+
+    def invalidate(self, key_hash):
+        cache_key = self.cache_key(key_hash)
+        with self.lock:
+            self.entries.pop(cache_key, None)
+        shared = self.shared_cache()
+        if shared is not None:
+            shared.delete(cache_key)
+            shared.set(self.revoked_key(key_hash), True, settings.AUTH_TOKEN_CACHE_TTL)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'shared_hits': self.shared_hits, 'misses': self.misses, 'size': len(self.entries)}
+
+    def get_local(self, cache_key):
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[cache_key]
+                return None
+            self.entries.move_to_end(cache_key)
+            self.hits += 1
+            return value
+
+    def set_local(self, cache_key, value):
+        with self.lock:
+            self.entries[cache_key] = (time.monotonic() + settings.AUTH_TOKEN_CACHE_TTL, value)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > settings.AUTH_TOKEN_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def copy_or_miss(self, entry):
+        if entry is None:
+            self.misses += 1
+            return None
+        # Requests get their own instances so one view cannot mutate another's
+        user, token = entry
+        return copy.copy(user), copy.copy(token)
+
+
+token_cache = TokenCache()
+
+
+def hash_token(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def issue_auth_token(user):
+    """Create a login token for user and return its key, which is not stored anywhere"""
+    key = generate_secure_token()
+    token = AuthToken.objects.create(
+        key_hash=hash_token(key),
+        user=user,
+        expires_at=timezone.now() + timedelta(hours=settings.AUTH_TOKEN_LIFETIME_HOURS),
+    )
+    # Keep only the newest tokens of each user so the table stays bounded
+    stale = AuthToken.objects.filter(user=user).order_by('-created_at', '-pk').values_list('pk', flat=True)
+    AuthToken.objects.filter(pk__in=list(stale[settings.AUTH_TOKEN_MAX_PER_USER:])).delete()
+    return key, token
+
+
+def refresh_due(token):
+    """Whether a sliding token has used up half its lifetime and should be extended"""
+    lifetime = timedelta(hours=settings.AUTH_TOKEN_LIFETIME_HOURS)
+    return settings.AUTH_TOKEN_SLIDING and token.expires_at - timezone.now() < lifetime / 2
+
+
+def refresh_auth_token(token):
+    """Extend a sliding token, writing at most once per half lifetime"""
+    if not refresh_due(token):
+        return False
+    token.expires_at = timezone.now() + timedelta(hours=settings.AUTH_TOKEN_LIFETIME_HOURS)
+    AuthToken.objects.filter(pk=token.pk).update(expires_at=token.expires_at)
+    return True
+
+
+async def arefresh_auth_token(token):
+    """Async version of refresh_auth_token"""
+    if not refresh_due(token):
+        return False
+    token.expires_at = timezone.now() + timedelta(hours=settings.AUTH_TOKEN_LIFETIME_HOURS)
+    await AuthToken.objects.filter(pk=token.pk).aupdate(expires_at=token.expires_at)
+    return True
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """Authenticate hashed, expiring AuthTokens, serving repeat clients from token_cache without a query"""
+
+    def authenticate_credentials(self, key):
+        key_hash = hash_token(key)
+        cached = token_cache.get(key_hash)
+        if cached is None:
+            try:
+                token = AuthToken.objects.select_related('user').get(key_hash=key_hash)
+            except AuthToken.DoesNotExist:
+                raise AuthenticationFailed('Invalid token.')
+            if not token.user.is_active:
+                raise AuthenticationFailed('User inactive or deleted.')
+            cached = (token.user, token)
+            token_cache.set(key_hash, *cached)
+
+        user, token = cached
+        if token.is_expired():
+            token_cache.invalidate(key_hash)
+            raise AuthenticationFailed('Token has expired.')
+        if refresh_auth_token(token):
+            token_cache.set(key_hash, user, token)
+        return user, token
+
+
+async def aauthenticate(request):
+    """Resolve an ``Authorization: Token <key>`` header the way CachedTokenAuthentication does, without blocking"""
+    auth = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(auth) != 2 or auth[0].lower() != 'token':
+        return None
+
+    key_hash = hash_token(auth[1])
+    cached = await token_cache.aget(key_hash)
+    if cached is None:
+        try:
+            token = await AuthToken.objects.select_related('user').aget(key_hash=key_hash)
+        except AuthToken.DoesNotExist:
+            return None
+        if not token.user.is_active:
+            return None
+        cached = (token.user, token)
+        await token_cache.aset(key_hash, *cached)
+
+    user, token = cached
+    if token.is_expired():
+        return None
+    if await arefresh_auth_token(token):
+        await token_cache.aset(key_hash, user, token)
+    return user
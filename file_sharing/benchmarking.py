@@ -0,0 +1,244 @@
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+import io
+import math
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import zipfile
+
+from .processing import MAIN_CONTENT_TYPES
+
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Vocabulary for seeded filenames, giving searches a realistic spread of selectivity
+WORDS = [
+    'quarterly', 'report', 'budget', 'roadmap', 'forecast', 'invoice', 'summary', 'minutes',
+    'proposal', 'contract', 'review', 'analysis', 'planning', 'strategy', 'metrics', 'onboarding',
+    'audit', 'payroll', 'pricing', 'inventory', 'marketing', 'sales', 'hiring', 'training',
+]
+
+# Commands serving the project on {port}, run with python -m
+SERVERS = {
+    'wsgi': ['gunicorn', 'file_sharing_system.wsgi:application', '--bind', '127.0.0.1:{port}',
+             '--workers', '{workers}', '--timeout', '600'],
+    'asgi': ['uvicorn', 'file_sharing_system.asgi:application', '--host', '127.0.0.1', '--port', '{port}',
+             '--workers', '1', '--log-level', 'warning'],
+}
+
+# Main part of each Office Open XML package: (path, content type)
+OFFICE_PARTS = {
+    'docx': ('word/document.xml', MAIN_CONTENT_TYPES['docx']),
+    'pptx': ('ppt/presentation.xml', MAIN_CONTENT_TYPES['pptx']),
+    'xlsx': ('xl/workbook.xml', MAIN_CONTENT_TYPES['xlsx']),
+}
+
+
+def parse_size(value):
+    """Parse a human readable size such as 100M into bytes"""
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def format_size(size):
+    """Format a byte count using the largest whole suffix"""
+    for suffix in ('G', 'M', 'K'):
+        if size >= SIZE_SUFFIXES[suffix] and size % SIZE_SUFFIXES[suffix] == 0:
+            return f'{size // SIZE_SUFFIXES[suffix]}{suffix}'
+    return str(size)
+
+
+def peak_rss_kb():
+    """Peak resident set size of the current process in KiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports kilobytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def make_sparse_file(path, size):
+    """Create a file of the given size without writing its blocks"""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+class Timer:
+    """Context manager measuring wall clock time in seconds"""
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def median_ms(func, repeat=5):
+    """Run func repeat times and return its median duration in milliseconds"""
+    durations = []
+    for _ in range(repeat):
+        with Timer() as timer:
+            func()
+        durations.append(timer.elapsed * 1000)
+    return statistics.median(durations)
+
+
+class QueryCounter:
+    """Database execute wrapper counting queries, INSERT statements and their total duration"""
+
+    def __init__(self):
+        self.count = 0
+        self.inserts = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.inserts += sql.lstrip().upper().startswith('INSERT')
+            self.seconds += time.perf_counter() - start
+
+
+@contextmanager
+def count_queries(using='default'):
+    """Count the queries run on a connection within the block"""
+    counter = QueryCounter()
+    with connections[using].execute_wrapper(counter):
+        yield counter
+
+
+@contextmanager
+def benchmark_database(using='default', keepdb=False):
+    """Run against a throwaway database created the same way the test runner does"""
+    connection = connections[using]
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=keepdb)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+
+def seed_files(count, uploader, batch_size=5000, file_types=('docx', 'pptx', 'xlsx')):
+    """Bulk insert count UploadedFile rows without writing any file content"""
+    from .models import UploadedFile
+
+    created = 0
+    while created < count:
+        batch = []
+        for i in range(created, min(created + batch_size, count)):
+            file_type = file_types[i % len(file_types)]
+            batch.append(UploadedFile(
+                file=f'benchmark/{i}.{file_type}',
+                original_filename=f'{WORDS[i % len(WORDS)]} {WORDS[i // len(WORDS) % len(WORDS)]} {i}.{file_type}',
+                uploaded_by=uploader,
+                file_size=1024 + i,
+                file_type=file_type,
+            ))
+        UploadedFile.objects.bulk_create(batch)
+        created += len(batch)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * p / 100) - 1)]
+
+
+def make_office_file(file_type, size):
+    """A minimal .docx, .pptx or .xlsx package padded with random bytes to about size bytes"""
+    part, content_type = OFFICE_PARTS[file_type]
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as package:
+        package.writestr('[Content_Types].xml', (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            f'<Override PartName="/{part}" ContentType="{content_type}"/></Types>'
+        ))
+        package.writestr(part, '<?xml version="1.0" encoding="UTF-8"?><document/>', zipfile.ZIP_DEFLATED)
+        # Random bytes do not compress, like the images that make up most real documents
+        package.writestr('docProps/thumbnail.bin', os.urandom(max(0, size - 600)))
+    return buffer.getvalue()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start listening on port {port}')
+
+
+def run_django(args, env):
+    """Run a management command in a subprocess with the given environment and return its output"""
+    return subprocess.run(
+        [sys.executable, '-m', 'django', *args],
+        cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+
+
+@contextmanager
+def run_server(server, env, workers=3):
+    """Serve the project with gunicorn ('wsgi') or uvicorn ('asgi') on a free port and yield the port"""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', *(arg.format(port=port, workers=workers) for arg in SERVERS[server])],
+        cwd=settings.BASE_DIR,
+        env=dict(env, ASYNC_VIEWS=str(server == 'asgi')),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        yield port, process
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def process_tree_rss_kb(pid):
+    """Resident set size in KiB of a process and all its descendants, or None where /proc is unavailable"""
+    try:
+        parents = {}
+        rss = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/status') as f:
+                    status = dict(line.split(':', 1) for line in f if ':' in line)
+            except OSError:
+                continue
+            parents[int(entry)] = int(status['PPid'])
+            # Kernel threads have no VmRSS
+            rss[int(entry)] = int(status.get('VmRSS', '0 kB').split()[0])
+    except FileNotFoundError:
+        return None
+
+    tree = {pid}
+    while True:
+        children = {child for child, parent in parents.items() if parent in tree} - tree
+        if not children:
+            return sum(rss.get(member, 0) for member in tree)
+        tree |= children
@@ -0,0 +1,22 @@
+from django.core.checks import Error, Tags, register
+from django.core.exceptions import ImproperlyConfigured
+
+from .tokens import replay_cache_problem, token_mode
+
+
+@register(Tags.caches)
+def check_replay_cache(app_configs, **kwargs):
+    """Stateless download tokens are single use only with a replay cache shared by all workers"""
+    try:
+        if token_mode() == 'db':
+            return []
+    except ImproperlyConfigured as e:
+        return [Error(str(e), id='file_sharing.E001')]
+    problem = replay_cache_problem()
+    if problem is None:
+        return []
+    return [Error(
+        problem,
+        hint='Point CACHE_BACKEND/CACHE_LOCATION (or DOWNLOAD_REPLAY_CACHE) at Redis, Memcached or the database cache',
+        id='file_sharing.E002',
+    )]
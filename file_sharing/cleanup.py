@@ -0,0 +1,138 @@
+from django.conf import settings
+from django.db import router, transaction
+from django.utils import timezone
+from datetime import timedelta
+import os
+import shutil
+import time
+import uuid
+
+from .models import AuthToken, BatchDownloadToken, DownloadToken, UploadSession, User
+
+def expired_tokens(now):
+    return DownloadToken.objects.filter(expires_at__lt=now)
+
+def used_tokens(now):
+    """Used tokens past the window in which their transfer may still be resumed"""
+    # Matches DownloadToken.can_resume; after this a used token is refused and only takes up space
+    cutoff = now - timedelta(seconds=settings.DOWNLOAD_RESUME_WINDOW)
+    return DownloadToken.objects.filter(is_used=True, used_at__lt=cutoff)
+
+def expired_batch_tokens(now):
+    return BatchDownloadToken.objects.filter(expires_at__lt=now)
+
+def expired_batch_token_files(now):
+    """File links of expired batch tokens, deleted first since raw deletes do not cascade"""
+    return BatchDownloadToken.files.through.objects.filter(batchdownloadtoken__expires_at__lt=now)
+
+def expired_auth_tokens(now):
+    return AuthToken.objects.filter(expires_at__lt=now)
+
+def stale_verifications(now):
+    """Unverified users whose verification link is older than it is valid for"""
+    cutoff = now - timedelta(hours=settings.EMAIL_VERIFICATION_EXPIRY_HOURS)
+    return User.objects.filter(email_verification_token__isnull=False, date_joined__lt=cutoff)
+
+def expired_upload_sessions(now):
+    return UploadSession.objects.filter(expires_at__lt=now)
+
+def orphaned_chunk_dirs(now):
+    """Chunk directories without an upload session row, untouched for longer than a session lives"""
+    root = os.path.join(settings.MEDIA_ROOT, settings.CHUNKED_UPLOAD_DIR)
+    cutoff = (now - timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS)).timestamp()
+    try:
+        entries = [entry for entry in os.scandir(root) if entry.is_dir() and entry.stat().st_mtime < cutoff]
+    except FileNotFoundError:
+        return []
+    ids = {}
+    for entry in entries:
+        try:
+            ids[uuid.UUID(entry.name)] = entry.path
+        except ValueError:
+            continue
+    live = set(UploadSession.objects.filter(pk__in=list(ids)).values_list('pk', flat=True))
+    return [path for pk, path in ids.items() if pk not in live]
+
+def delete_in_batches(queryset, batch_size, sleep=0):
+    """Delete the rows of queryset batch_size primary keys at a time and return the count"""
+    using = router.db_for_write(queryset.model)
+    deleted = 0
+    while True:
+        # Each batch is a short transaction, so locks and WAL/journal growth stay bounded
+        with transaction.atomic(using=using):
+            pks = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            # _raw_delete issues a plain DELETE without collecting the rows or
+            # sending per-row signals; nothing cascades from these tables
+            deleted += queryset.model.objects.filter(pk__in=pks)._raw_delete(using)
+        if len(pks) < batch_size:
+            break
+        time.sleep(sleep)
+    return deleted
+
+def update_in_batches(queryset, batch_size, sleep=0, **values):
+    """Update the rows of queryset batch_size primary keys at a time and return the count"""
+    updated = 0
+    while True:
+        pks = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        updated += queryset.model.objects.filter(pk__in=pks).update(**values)
+        if len(pks) < batch_size:
+            break
+        time.sleep(sleep)
+    return updated
+
+def delete_upload_sessions(queryset, batch_size, sleep=0):
+    """Delete upload sessions batch_size at a time along with their chunk directories and return the count"""
+    using = router.db_for_write(UploadSession)
+    deleted = 0
+    while True:
+        pks = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        deleted += UploadSession.objects.filter(pk__in=pks)._raw_delete(using)
+        # A directory left behind by a failure here is picked up by orphaned_chunk_dirs later
+        for pk in pks:
+            shutil.rmtree(UploadSession(pk=pk).chunk_dir, ignore_errors=True)
+        if len(pks) < batch_size:
+            break
+        time.sleep(sleep)
+    return deleted
+
+def delete_dirs(paths):
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+    return len(paths)
+
+def cleanup_counts(now=None):
+    """Number of rows each cleanup task would touch, for dry runs"""
+    now = now or timezone.now()
+    return {
+        'expired_tokens': expired_tokens(now).count(),
+        'used_tokens': used_tokens(now).exclude(expires_at__lt=now).count(),
+        'expired_batch_tokens': expired_batch_tokens(now).count(),
+        'expired_auth_tokens': expired_auth_tokens(now).count(),
+        'stale_verifications': stale_verifications(now).count(),
+        'expired_upload_sessions': expired_upload_sessions(now).count(),
+        'orphaned_chunk_dirs': len(orphaned_chunk_dirs(now)),
+    }
+
+def run_cleanup(batch_size=None, sleep=None, now=None):
+    """Purge expired and used download tokens, expired login tokens and upload sessions, and clear stale verification tokens"""
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    sleep = settings.CLEANUP_BATCH_SLEEP if sleep is None else sleep
+    now = now or timezone.now()
+    delete_in_batches(expired_batch_token_files(now), batch_size, sleep)
+    return {
+        'expired_tokens': delete_in_batches(expired_tokens(now), batch_size, sleep),
+        'used_tokens': delete_in_batches(used_tokens(now), batch_size, sleep),
+        'expired_batch_tokens': delete_in_batches(expired_batch_tokens(now), batch_size, sleep),
+        'expired_auth_tokens': delete_in_batches(expired_auth_tokens(now), batch_size, sleep),
+        'stale_verifications': update_in_batches(
+            stale_verifications(now), batch_size, sleep, email_verification_token=None
+        ),
+        'expired_upload_sessions': delete_upload_sessions(expired_upload_sessions(now), batch_size, sleep),
+        'orphaned_chunk_dirs': delete_dirs(orphaned_chunk_dirs(now)),
+    }
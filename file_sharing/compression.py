@@ -0,0 +1,225 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+import gzip
+import os
+import re
+import uuid
+
+from .models import UploadedFile
+from .storage import file_storage, is_local
+
+try:
+    import zstandard
+except ImportError:
+    # Optional; only needed for COMPRESSION_ENCODING=zstd
+    zstandard = None
+
+# Content codings a stored file may be compressed with, and the suffix of their variant
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+IDENTITY = 'identity'
+
+ACCEPT_ENCODING_RE = re.compile(r'^\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?\s*$')
+
+
+def available_encodings():
+    return [encoding for encoding in SUFFIXES if encoding != 'zstd' or zstandard is not None]
+
+
+def configured_encoding(encoding=None):
+    """Validate an encoding to compress with, COMPRESSION_ENCODING by default"""
+    encoding = (encoding or settings.COMPRESSION_ENCODING).lower()
+    if encoding not in SUFFIXES:
+        raise ImproperlyConfigured(f'COMPRESSION_ENCODING must be one of {", ".join(SUFFIXES)}, got {encoding!r}')
+    if encoding not in available_encodings():
+        raise ImproperlyConfigured('COMPRESSION_ENCODING=zstd requires the zstandard package')
+    return encoding
+
+
+def variant_name(name, encoding):
+    """Storage name of the compressed variant of a blob"""
+    return name + SUFFIXES[encoding]
+
+
+def stored_blob(uploaded_file):
+    """Return the storage name of the bytes stored for a file and their encoding, None when uncompressed"""
+    storage, name = uploaded_file.file.storage, uploaded_file.file.name
+    encoding = uploaded_file.stored_encoding
+    if encoding in SUFFIXES:
+        return variant_name(name, encoding), encoding
+
+    if encoding == '' and not storage.exists(name):
+        # A pending row for content another row already had compressed
+        for candidate in SUFFIXES:
+            if storage.exists(variant_name(name, candidate)):
+                return variant_name(name, candidate), candidate
+    return name, None
+
+
+async def astored_blob(uploaded_file):
+    """stored_blob for async code; only remote storage needs the thread pool"""
+    if is_local(uploaded_file.file.storage):
+        return stored_blob(uploaded_file)
+    return await sync_to_async(stored_blob, thread_sensitive=False)(uploaded_file)
+
+
+def stored_file(uploaded_file):
+    """Return the local path of the bytes stored for a file and their encoding, None when uncompressed"""
+    name, encoding = stored_blob(uploaded_file)
+    return uploaded_file.file.storage.path(name), encoding
+
+
+def open_stored(storage, name, encoding):
+    """Open stored bytes for reading their original content"""
+    if encoding is None:
+        return storage.open(name, 'rb')
+    return open_decompressed(storage.path(name), encoding)
+
+
+def open_original(uploaded_file):
+    """Open the original bytes of an uploaded file for reading, decompressing a compressed variant"""
+    return open_stored(uploaded_file.file.storage, *stored_blob(uploaded_file))
+
+
+def require_local_storage():
+    # Variants are written and swapped in with filesystem renames
+    if not is_local(file_storage):
+        raise ImproperlyConfigured('Storage compression requires FILE_STORAGE_BACKEND=local')
+
+
+def accepts_encoding(request, encoding):
+    """Whether the request's Accept-Encoding allows the given content coding (RFC 9110 12.5.3)"""
+    qualities = {}
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').lower().split(','):
+        match = ACCEPT_ENCODING_RE.match(item)
+        if match:
+            try:
+                qualities[match.group(1)] = float(match.group(2) or 1)
+            except ValueError:
+                continue
+    quality = qualities.get(encoding, qualities.get('*', 0))
+    return quality > 0
+
+
+def open_compressor(f, encoding, level=None):
+    """Wrap a binary file so that writes to it are compressed"""
+    level = level if level is not None else settings.COMPRESSION_LEVEL or DEFAULT_LEVELS[encoding]
+    if encoding == 'gzip':
+        # mtime=0 keeps the output identical for identical content
+        return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=level, mtime=0)
+    return zstandard.ZstdCompressor(level=level).stream_writer(f, closefd=False)
+
+
+def open_decompressed(path, encoding):
+    """Open a stored variant for reading its original bytes as a stream"""
+    if encoding == 'gzip':
+        return gzip.open(path, 'rb')
+    return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+
+def read_decompressed(path, encoding, chunk_size):
+    """Yield the original bytes of a stored variant"""
+    with open_decompressed(path, encoding) as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+class CountingWriter:
+    """Write target that only counts the bytes written to it"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def compressed_size(path, encoding, level=None):
+    """Size a file would have compressed, computed as a stream without writing it anywhere"""
+    counter = CountingWriter()
+    with open(path, 'rb') as source, open_compressor(counter, encoding, level) as target:
+        while chunk := source.read(1024 * 1024):
+            target.write(chunk)
+    return counter.size
+
+
+def compress_blob(name, encoding):
+    """Compress a stored blob if that saves enough space and return the encoding it is now stored with"""
+    path = file_storage.path(name)
+    variant = file_storage.path(variant_name(name, encoding))
+    if os.path.exists(variant):
+        return encoding
+
+    # Write under a unique temporary name and rename, like ContentAddressedStorage
+    tmp_path = f'{variant}.{uuid.uuid4().hex}.tmp'
+    with open(path, 'rb') as source, open(tmp_path, 'wb') as f, open_compressor(f, encoding) as target:
+        while chunk := source.read(1024 * 1024):
+            target.write(chunk)
+    original, compressed = os.path.getsize(path), os.path.getsize(tmp_path)
+    if compressed > original * (1 - settings.COMPRESSION_MIN_SAVINGS):
+        os.remove(tmp_path)
+        return IDENTITY
+    os.replace(tmp_path, variant)
+    return encoding
+
+
+def compress_pending(batch_size=None, encoding=None):
+    """Compress the blobs of one batch of files not yet processed and return counts"""
+    require_local_storage()
+    encoding = configured_encoding(encoding)
+    names = list(
+        # Files still being processed are read by the processing jobs
+        UploadedFile.objects.filter(stored_encoding='', processing_status='ready')
+        .order_by('file').values_list('file', flat=True).distinct()[:batch_size or settings.COMPRESSION_BATCH_SIZE]
+    )
+    stats = {'compressed': 0, 'identity': 0, 'missing': 0}
+    for name in names:
+        path = file_storage.path(name)
+        existing = next(
+            (candidate for candidate in SUFFIXES if file_storage.exists(variant_name(name, candidate))), None
+        )
+        if existing is None and not os.path.exists(path):
+            stats['missing'] += 1
+            UploadedFile.objects.filter(file=name, stored_encoding='').update(stored_encoding=IDENTITY)
+            continue
+
+        stored_encoding = existing or compress_blob(name, encoding)
+        # Every row sharing the blob switches at once; the original is removed only
+        # after the rows point at the variant
+        UploadedFile.objects.filter(file=name).update(stored_encoding=stored_encoding)
+        if stored_encoding != IDENTITY and os.path.exists(path):
+            os.remove(path)
+        stats['compressed' if stored_encoding != IDENTITY else 'identity'] += 1
+    return stats
+
+
+def compression_report(limit=None, level=None):
+    """Compressed sizes of the stored files per file type for each available encoding"""
+    require_local_storage()
+    encodings = available_encodings()
+    report = {}
+    # Uncompressed blobs only; each distinct content is measured once
+    blobs = (
+        UploadedFile.objects.filter(stored_encoding__in=['', IDENTITY])
+        .order_by('file_type', 'file').values_list('file_type', 'file').distinct()
+    )
+    for file_type, name in blobs[:limit] if limit else blobs:
+        path = file_storage.path(name)
+        if not os.path.exists(path):
+            continue
+        row = report.setdefault(file_type, {'files': 0, 'size': 0, **{encoding: 0 for encoding in encodings},
+                                            'worthwhile': 0})
+        size = os.path.getsize(path)
+        row['files'] += 1
+        row['size'] += size
+        sizes = {encoding: compressed_size(path, encoding, level) for encoding in encodings}
+        for encoding, compressed in sizes.items():
+            row[encoding] += compressed
+        if min(sizes.values()) <= size * (1 - settings.COMPRESSION_MIN_SAVINGS):
+            row['worthwhile'] += 1
+    return report
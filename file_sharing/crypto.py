@@ -0,0 +1,78 @@
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+from functools import lru_cache
+import base64
+import hashlib
+
+
+@lru_cache(maxsize=16)
+def derive_key(secret):
+    """Derive a Fernet key from a Django secret key"""
+    return base64.urlsafe_b64encode(hashlib.sha256(secret.encode()[:32]).digest())
+
+
+def configured_keys():
+    """Fernet keys in rotation order, the first one being used to encrypt
+
+    ENCRYPTION_KEYS takes precedence; otherwise keys are derived from
+    SECRET_KEY followed by SECRET_KEY_FALLBACKS.
+    """
+    if settings.ENCRYPTION_KEYS:
+        return tuple(key.encode() if isinstance(key, str) else key for key in settings.ENCRYPTION_KEYS)
+    secrets = [settings.SECRET_KEY, *getattr(settings, 'SECRET_KEY_FALLBACKS', [])]
+    return tuple(derive_key(secret) for secret in secrets)
+
+
+@lru_cache(maxsize=32)
+def get_cipher(keys):
+    """Build (once per key tuple) the cipher for a tuple of Fernet keys"""
+    if len(keys) == 1:
+        return Fernet(keys[0])
+    return MultiFernet([Fernet(key) for key in keys])
+
+
+def cipher_for(key=None):
+    return get_cipher(configured_keys() if key is None else (key,))
+
+
+def _to_bytes(data):
+    return data.encode() if isinstance(data, str) else data
+
+
+def encrypt(data, key=None):
+    """Encrypt a str or bytes payload and return the token as str"""
+    return cipher_for(key).encrypt(_to_bytes(data)).decode()
+
+
+def decrypt(token, key=None):
+    """Decrypt a token to str, returning None if it is invalid"""
+    try:
+        return cipher_for(key).decrypt(_to_bytes(token)).decode()
+    except (InvalidToken, TypeError, ValueError):
+        return None
+
+
+def encrypt_many(items, key=None):
+    """Encrypt a list of payloads with a single cipher lookup"""
+    cipher = cipher_for(key)
+    return [cipher.encrypt(_to_bytes(item)).decode() for item in items]
+
+
+def decrypt_many(tokens, key=None):
+    """Decrypt a list of tokens, with None in place of invalid ones"""
+    cipher = cipher_for(key)
+    results = []
+    for token in tokens:
+        try:
+            results.append(cipher.decrypt(_to_bytes(token)).decode())
+        except (InvalidToken, TypeError, ValueError):
+            results.append(None)
+    return results
+
+
+def rotate(token):
+    """Re-encrypt a token under the current primary key"""
+    cipher = cipher_for()
+    if isinstance(cipher, Fernet):
+        cipher = MultiFernet([cipher])
+    return cipher.rotate(_to_bytes(token)).decode()
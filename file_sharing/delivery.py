@@ -0,0 +1,503 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.http import content_disposition_header, http_date, parse_etags, parse_http_date_safe
+import functools
+import io
+import mimetypes
+import os
+import re
+import zipfile
+from urllib.parse import quote
+
+from . import metrics
+from .compression import accepts_encoding, open_stored, read_decompressed, stored_blob
+from .storage import is_local
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Delivery backends that hand the file body off to the front proxy
+OFFLOAD_HEADERS = {
+    'x-accel-redirect': 'X-Accel-Redirect',
+    'x-sendfile': 'X-Sendfile',
+}
+DELIVERY_BACKENDS = ['stream', *OFFLOAD_HEADERS]
+
+# File types that are ZIP packages already and gain nothing from recompression
+COMPRESSED_FILE_TYPES = {'docx', 'pptx', 'xlsx'}
+
+# Error body and status of each way a download link can be refused, keyed by metrics outcome
+REFUSALS = {
+    'invalid': ('Invalid download link', 404),
+    'expired': ('Download link has expired', 410),
+    'missing_file': ('File not found on server', 404),
+    'used': ('Download link has already been used', 410),
+}
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when a Range header selects no bytes of the file"""
+
+    def __init__(self, size):
+        super().__init__(f'Requested range not satisfiable for {size} bytes')
+        self.size = size
+
+
+def file_validators(path):
+    """Return the ETag, Last-Modified timestamp and size of a file on disk"""
+    stat = os.stat(path)
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    return etag, int(stat.st_mtime), stat.st_size
+
+
+def requested_range(request, size, etag, last_modified, check_if_range=True):
+    """Return the (start, end) byte range to serve, or None for the full file"""
+    header = request.META.get('HTTP_RANGE', '').replace(' ', '')
+    match = RANGE_RE.match(header)
+    # Malformed and multi-range requests fall back to the full body (RFC 9110 14.2)
+    if not match or match.groups() == ('', ''):
+        return None
+
+    if_range = request.META.get('HTTP_IF_RANGE') if check_if_range else None
+    if if_range:
+        if if_range.startswith(('"', 'W/"')):
+            # If-Range requires a strong comparison, so weak tags never match
+            if parse_etags(if_range) != [etag]:
+                return None
+        elif parse_http_date_safe(if_range) != last_modified:
+            return None
+
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start >= size or end < start:
+            raise RangeNotSatisfiable(size)
+    else:
+        # Suffix range: the final N bytes
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise RangeNotSatisfiable(size)
+        start, end = max(size - suffix, 0), size - 1
+
+    return start, end
+
+
+def range_not_satisfiable(size):
+    """Build a 416 response advertising the full length of the file"""
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f'bytes */{size}'
+    return response
+
+
+def conditional_response(request, etag, last_modified):
+    """Return a 304/412 response when the request preconditions say so"""
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def read_range(path, start, end, chunk_size):
+    """Yield the bytes of path between start and end inclusive"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def stream_file(path, filename, byte_range=None, etag=None, last_modified=None):
+    """Build a streaming attachment response for a file on disk"""
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), as_attachment=True, filename=filename)
+        response.block_size = settings.DOWNLOAD_CHUNK_SIZE
+
+        if not settings.DOWNLOAD_USE_SENDFILE:
+            # Without file_to_stream the WSGI handler never hands the file to
+            # wsgi.file_wrapper (os.sendfile under gunicorn) and iterates block_size
+            # chunks in Python instead.
+            response.file_to_stream = None
+    else:
+        start, end = byte_range
+        content_type, _ = mimetypes.guess_type(filename)
+        response = StreamingHttpResponse(
+            read_range(path, start, end, settings.DOWNLOAD_CHUNK_SIZE),
+            status=206,
+            content_type=content_type or 'application/octet-stream',
+        )
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{os.path.getsize(path)}'
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+
+    response['Accept-Ranges'] = 'bytes'
+    if etag:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+
+    return response
+
+
+async def aread_range(path, start, end, chunk_size):
+    """Async version of read_range doing the blocking reads in a thread pool"""
+    # thread_sensitive=False lets reads for different downloads run in parallel
+    f = await sync_to_async(open, thread_sensitive=False)(path, 'rb')
+    try:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await sync_to_async(f.read, thread_sensitive=False)(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def astream_file(path, filename, size, byte_range=None, etag=None, last_modified=None):
+    """Build a streaming attachment response with an async body for ASGI servers"""
+    # Django's ASGI handler buffers sync iterators such as FileResponse in full
+    start, end = byte_range if byte_range is not None else (0, size - 1)
+    content_type, _ = mimetypes.guess_type(filename)
+    response = StreamingHttpResponse(
+        aread_range(path, start, end, settings.DOWNLOAD_CHUNK_SIZE),
+        status=206 if byte_range is not None else 200,
+        content_type=content_type or 'application/octet-stream',
+    )
+    response['Content-Length'] = end - start + 1
+    if byte_range is not None:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    response['Accept-Ranges'] = 'bytes'
+    if etag:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+
+    return response
+
+
+class ArchiveSink(io.RawIOBase):
+    """Unseekable write target collecting what ZipFile writes until it is drained"""
+
+    # Without seek, ZipFile writes sizes and CRCs in data descriptors after each
+    # entry instead of going back to patch local headers
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def archive_names(filenames):
+    """Make filenames unique within an archive by numbering repeats: report.docx, report (2).docx"""
+    seen = set()
+    names = []
+    for filename in filenames:
+        name, number = filename, 1
+        while name.lower() in seen:
+            number += 1
+            root, ext = os.path.splitext(filename)
+            name = f'{root} ({number}){ext}'
+        seen.add(name.lower())
+        names.append(name)
+    return names
+
+
+def archive_filename():
+    return f'files-{timezone.now():%Y%m%d-%H%M%S}.zip'
+
+
+def archive_entries(files):
+    """ZIP entries for uploaded files, or None when the stored bytes of any of them are missing"""
+    names = archive_names([uploaded_file.original_filename for uploaded_file in files])
+    entries = []
+    for uploaded_file, name in zip(files, names):
+        storage = uploaded_file.file.storage
+        stored_name, encoding = stored_blob(uploaded_file)
+        if not storage.exists(stored_name):
+            return None
+        entries.append((
+            functools.partial(open_stored, storage, stored_name, encoding), name,
+            uploaded_file.file_type, uploaded_file.file_size, uploaded_file.uploaded_at
+        ))
+    return entries
+
+
+def zip_stream(entries, chunk_size):
+    """Yield a ZIP archive of (opener, name, file type, size, modified) entries as it is written"""
+    sink = ArchiveSink()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as archive:
+        for opener, name, file_type, size, modified in entries:
+            info = zipfile.ZipInfo(name, date_time=timezone.localtime(modified).timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED if file_type in COMPRESSED_FILE_TYPES else zipfile.ZIP_DEFLATED
+            # Setting the size up front lets ZipFile decide on ZIP64 before writing the header
+            info.file_size = size
+            # opener returns the original bytes, so compressed variants go in decompressed
+            with opener() as source, archive.open(info, 'w') as target:
+                while chunk := source.read(chunk_size):
+                    target.write(chunk)
+                    # Compressed entries may not have produced output yet
+                    if data := sink.drain():
+                        yield data
+            yield sink.drain()
+    # The central directory is written on close
+    yield sink.drain()
+
+
+async def aiterate(chunks):
+    """Iterate a blocking generator from async code, advancing it in a thread pool"""
+    try:
+        while (chunk := await sync_to_async(next, thread_sensitive=False)(chunks, None)) is not None:
+            yield chunk
+    finally:
+        chunks.close()
+
+
+def azip_stream(entries, chunk_size):
+    """Async version of zip_stream doing the reads and compression in a thread pool"""
+    return aiterate(zip_stream(entries, chunk_size))
+
+
+def stream_archive(entries, filename, chunk_size=None):
+    """Build a streaming ZIP attachment response; the archive is never held in memory or on disk"""
+    chunk_size = chunk_size or settings.DOWNLOAD_CHUNK_SIZE
+    response = StreamingHttpResponse(zip_stream(entries, chunk_size), content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
+
+
+def astream_archive(entries, filename, chunk_size=None):
+    """Build a streaming ZIP attachment response with an async body for ASGI servers"""
+    chunk_size = chunk_size or settings.DOWNLOAD_CHUNK_SIZE
+    response = StreamingHttpResponse(azip_stream(entries, chunk_size), content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
+
+
+def decompressed_etag(etag):
+    """ETag of the decompressed representation of a compressed variant"""
+    return f'{etag[:-1]}-identity"'
+
+
+def mark_encoded(response, encoding):
+    """Label a response carrying a compressed variant; both representations vary on Accept-Encoding"""
+    if encoding is not None and response.status_code in (200, 206):
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+def stream_decompressed(path, encoding, filename, size, etag=None, last_modified=None, body=None):
+    """Build a streaming attachment response of a compressed variant decompressed on the fly"""
+    content_type, _ = mimetypes.guess_type(filename)
+    response = StreamingHttpResponse(
+        body if body is not None else read_decompressed(path, encoding, settings.DOWNLOAD_CHUNK_SIZE),
+        content_type=content_type or 'application/octet-stream',
+    )
+    response['Content-Length'] = size
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    # Serving a range of the original would mean decompressing everything before it
+    response['Accept-Ranges'] = 'none'
+    if etag:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+def astream_decompressed(path, encoding, filename, size, etag=None, last_modified=None):
+    """Async version of stream_decompressed decompressing in a thread pool"""
+    body = aiterate(read_decompressed(path, encoding, settings.DOWNLOAD_CHUNK_SIZE))
+    return stream_decompressed(path, encoding, filename, size, etag, last_modified, body=body)
+
+
+def delivery_backend():
+    """Return the configured file delivery backend"""
+    backend = settings.FILE_DELIVERY_BACKEND.lower()
+    if backend not in DELIVERY_BACKENDS:
+        raise ImproperlyConfigured(
+            f'FILE_DELIVERY_BACKEND must be one of {", ".join(DELIVERY_BACKENDS)}, got {backend!r}'
+        )
+    return backend
+
+
+def redirect_file(url):
+    """Send the client to a presigned object storage URL, which serves the file and its ranges itself"""
+    response = HttpResponseRedirect(url)
+    # The URL grants access until it expires, so it must not be cached
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+
+def offload_file(path, filename, backend):
+    """Build an empty response telling the front proxy which file to send"""
+    if backend == 'x-accel-redirect':
+        relative = os.path.relpath(path, settings.MEDIA_ROOT)
+        if relative.startswith(os.pardir):
+            raise ImproperlyConfigured(f'{path} is outside MEDIA_ROOT and cannot be served by X-Accel-Redirect')
+        location = settings.FILE_DELIVERY_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative.replace(os.sep, '/'))
+    else:
+        location = path
+
+    content_type, _ = mimetypes.guess_type(filename)
+    response = HttpResponse(content_type=content_type or 'application/octet-stream')
+    response[OFFLOAD_HEADERS[backend]] = location
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
+
+
+def refusal(outcome):
+    """Count a refused download and return its error body and status code"""
+    metrics.inc('download_token_validations_total', outcome=outcome)
+    error, status = REFUSALS[outcome]
+    return {'error': error}, status
+
+
+class DownloadPlan:
+    """How one download request is served: the backend, the stored bytes, their validators and the range asked for"""
+
+    def __init__(self, request, uploaded_file, name, encoding):
+        self.uploaded_file = uploaded_file
+        self.storage = uploaded_file.file.storage
+        self.name = name
+        self.encoding = encoding
+        self.filename = uploaded_file.original_filename
+
+        if is_local(self.storage):
+            self.backend = delivery_backend()
+            self.path = self.storage.path(name)
+            self.etag, self.last_modified, self.size = file_validators(self.path)
+        else:
+            # Object storage serves the file from a presigned URL; blobs never change
+            # under their content address, so the digest is a stable ETag
+            self.backend = 'redirect'
+            self.path = None
+            self.etag, self.last_modified, self.size = f'"{uploaded_file.sha256}"', None, uploaded_file.file_size
+
+        self.decompress = False
+        if encoding is not None:
+            # Compressed files are sent as stored to clients accepting the encoding and
+            # decompressed on the fly for the rest; the front proxy can do neither
+            self.backend = 'stream'
+            self.decompress = not accepts_encoding(request, encoding)
+            if self.decompress:
+                self.etag = decompressed_etag(self.etag)
+
+        self.byte_range = None
+        resume_range = None
+        if self.backend == 'stream' and not self.decompress:
+            # Raises RangeNotSatisfiable
+            self.byte_range = resume_range = requested_range(request, self.size, self.etag, self.last_modified)
+        elif not self.decompress:
+            # The front proxy evaluates Range and conditional headers itself; the range
+            # is only parsed here to tell whether the request resumes a transfer. If-Range
+            # carries the validator of whoever served the first part (nginx, Apache or S3
+            # ETags differ from ours), so it is left to them
+            try:
+                resume_range = requested_range(
+                    request, self.size, self.etag, self.last_modified, check_if_range=False
+                )
+            except RangeNotSatisfiable:
+                pass
+        # A range from the first byte would serve the whole file again
+        self.resuming = resume_range is not None and resume_range[0] > 0
+
+    def precondition_response(self, request):
+        """A 304/412 response when the request preconditions say so; proxies and object storage check their own"""
+        if self.backend != 'stream':
+            return None
+        response = conditional_response(request, self.etag, self.last_modified)
+        if response is not None and self.encoding is not None:
+            mark_encoded(response, None)
+        return response
+
+    def response(self, asynchronous=False):
+        """Build the response delivering the file, with an async body for ASGI servers when asked"""
+        if self.backend == 'redirect':
+            return redirect_file(self.storage.url(self.name, filename=self.filename))
+        if self.backend != 'stream':
+            return offload_file(self.path, self.filename, self.backend)
+
+        if self.decompress:
+            stream = astream_decompressed if asynchronous else stream_decompressed
+            return stream(
+                self.path, self.encoding, self.filename, self.uploaded_file.file_size, self.etag, self.last_modified
+            )
+
+        # Stream the file in chunks instead of loading it into memory
+        if asynchronous:
+            response = astream_file(self.path, self.filename, self.size, self.byte_range, self.etag, self.last_modified)
+        else:
+            response = stream_file(self.path, self.filename, self.byte_range, self.etag, self.last_modified)
+        return mark_encoded(response, self.encoding) if self.encoding is not None else response
+
+
+def claim_download(download_token, plan):
+    """Claim the token for this request, or accept it for resuming the transfer that claimed it"""
+    # The first request claims the token; afterwards it only serves resumed
+    # ranges of the same file version until it expires
+    if download_token.claim(plan.etag):
+        outcome = 'claimed'
+    elif plan.resuming and download_token.can_resume(plan.etag):
+        outcome = 'resumed'
+    else:
+        return False
+    metrics.inc('download_token_validations_total', outcome=outcome)
+    return True
+
+
+async def aclaim_download(download_token, plan):
+    """Async version of claim_download"""
+    if await download_token.aclaim(plan.etag):
+        outcome = 'claimed'
+    elif plan.resuming and await download_token.acan_resume(plan.etag):
+        outcome = 'resumed'
+    else:
+        return False
+    metrics.inc('download_token_validations_total', outcome=outcome)
+    return True
+
+
+def download_link_data(request, token, expires_at):
+    """Response body handing out a single-file download link"""
+    return {
+        'download_link': request.build_absolute_uri(f'/api/secure-download/{token}/'),
+        'message': 'success',
+        'expires_at': expires_at
+    }
+
+
+def batch_files(batch_token):
+    """The files of a batch link in archive order, with only the fields the archive needs"""
+    return (
+        batch_token.files.only('file', 'original_filename', 'file_type', 'file_size', 'stored_encoding', 'uploaded_at')
+        .order_by('original_filename', 'id')
+    )
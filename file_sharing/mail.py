@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+from datetime import timedelta
+
+from .models import OutboundEmail
+
+def enqueue_email(subject, body, to, from_email=None):
+    """Store a message in the outbox for send_queued_mail to deliver"""
+    return OutboundEmail.objects.create(
+        subject=subject,
+        body=body,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        to=list(to),
+    )
+
+def retry_delay(attempts):
+    """Seconds to wait before the next attempt after the given number of failures"""
+    delay = settings.MAIL_QUEUE_RETRY_DELAY * 2 ** (attempts - 1)
+    return min(delay, settings.MAIL_QUEUE_MAX_RETRY_DELAY)
+
+def claim_batch(batch_size):
+    """Lease up to batch_size due messages so concurrent workers skip them"""
+    now = timezone.now()
+    with transaction.atomic():
+        due = (
+            OutboundEmail.objects
+            .select_for_update(skip_locked=True)
+            .filter(status='queued', next_attempt_at__lte=now)
+            .order_by('next_attempt_at')
+        )
+        messages = list(due[:batch_size])
+        # A worker that dies mid-batch releases its messages once the lease runs out
+        OutboundEmail.objects.filter(pk__in=[m.pk for m in messages]).update(
+            next_attempt_at=now + timedelta(seconds=settings.MAIL_QUEUE_LEASE_SECONDS)
+        )
+    return messages
+
+def send_queued_mail(batch_size=None, connection=None):
+    """Send one batch of due messages over a single connection and return counts"""
+    messages = claim_batch(batch_size or settings.MAIL_QUEUE_BATCH_SIZE)
+    stats = {'sent': 0, 'retried': 0, 'failed': 0}
+    if not messages:
+        return stats
+
+    connection = connection or get_connection()
+    reopen = False
+    try:
+        connection.open()
+        for message in messages:
+            email = EmailMessage(
+                message.subject, message.body, message.from_email, message.to, connection=connection
+            )
+            message.attempts += 1
+            try:
+                if reopen:
+                    # The failed send may have left the connection unusable; a failure to
+                    # reconnect counts against this message like a failed send
+                    connection.close()
+                    connection.open()
+                    reopen = False
+                email.send()
+            except Exception as e:
+                reopen = True
+                message.last_error = f'{type(e).__name__}: {e}'
+                if message.attempts >= settings.MAIL_QUEUE_MAX_ATTEMPTS:
+                    message.status = 'failed'
+                    stats['failed'] += 1
+                else:
+                    message.next_attempt_at = timezone.now() + timedelta(seconds=retry_delay(message.attempts))
+                    stats['retried'] += 1
+            else:
+                message.status = 'sent'
+                message.sent_at = timezone.now()
+                message.last_error = ''
+                stats['sent'] += 1
+            message.save(update_fields=['status', 'attempts', 'last_error', 'next_attempt_at', 'sent_at'])
+    finally:
+        connection.close()
+
+    return stats
+
+def queue_stats():
+    """Outbox depth by status plus the number of due messages and the oldest one's age"""
+    now = timezone.now()
+    stats = OutboundEmail.objects.aggregate(
+        queued=Count('pk', filter=Q(status='queued')),
+        due=Count('pk', filter=Q(status='queued', next_attempt_at__lte=now)),
+        failed=Count('pk', filter=Q(status='failed')),
+        oldest=Min('created_at', filter=Q(status='queued')),
+    )
+    oldest = stats.pop('oldest')
+    stats['oldest_age_seconds'] = (now - oldest).total_seconds() if oldest else 0
+    return stats
@@ -0,0 +1,382 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlsplit
+import argparse
+import http.client
+import importlib.util
+import itertools
+import json
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+from file_sharing.benchmarking import (
+    SERVERS, make_office_file, parse_size, percentile, process_tree_rss_kb, run_django, run_server,
+)
+
+# Scenarios in the order they run, with the view each one exercises
+SCENARIOS = {
+    'signup': 'client_signup',
+    'login': 'user_login',
+    'upload': 'upload_file',
+    'list': 'list_files',
+    'link': 'download_file',
+    'download': 'secure_download',
+}
+
+PASSWORD = 'benchmark-password'
+FILE_TYPES = ('docx', 'pptx', 'xlsx')
+
+# Compared against a baseline: (key, whether a higher value is better)
+COMPARED = [('p50_ms', False), ('p95_ms', False), ('p99_ms', False), ('throughput', True)]
+
+QUERY_SAMPLE = re.compile(r'^http_request_db_queries_(sum|count)\{view="(\w+)"\} (\S+)$', re.MULTILINE)
+
+
+class Command(BaseCommand):
+    help = 'Load test the API end to end (signup, login, upload, list, link, download) against a local server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+        parser.add_argument('--server', default='wsgi', choices=list(SERVERS))
+        parser.add_argument('--workers', type=int, default=3, help='gunicorn sync workers')
+        parser.add_argument('--concurrency', type=int, default=8, help='Simultaneous clients')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+        parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests before each scenario')
+        parser.add_argument('--users', type=int, default=100, help='Seeded client users')
+        parser.add_argument('--files', type=int, default=10000, help='Seeded UploadedFile rows')
+        parser.add_argument('--tokens', type=int, default=10000, help='Seeded download tokens')
+        parser.add_argument('--blobs', type=int, default=30, help='Distinct seeded file contents')
+        parser.add_argument('--file-size', default='256K', help='Size of seeded and uploaded documents')
+        parser.add_argument(
+            '--database-url',
+            help='Run against this database (e.g. a scratch PostgreSQL database) instead of a throwaway SQLite file',
+        )
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+        parser.add_argument('--threshold', type=float, default=10, help='Percent change reported as a regression')
+        parser.add_argument('--prepare', action='store_true', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['prepare']:
+            self.stdout.write(json.dumps(self.prepare(options)))
+            return
+
+        if options['server'] == 'asgi' and importlib.util.find_spec('uvicorn') is None:
+            raise CommandError('uvicorn is not installed; pip install uvicorn or pass --server wsgi')
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = dict(
+                os.environ,
+                DATABASE_URL=options['database_url'] or f'sqlite:///{os.path.join(tmpdir, "db.sqlite3")}',
+                MEDIA_ROOT=os.path.join(tmpdir, 'media'),
+                METRICS_DIR=os.path.join(tmpdir, 'metrics'),
+                METRICS_ENABLED='True',
+                METRICS_AUTH_TOKEN='',
+                PROFILING_ENABLED='False',
+                MAIL_QUEUE_ENABLED='True',
+                DOWNLOAD_TOKEN_MODE='db',
+                ALLOWED_HOSTS='127.0.0.1',
+                DEBUG='False',
+                # Every client shares one address, so the rate limits would otherwise be the bottleneck
+                THROTTLE_RATE_UPLOADS='1000000/s',
+                THROTTLE_RATE_LINKS='1000000/s',
+                THROTTLE_RATE_LOGIN='1000000/s',
+                THROTTLE_RATE_SIGNUP='1000000/s',
+            )
+            try:
+                run_django(['migrate', '--verbosity', '0'], env)
+                self.stdout.write(
+                    f'Seeding {options["users"]} users, {options["files"]} files and {options["tokens"]} tokens...'
+                )
+                output = run_django(self.prepare_args(options), env)
+            except subprocess.CalledProcessError as e:
+                raise CommandError(e.stderr.strip().splitlines()[-1] if e.stderr.strip() else str(e))
+            fixtures = json.loads(output.strip().splitlines()[-1])
+
+            try:
+                with run_server(options['server'], env, options['workers']) as (port, process):
+                    results = self.run_scenarios(port, process.pid, fixtures, options)
+            except RuntimeError as e:
+                raise CommandError(str(e))
+
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
+        if baseline is not None:
+            self.compare(baseline, results, options['threshold'])
+
+    def prepare_args(self, options):
+        return [
+            'benchmark_api', '--prepare',
+            '--users', str(options['users']),
+            '--files', str(options['files']),
+            '--tokens', str(max(options['tokens'], options['warmup'] + options['requests'])),
+            '--blobs', str(options['blobs']),
+            '--file-size', options['file_size'],
+        ]
+
+    def prepare(self, options):
+        """Seed the database and return the credentials, ids and tokens the clients use"""
+        from django.contrib.auth.hashers import make_password
+        from django.core.files.base import ContentFile
+        from file_sharing.authentication import issue_auth_token
+        from file_sharing.models import DownloadToken, UploadedFile, User
+        from file_sharing.storage import blob_digest, file_storage
+        from file_sharing.utils import generate_secure_token
+
+        # A prefix per run keeps seeded names unique when reusing a database
+        prefix = f'bench-{uuid.uuid4().hex[:6]}'
+        # Hash the password once; hashing it per user would dominate seeding
+        password = make_password(PASSWORD)
+        ops_user = User.objects.create(
+            username=f'{prefix}-ops', password=password, user_type='ops', is_email_verified=True
+        )
+        User.objects.bulk_create([
+            User(username=f'{prefix}-client-{i}', email=f'{prefix}-client-{i}@example.com', password=password,
+                 user_type='client', is_email_verified=True)
+            for i in range(options['users'])
+        ])
+        # Read the clients back since not every backend returns primary keys from bulk_create
+        clients = list(User.objects.filter(username__startswith=f'{prefix}-client-').order_by('pk'))
+
+        size = parse_size(options['file_size'])
+        blobs = []
+        for i in range(options['blobs']):
+            file_type = FILE_TYPES[i % len(FILE_TYPES)]
+            blobs.append((file_type, file_storage.save(f'seed.{file_type}', ContentFile(make_office_file(file_type, size)))))
+
+        files = []
+        for start in range(0, options['files'], 5000):
+            batch = []
+            for i in range(start, min(start + 5000, options['files'])):
+                file_type, name = blobs[i % len(blobs)]
+                batch.append(UploadedFile(
+                    file=name,
+                    original_filename=f'{prefix} document {i}.{file_type}',
+                    uploaded_by=ops_user,
+                    file_size=file_storage.size(name),
+                    file_type=file_type,
+                    sha256=blob_digest(name),
+                ))
+            files.extend(UploadedFile.objects.bulk_create(batch))
+
+        expires_at = timezone.now() + timedelta(hours=1)
+        tokens = []
+        for start in range(0, options['tokens'], 5000):
+            batch = [
+                DownloadToken(
+                    token=generate_secure_token(),
+                    file=files[i % len(files)],
+                    user=clients[i % len(clients)],
+                    expires_at=expires_at,
+                )
+                for i in range(start, min(start + 5000, options['tokens']))
+            ]
+            DownloadToken.objects.bulk_create(batch)
+            tokens.extend(token.token for token in batch)
+
+        return {
+            'prefix': prefix,
+            'ops_token': issue_auth_token(ops_user)[0],
+            'client_tokens': [issue_auth_token(client)[0] for client in clients],
+            'client_usernames': [client.username for client in clients],
+            'file_ids': [str(uploaded_file.id) for uploaded_file in files[:1000]],
+            'download_tokens': tokens,
+            'upload_size': size,
+        }
+
+    def run_scenarios(self, port, pid, fixtures, options):
+        results = {
+            'created_at': timezone.now().isoformat(),
+            'server': options['server'],
+            'workers': options['workers'] if options['server'] == 'wsgi' else 1,
+            'database': urlsplit(options['database_url']).scheme if options['database_url'] else 'sqlite',
+            'concurrency': options['concurrency'],
+            'requests': options['requests'],
+            'seeded': {name: options[name] for name in ('users', 'files', 'tokens', 'blobs')},
+            'file_size': options['file_size'],
+            'scenarios': {},
+        }
+        builders = self.request_builders(fixtures)
+        warmup, count = options['warmup'], options['requests']
+        for name in options['scenarios']:
+            self.stdout.write(f'Running {name}...')
+            # Warm up every worker's connections and caches, then measure
+            self.run_scenario(port, pid, builders[name], range(warmup), options['concurrency'])
+            results['scenarios'][name] = self.run_scenario(
+                port, pid, builders[name], range(warmup, warmup + count), options['concurrency']
+            )
+
+        # Per-view query counts come from the server's own metrics, summed over its workers
+        samples = {}
+        for kind, view, value in QUERY_SAMPLE.findall(self.fetch_metrics(port)):
+            samples[view, kind] = float(value)
+        for name, result in results['scenarios'].items():
+            view = SCENARIOS[name]
+            count = samples.get((view, 'count'))
+            # Async views do not record queries
+            result['queries_per_request'] = samples[view, 'sum'] / count if count else None
+        return results
+
+    def request_builders(self, fixtures):
+        """Functions building the i-th (method, path, headers, body) request of each scenario"""
+        clients = list(zip(fixtures['client_usernames'], fixtures['client_tokens']))
+        client_cycle = itertools.cycle(clients)
+        file_cycle = itertools.cycle(fixtures['file_ids'])
+        ops_auth = {'Authorization': f'Token {fixtures["ops_token"]}'}
+
+        def signup(i):
+            username = f'{fixtures["prefix"]}-signup-{i}'
+            return 'POST', '/api/signup/', {'Content-Type': 'application/json'}, json.dumps({
+                'username': username, 'email': f'{username}@example.com',
+                'password': PASSWORD, 'confirm_password': PASSWORD,
+            }).encode()
+
+        def login(i):
+            username, _ = next(client_cycle)
+            return 'POST', '/api/login/', {'Content-Type': 'application/json'}, json.dumps({
+                'username': username, 'password': PASSWORD,
+            }).encode()
+
+        def upload(i):
+            # Fresh content each time, so uploads are not deduplicated into metadata-only writes
+            file_type = FILE_TYPES[i % len(FILE_TYPES)]
+            boundary = uuid.uuid4().hex
+            body = b''.join([
+                f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+                f'filename="upload-{i}.{file_type}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode(),
+                make_office_file(file_type, fixtures['upload_size']),
+                f'\r\n--{boundary}--\r\n'.encode(),
+            ])
+            return 'POST', '/api/upload/', {**ops_auth, 'Content-Type': f'multipart/form-data; boundary={boundary}'}, body
+
+        def list_files(i):
+            _, token = next(client_cycle)
+            return 'GET', '/api/files/', {'Authorization': f'Token {token}'}, None
+
+        def link(i):
+            _, token = next(client_cycle)
+            return 'GET', f'/api/download-file/{next(file_cycle)}/', {'Authorization': f'Token {token}'}, None
+
+        def download(i):
+            # Each seeded token is unused, so every request is a first, full download
+            return 'GET', f'/api/secure-download/{fixtures["download_tokens"][i]}/', {}, None
+
+        return {'signup': signup, 'login': login, 'upload': upload, 'list': list_files,
+                'link': link, 'download': download}
+
+    def run_scenario(self, port, pid, builder, indices, concurrency):
+        indices = iter(indices)
+        peak_rss = []
+        done = threading.Event()
+
+        def sample_rss():
+            while not done.is_set():
+                peak_rss.append(process_tree_rss_kb(pid))
+                done.wait(0.2)
+
+        def client():
+            # Each client thread keeps its own connection, reopened whenever the server closes it
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            results = []
+            while (i := next(indices, None)) is not None:
+                method, path, headers, body = builder(i)
+                start = time.perf_counter()
+                try:
+                    connection.request(method, path, body=body, headers=headers)
+                    response = connection.getresponse()
+                    response.read()
+                    results.append((time.perf_counter() - start, response.status))
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    results.append((time.perf_counter() - start, None))
+            connection.close()
+            return results
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            futures = [pool.submit(client) for _ in range(concurrency)]
+            results = [result for future in futures for result in future.result()]
+        wall = time.perf_counter() - start
+        done.set()
+        sampler.join()
+
+        latencies = [elapsed * 1000 for elapsed, _ in results]
+        statuses = {}
+        for _, code in results:
+            statuses[str(code)] = statuses.get(str(code), 0) + 1
+        rss = [value for value in peak_rss if value is not None]
+        return {
+            'requests': len(results),
+            'errors': sum(1 for _, code in results if code is None or code >= 400),
+            'statuses': statuses,
+            'seconds': wall,
+            'throughput': len(results) / wall if wall else 0.0,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'peak_rss_kb': max(rss) if rss else None,
+        }
+
+    def fetch_metrics(self, port):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        try:
+            connection.request('GET', '/metrics')
+            return connection.getresponse().read().decode()
+        finally:
+            connection.close()
+
+    def report(self, results):
+        self.stdout.write(
+            f'{results["server"]} server, {results["database"]} database, '
+            f'{results["concurrency"]} clients, {results["file_size"]} documents'
+        )
+        self.stdout.write(
+            f'{"scenario":>9} {"requests":>9} {"errors":>7} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} '
+            f'{"p99 ms":>8} {"queries":>8} {"peak RSS":>9}'
+        )
+        for name, result in results['scenarios'].items():
+            queries = '-' if result['queries_per_request'] is None else f'{result["queries_per_request"]:.1f}'
+            rss = '-' if result['peak_rss_kb'] is None else f'{result["peak_rss_kb"] / 1024:.0f}M'
+            self.stdout.write(
+                f'{name:>9} {result["requests"]:>9} {result["errors"]:>7} {result["throughput"]:>8.1f} '
+                f'{result["p50_ms"]:>8.1f} {result["p95_ms"]:>8.1f} {result["p99_ms"]:>8.1f} {queries:>8} {rss:>9}'
+            )
+
+    def compare(self, baseline, results, threshold):
+        """Print the change of each scenario from the baseline and fail on regressions beyond threshold percent"""
+        self.stdout.write(f'Change from baseline of {baseline.get("created_at", "unknown date")}:')
+        self.stdout.write(f'{"scenario":>9} ' + ' '.join(f'{key:>11}' for key, _ in COMPARED))
+        regressions = []
+        for name, result in results['scenarios'].items():
+            before = baseline.get('scenarios', {}).get(name)
+            if before is None:
+                continue
+            cells = []
+            for key, higher_is_better in COMPARED:
+                if not before.get(key):
+                    cells.append(f'{"-":>11}')
+                    continue
+                change = (result[key] - before[key]) / before[key] * 100
+                worse = -change if higher_is_better else change
+                if worse > threshold:
+                    regressions.append(f'{name} {key}')
+                cells.append(f'{change:>+10.1f}%')
+            self.stdout.write(f'{name:>9} ' + ' '.join(cells))
+        if regressions:
+            raise CommandError(f'Regressed by more than {threshold:g}%: {", ".join(regressions)}')
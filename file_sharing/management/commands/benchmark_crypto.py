@@ -0,0 +1,45 @@
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import base64
+import hashlib
+
+from file_sharing import crypto
+from file_sharing.benchmarking import Timer
+
+class Command(BaseCommand):
+    help = 'Microbenchmark Fernet encryption with per-call key derivation versus cached ciphers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000, help='Payloads per scenario')
+        parser.add_argument('--payload-size', type=int, default=96, help='Bytes per payload')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        payloads = [('x' * options['payload_size'])] * iterations
+        tokens = crypto.encrypt_many(payloads)
+
+        scenarios = [
+            ('encrypt, derive key per call', lambda: [self.legacy_encrypt(p) for p in payloads]),
+            ('encrypt, cached cipher', lambda: [crypto.encrypt(p) for p in payloads]),
+            ('encrypt_many', lambda: crypto.encrypt_many(payloads)),
+            ('decrypt, derive key per call', lambda: [self.legacy_decrypt(t) for t in tokens]),
+            ('decrypt, cached cipher', lambda: [crypto.decrypt(t) for t in tokens]),
+            ('decrypt_many', lambda: crypto.decrypt_many(tokens)),
+        ]
+
+        self.stdout.write(f'{"scenario":<32} {"ops/s":>10} {"us/op":>8}')
+        for name, func in scenarios:
+            with Timer() as timer:
+                func()
+            self.stdout.write(f'{name:<32} {iterations / timer.elapsed:>10.0f} {timer.elapsed / iterations * 1e6:>8.1f}')
+
+    def legacy_key(self):
+        # How encrypt_data/decrypt_data built the key before ciphers were cached
+        return base64.urlsafe_b64encode(hashlib.sha256(settings.SECRET_KEY.encode()[:32]).digest())
+
+    def legacy_encrypt(self, data):
+        return Fernet(self.legacy_key()).encrypt(data.encode()).decode()
+
+    def legacy_decrypt(self, token):
+        return Fernet(self.legacy_key()).decrypt(token.encode()).decode()
@@ -0,0 +1,125 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+import shutil
+import tempfile
+
+from file_sharing import views
+from file_sharing.benchmarking import Timer, benchmark_database, count_queries
+from file_sharing.models import DownloadToken, User, UploadedFile
+from file_sharing.tokens import TOKEN_MODES
+
+class Command(BaseCommand):
+    help = 'Compare link generation and redemption throughput of the download token modes, and of link reuse'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Links to issue and redeem per mode')
+        parser.add_argument('--modes', nargs='+', default=TOKEN_MODES, choices=TOKEN_MODES)
+        parser.add_argument('--files', type=int, default=20,
+                            help='Files a client keeps asking links for in the reuse comparison (0 skips it)')
+
+    def handle(self, *args, **options):
+        factory = APIRequestFactory(SERVER_NAME='localhost')
+        media_root = tempfile.mkdtemp()
+        self.stdout.write(
+            f'{"mode":<10} {"issue req/s":>12} {"queries":>8} {"redeem req/s":>13} {"queries":>8} {"token rows":>11}'
+        )
+
+        # X-Sendfile delivery keeps file I/O out of the measurement, and the link throttle is lifted
+        rates = dict(settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'], links='1000000000/min')
+        rest_framework = dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES=rates)
+        # Stateless modes need a replay cache shared between workers; the database cache is one,
+        # and benchmark_database creates its table
+        cache_settings = dict(settings.CACHES, benchmark_replay={
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'benchmark_replay_cache',
+        })
+        with override_settings(MEDIA_ROOT=media_root, FILE_DELIVERY_BACKEND='x-sendfile', REST_FRAMEWORK=rest_framework,
+                               CACHES=cache_settings, DOWNLOAD_REPLAY_CACHE='benchmark_replay'), \
+                benchmark_database():
+            ops_user = User.objects.create_user(username='benchops', password='benchpass123', user_type='ops')
+            client_user = User.objects.create_user(
+                username='benchclient', password='benchpass123', user_type='client', is_email_verified=True
+            )
+            uploaded_file = UploadedFile.objects.create(
+                file=SimpleUploadedFile('bench.docx', b'benchmark'),
+                original_filename='bench.docx',
+                uploaded_by=ops_user,
+                file_size=9,
+                file_type='docx'
+            )
+
+            for mode in options['modes']:
+                caches['benchmark_replay'].clear()
+                # Every link is redeemed before the next is needed, so reuse is left out here
+                with override_settings(DOWNLOAD_TOKEN_MODE=mode, DOWNLOAD_TOKEN_REUSE=False):
+                    tokens = []
+                    with count_queries() as issue_queries, Timer() as issue_timer:
+                        for _ in range(options['requests']):
+                            request = factory.get(f'/api/download-file/{uploaded_file.id}/')
+                            force_authenticate(request, user=client_user)
+                            link = views.download_file(request, file_id=uploaded_file.id).data['download_link']
+                            tokens.append(link.rstrip('/').rsplit('/', 1)[-1])
+
+                    with count_queries() as redeem_queries, Timer() as redeem_timer:
+                        for token in tokens:
+                            response = views.secure_download(factory.get(f'/api/secure-download/{token}/'), token=token)
+                            assert response.status_code == 200, response.status_code
+
+                rows = uploaded_file.downloadtoken_set.count()
+                uploaded_file.downloadtoken_set.all().delete()
+                self.stdout.write(
+                    f'{mode:<10} {options["requests"] / issue_timer.elapsed:>12.0f} '
+                    f'{issue_queries.count / options["requests"]:>8.1f} '
+                    f'{options["requests"] / redeem_timer.elapsed:>13.0f} '
+                    f'{redeem_queries.count / options["requests"]:>8.1f} {rows:>11}'
+                )
+
+            if options['files']:
+                self.link_reuse(factory, ops_user, client_user, options['requests'], options['files'])
+
+        shutil.rmtree(media_root, ignore_errors=True)
+
+    def link_reuse(self, factory, ops_user, client_user, requests, file_count):
+        """Issue links for the same few files over and over, as clients refreshing a file list do"""
+        files = [
+            UploadedFile.objects.create(
+                file=SimpleUploadedFile(f'bench{i}.docx', f'benchmark {i}'.encode()),
+                original_filename=f'bench{i}.docx',
+                uploaded_by=ops_user,
+                file_size=len(f'benchmark {i}'),
+                file_type='docx'
+            )
+            for i in range(file_count)
+        ]
+        file_ids = [str(f.id) for f in files]
+
+        def single(file_index):
+            request = factory.get(f'/api/download-file/{file_ids[file_index]}/')
+            force_authenticate(request, user=client_user)
+            views.download_file(request, file_id=files[file_index].id)
+            return 1
+
+        def bulk(file_index):
+            request = factory.post('/api/download-links/', {'file_ids': file_ids}, format='json')
+            force_authenticate(request, user=client_user)
+            return len(views.download_links(request).data['links'])
+
+        self.stdout.write('')
+        self.stdout.write(f'{requests} links for {file_count} files, db tokens, none redeemed')
+        self.stdout.write(f'{"strategy":<16} {"links/s":>9} {"queries":>8} {"inserts":>8} {"token rows":>11}')
+        for label, issue, reuse in [('single', single, False), ('single+reuse', single, True),
+                                    ('bulk', bulk, False), ('bulk+reuse', bulk, True)]:
+            DownloadToken.objects.all().delete()
+            links = 0
+            with override_settings(DOWNLOAD_TOKEN_MODE='db', DOWNLOAD_TOKEN_REUSE=reuse), \
+                    count_queries() as queries, Timer() as timer:
+                while links < requests:
+                    links += issue(links % file_count)
+            self.stdout.write(
+                f'{label:<16} {links / timer.elapsed:>9.0f} {queries.count / links:>8.2f} '
+                f'{queries.inserts / links:>8.2f} {DownloadToken.objects.count():>11}'
+            )
@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from file_sharing.benchmarking import Timer, format_size, make_sparse_file, parse_size, peak_rss_kb
+from file_sharing.delivery import stream_file
+
+class Command(BaseCommand):
+    help = 'Measure peak RSS of serving downloads of various sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', default=['1M', '100M', '1G'], help='File sizes to benchmark')
+        parser.add_argument('--modes', nargs='+', default=['stream', 'buffered'], choices=['stream', 'buffered'],
+                            help='stream uses the chunked download path, buffered reads the whole file')
+        parser.add_argument('--single', type=str, help=argparse.SUPPRESS)
+        parser.add_argument('--mode', type=str, default='stream', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['single']:
+            self.stdout.write(json.dumps(self.measure(parse_size(options['single']), options['mode'])))
+            return
+
+        self.stdout.write(f'{"size":>8} {"mode":>10} {"peak RSS":>12} {"delta":>12} {"seconds":>8}')
+        for size in options['sizes']:
+            for mode in options['modes']:
+                # Each measurement runs in a fresh interpreter since ru_maxrss never decreases
+                output = subprocess.run(
+                    [sys.executable, '-m', 'django', 'benchmark_downloads', '--single', size, '--mode', mode],
+                    cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                self.stdout.write(
+                    f'{format_size(result["size"]):>8} {mode:>10} {result["peak_kb"]:>9} KiB '
+                    f'{result["delta_kb"]:>8} KiB {result["seconds"]:>8.3f}'
+                )
+
+    def measure(self, size, mode):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'benchmark.docx')
+            make_sparse_file(path, size)
+            baseline = peak_rss_kb()
+
+            with Timer() as timer:
+                if mode == 'stream':
+                    response = stream_file(path, 'benchmark.docx')
+                else:
+                    with open(path, 'rb') as f:
+                        response = HttpResponse(f.read())
+                # Consume the body the way a WSGI server without sendfile would
+                sent = sum(len(chunk) for chunk in response)
+                response.close()
+
+        peak = peak_rss_kb()
+        return {'size': sent, 'mode': mode, 'peak_kb': peak, 'delta_kb': peak - baseline, 'seconds': timer.elapsed}
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from file_sharing import views
+from file_sharing.benchmarking import benchmark_database, count_queries, median_ms, seed_files
+from file_sharing.models import User, UploadedFile
+from file_sharing.pagination import encode_cursor
+from file_sharing.serializers import UploadedFileSerializer
+
+class Command(BaseCommand):
+    help = 'Compare query count and latency of the file listing against seeded tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', nargs='+', type=int, default=[10000, 100000, 1000000],
+                            help='Table sizes to seed and benchmark')
+        parser.add_argument('--legacy-max-rows', type=int, default=10000,
+                            help='Skip the unpaginated listing above this many rows')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per scenario; the median is reported')
+
+    def handle(self, *args, **options):
+        self.factory = APIRequestFactory()
+        self.stdout.write(f'{"rows":>9}  {"scenario":<34} {"queries":>7} {"median ms":>10}')
+
+        for rows in sorted(options['rows']):
+            with benchmark_database():
+                ops_user = User.objects.create_user(username='benchops', password='benchpass123', user_type='ops')
+                self.client_user = User.objects.create_user(
+                    username='benchclient', password='benchpass123', user_type='client', is_email_verified=True
+                )
+                seed_files(rows, ops_user)
+
+                middle = UploadedFile.objects.order_by('-uploaded_at', '-id')[rows // 2]
+                scenarios = [
+                    ('first page', {}),
+                    ('middle page (cursor)', {'cursor': encode_cursor(middle)}),
+                    ('first page, fields=id,name', {'fields': 'id,original_filename'}),
+                    ('first page, file_type filter', {'file_type': 'pptx'}),
+                    ('first page, count=exact', {'count': 'exact'}),
+                    ('first page, count=approx', {'count': 'approx'}),
+                ]
+                if rows <= options['legacy_max_rows']:
+                    self.report(rows, 'unpaginated (previous behaviour)', self.legacy_list, options['repeat'])
+                for name, params in scenarios:
+                    self.report(rows, name, lambda params=params: self.list_files(params), options['repeat'])
+
+    def report(self, rows, name, func, repeat):
+        with count_queries() as queries:
+            func()
+        self.stdout.write(f'{rows:>9}  {name:<34} {queries.count:>7} {median_ms(func, repeat):>10.1f}')
+
+    def list_files(self, params):
+        request = self.factory.get('/api/files/', params)
+        force_authenticate(request, user=self.client_user)
+        response = views.list_files(request)
+        assert response.status_code == 200, response.data
+
+    def legacy_list(self):
+        # The listing as it was before keyset pagination: every row, an N+1
+        # uploader lookup and a separate COUNT
+        files = UploadedFile.objects.all().order_by('-uploaded_at')
+        UploadedFileSerializer(files, many=True).data
+        files.count()
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from file_sharing.benchmarking import benchmark_database, median_ms, seed_files
+from file_sharing.models import User, UploadedFile
+from file_sharing.search import search_files
+
+class Command(BaseCommand):
+    help = 'Compare substring (icontains) filename search with the indexed search path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', nargs='+', type=int, default=[10000, 100000, 1000000],
+                            help='Table sizes to seed and benchmark')
+        parser.add_argument('--queries', nargs='+', default=['audit', 'quart rev', 'invoice 4242', 'zzz'],
+                            help='Search queries to run')
+        parser.add_argument('--limit', type=int, default=50, help='Rows fetched per search, like one listing page')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per scenario; the median is reported')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"rows":>9}  {"query":<14} {"path":<10} {"matches":>8} {"median ms":>10}')
+
+        for rows in sorted(options['rows']):
+            with benchmark_database():
+                ops_user = User.objects.create_user(username='benchops', password='benchpass123', user_type='ops')
+                seed_files(rows, ops_user)
+
+                for query in options['queries']:
+                    base = UploadedFile.objects.order_by('-uploaded_at', '-id')
+                    paths = [
+                        ('icontains', base.filter(original_filename__icontains=query)),
+                        ('indexed', search_files(base, query)),
+                        ('ranked', search_files(base, query, rank=True).order_by('-search_rank')),
+                    ]
+                    for name, queryset in paths:
+                        page = lambda queryset=queryset: list(queryset[:options['limit']])
+                        matches = queryset.count()
+                        self.stdout.write(
+                            f'{rows:>9}  {query:<14} {name:<10} {matches:>8} '
+                            f'{median_ms(page, options["repeat"]):>10.2f}'
+                        )
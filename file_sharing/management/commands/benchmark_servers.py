@@ -0,0 +1,149 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from datetime import timedelta
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import socket
+import statistics
+import tempfile
+import time
+
+from file_sharing.benchmarking import SERVERS, format_size, parse_size, run_django, run_server
+
+class Command(BaseCommand):
+    help = 'Load test concurrent slow downloads against gunicorn (WSGI) and uvicorn (ASGI)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', default=list(SERVERS), choices=list(SERVERS))
+        parser.add_argument('--concurrency', type=int, default=50, help='Simultaneous downloads')
+        parser.add_argument('--size', default='8M', help='Size of the downloaded file')
+        parser.add_argument('--rate', default='1M', help='Bytes per second each client reads')
+        parser.add_argument('--workers', type=int, default=3, help='gunicorn sync workers')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds before a download counts as failed')
+        parser.add_argument('--prepare', type=int, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        size = parse_size(options['size'])
+        if options['prepare']:
+            self.stdout.write(json.dumps(self.prepare(size, options['prepare'])))
+            return
+
+        if 'asgi' in options['servers'] and importlib.util.find_spec('uvicorn') is None:
+            raise CommandError('uvicorn is not installed; pip install uvicorn or pass --servers wsgi')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # The servers run against a throwaway database and media directory
+            env = dict(
+                os.environ,
+                DATABASE_URL=f'sqlite:///{os.path.join(tmpdir, "db.sqlite3")}',
+                MEDIA_ROOT=os.path.join(tmpdir, 'media'),
+                DOWNLOAD_TOKEN_MODE='signed',
+                # Every worker has to see the same used-token cache
+                CACHE_BACKEND='django.core.cache.backends.db.DatabaseCache',
+                CACHE_LOCATION='benchmark_cache',
+                ALLOWED_HOSTS='127.0.0.1',
+                DEBUG='False',
+            )
+            run_django(['migrate', '--verbosity', '0'], env)
+            run_django(['createcachetable'], env)
+            output = run_django(
+                ['benchmark_servers', '--size', options['size'],
+                 '--prepare', str(options['concurrency'] * len(options['servers']))], env,
+            )
+            tokens = json.loads(output.strip().splitlines()[-1])
+
+            self.stdout.write(
+                f'{options["concurrency"]} clients downloading {format_size(size)} at '
+                f'{format_size(parse_size(options["rate"]))}/s each'
+            )
+            self.stdout.write(
+                f'{"server":>6} {"ok":>5} {"failed":>7} {"wall s":>8} {"ttfb p50":>9} {"ttfb p95":>9} {"total p50":>10}'
+            )
+            for server in options['servers']:
+                batch, tokens = tokens[:options['concurrency']], tokens[options['concurrency']:]
+                result = self.benchmark(server, batch, env, options)
+                self.stdout.write(
+                    f'{server:>6} {result["ok"]:>5} {result["failed"]:>7} {result["wall"]:>8.2f} '
+                    f'{result["ttfb_p50"]:>9.3f} {result["ttfb_p95"]:>9.3f} {result["total_p50"]:>10.3f}'
+                )
+
+    def prepare(self, size, count):
+        from django.core.files.base import ContentFile
+        from file_sharing.models import UploadedFile, User
+        from file_sharing.tokens import issue_download_token
+
+        ops_user = User.objects.create_user(username='benchmark-ops', password='unused', user_type='ops')
+        client_user = User.objects.create_user(
+            username='benchmark-client', password='unused', user_type='client', is_email_verified=True
+        )
+        uploaded_file = UploadedFile.objects.create(
+            file=ContentFile(os.urandom(size), name='benchmark.docx'),
+            original_filename='benchmark.docx',
+            uploaded_by=ops_user,
+            file_size=size,
+            file_type='docx',
+        )
+        expires_at = timezone.now() + timedelta(hours=1)
+        return [issue_download_token(uploaded_file, client_user, expires_at) for _ in range(count)]
+
+    def benchmark(self, server, tokens, env, options):
+        try:
+            with run_server(server, env, options['workers']) as (port, _):
+                return asyncio.run(self.load(port, tokens, parse_size(options['rate']), options['timeout']))
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+    async def load(self, port, tokens, rate, timeout):
+        async def run(token):
+            try:
+                return await asyncio.wait_for(download(port, f'/api/secure-download/{token}/', rate), timeout)
+            except (asyncio.TimeoutError, OSError):
+                return None
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(run(token) for token in tokens))
+        wall = time.perf_counter() - start
+
+        ok = [result for result in results if result and result['status'] == 200]
+        ttfb = sorted(result['ttfb'] for result in ok) or [0.0]
+        return {
+            'ok': len(ok),
+            'failed': len(results) - len(ok),
+            'wall': wall,
+            'ttfb_p50': statistics.median(ttfb),
+            'ttfb_p95': ttfb[int(len(ttfb) * 0.95) - 1] if len(ttfb) > 1 else ttfb[0],
+            'total_p50': statistics.median([result['total'] for result in ok]) if ok else 0.0,
+        }
+
+
+async def download(port, path, rate):
+    """GET path reading the body at most rate bytes per second, like a slow client"""
+    sock = socket.socket()
+    # A small receive window keeps the kernel from absorbing the whole response
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+    sock.setblocking(False)
+    start = time.perf_counter()
+    await asyncio.get_running_loop().sock_connect(sock, ('127.0.0.1', port))
+    reader, writer = await asyncio.open_connection(sock=sock)
+    try:
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+        status_line = await reader.readline()
+        ttfb = time.perf_counter() - start
+        while await reader.readline() not in (b'\r\n', b''):
+            pass
+
+        received = 0
+        while chunk := await reader.read(65536):
+            received += len(chunk)
+            # Sleep until the client is back under its bandwidth budget
+            delay = received / rate - (time.perf_counter() - start - ttfb)
+            if delay > 0:
+                await asyncio.sleep(delay)
+    finally:
+        writer.close()
+
+    return {'status': int(status_line.split()[1]), 'ttfb': ttfb, 'total': time.perf_counter() - start}
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from rest_framework.settings import api_settings
+from rest_framework.test import APIRequestFactory
+from rest_framework.throttling import SimpleRateThrottle
+
+from file_sharing.benchmarking import Timer
+from file_sharing.throttling import LinkThrottle, local_buckets
+
+class CacheWindowThrottle(SimpleRateThrottle):
+    """DRF's stock sliding window throttle, for comparison"""
+    scope = 'links'
+
+    def get_rate(self):
+        return api_settings.DEFAULT_THROTTLE_RATES[self.scope]
+
+    def get_cache_key(self, request, view):
+        return self.cache_format % {'scope': self.scope, 'ident': self.get_ident(request)}
+
+class Command(BaseCommand):
+    help = 'Microbenchmark the cost of one throttle check per request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50000, help='Throttle checks per scenario')
+        parser.add_argument('--clients', type=int, default=1000, help='Distinct client addresses to spread checks over')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        factory = APIRequestFactory()
+        requests = [factory.get('/', REMOTE_ADDR=f'10.0.{i // 256}.{i % 256}') for i in range(options['clients'])]
+        for request in requests:
+            request.user = None
+
+        # A rate high enough that every check is allowed and does the full update
+        rates = dict(api_settings.DEFAULT_THROTTLE_RATES, links='1000000000/min')
+        scenarios = [
+            ('token bucket, local', {'THROTTLE_BACKEND': 'local'}, LinkThrottle),
+            ('token bucket, cache', {'THROTTLE_BACKEND': 'default'}, LinkThrottle),
+            ('DRF sliding window, cache', {}, CacheWindowThrottle),
+        ]
+
+        self.stdout.write(f'{"scenario":<28} {"us/check":>9}')
+        for name, overrides, throttle_class in scenarios:
+            local_buckets.clear()
+            with override_settings(REST_FRAMEWORK={'DEFAULT_THROTTLE_RATES': rates}, **overrides):
+                throttle = throttle_class()
+                with Timer() as timer:
+                    for i in range(iterations):
+                        throttle.allow_request(requests[i % len(requests)], None)
+            self.stdout.write(f'{name:<28} {timer.elapsed / iterations * 1e6:>9.2f}')
+        local_buckets.clear()
@@ -0,0 +1,110 @@
+from django.conf import settings
+from django.core.files.uploadhandler import load_handler
+from django.core.management.base import BaseCommand
+from django.http.multipartparser import MultiPartParser
+from django.test import override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from file_sharing.benchmarking import Timer, format_size, parse_size, peak_rss_kb
+from file_sharing.storage import file_storage
+from file_sharing.uploads import COPY_BUFFER_SIZE, StreamingUploadHandler
+
+def written_bytes():
+    """Bytes this process has passed to write calls so far, or None where /proc is unavailable"""
+    try:
+        with open('/proc/self/io') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('wchar:'))
+    except (OSError, StopIteration):
+        return None
+
+def write_body(path, size):
+    """Write a multipart/form-data request body carrying one file of random bytes"""
+    with open(path, 'wb') as f:
+        f.write((
+            f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="benchmark.docx"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode())
+        remaining = size
+        while remaining:
+            chunk = os.urandom(min(COPY_BUFFER_SIZE, remaining))
+            f.write(chunk)
+            remaining -= len(chunk)
+        f.write(f'\r\n--{BOUNDARY}--\r\n'.encode())
+
+class Command(BaseCommand):
+    help = 'Measure upload throughput, peak RSS and bytes written per uploaded byte for each upload handler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', default=['1M', '10M', '100M'], help='File sizes to benchmark')
+        parser.add_argument('--handlers', nargs='+', default=['streaming', 'default'], choices=['streaming', 'default'],
+                            help='streaming is StreamingUploadHandler, default is FILE_UPLOAD_HANDLERS')
+        parser.add_argument('--media-dir', default=settings.MEDIA_ROOT,
+                            help='Directory to store into; default handlers spool to FILE_UPLOAD_TEMP_DIR, so put '
+                                 'this on the filesystem MEDIA_ROOT uses in production')
+        parser.add_argument('--single', type=str, help=argparse.SUPPRESS)
+        parser.add_argument('--handler', type=str, default='streaming', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['single']:
+            self.stdout.write(json.dumps(
+                self.measure(parse_size(options['single']), options['handler'], options['media_dir'])
+            ))
+            return
+
+        self.stdout.write(
+            f'{"size":>8} {"handler":>10} {"peak RSS":>12} {"delta":>12} {"seconds":>8} {"MB/s":>8} {"written":>8}'
+        )
+        for size in options['sizes']:
+            for handler in options['handlers']:
+                # Each measurement runs in a fresh interpreter since ru_maxrss never decreases
+                output = subprocess.run(
+                    [sys.executable, '-m', 'django', 'benchmark_uploads', '--single', size, '--handler', handler,
+                     '--media-dir', options['media_dir']],
+                    cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                written = f'{result["written_ratio"]:.2f}x' if result['written_ratio'] is not None else 'n/a'
+                self.stdout.write(
+                    f'{format_size(result["size"]):>8} {handler:>10} {result["peak_kb"]:>9} KiB '
+                    f'{result["delta_kb"]:>8} KiB {result["seconds"]:>8.3f} '
+                    f'{result["size"] / 1024 ** 2 / result["seconds"]:>8.1f} {written:>8}'
+                )
+        self.stdout.write('written is bytes passed to write() per uploaded byte, from /proc/self/io')
+
+    def measure(self, size, handler_name, media_dir):
+        os.makedirs(media_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory() as tmpdir, tempfile.TemporaryDirectory(dir=media_dir) as media_root:
+            body_path = os.path.join(tmpdir, 'body')
+            write_body(body_path, size)
+
+            # The same path the upload view takes: parse the body, then store the file as FileField does
+            with override_settings(MEDIA_ROOT=media_root, UPLOAD_MAX_FILE_SIZE=size), open(body_path, 'rb') as body:
+                meta = {'CONTENT_TYPE': MULTIPART_CONTENT, 'CONTENT_LENGTH': str(os.path.getsize(body_path))}
+                if handler_name == 'streaming':
+                    handlers = [StreamingUploadHandler()]
+                else:
+                    handlers = [load_handler(path) for path in settings.FILE_UPLOAD_HANDLERS]
+                baseline = peak_rss_kb()
+                written = written_bytes()
+
+                with Timer() as timer:
+                    _, files = MultiPartParser(meta, body, handlers).parse()
+                    uploaded = files['file']
+                    name = file_storage.save(uploaded.name, uploaded)
+                    uploaded.close()
+
+                if written is not None:
+                    written = written_bytes() - written
+                stored = os.path.getsize(file_storage.path(name))
+
+        peak = peak_rss_kb()
+        return {
+            'size': stored, 'handler': handler_name, 'peak_kb': peak, 'delta_kb': peak - baseline,
+            'seconds': timer.elapsed, 'written_ratio': written / stored if written is not None else None,
+        }
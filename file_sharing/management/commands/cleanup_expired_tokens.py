@@ -1,13 +1,53 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from file_sharing.models import DownloadToken
+import time
+
+from file_sharing.cleanup import cleanup_counts, run_cleanup
+
+LABELS = {
+    'expired_tokens': 'expired download tokens',
+    'used_tokens': 'used download tokens',
+    'expired_batch_tokens': 'expired batch download tokens',
+    'expired_auth_tokens': 'expired login tokens',
+    'stale_verifications': 'stale email verification tokens',
+    'expired_upload_sessions': 'expired upload sessions',
+    'orphaned_chunk_dirs': 'orphaned chunk directories',
+}
 
 class Command(BaseCommand):
-    help = 'Clean up expired download tokens'
+    help = (
+        'Clean up expired and used download tokens, expired login tokens, stale email verification tokens and '
+        'expired upload sessions'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.CLEANUP_BATCH_SIZE,
+                            help='Rows deleted per transaction')
+        parser.add_argument('--sleep', type=float, default=settings.CLEANUP_BATCH_SLEEP,
+                            help='Seconds to pause between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many rows would be cleaned up')
+        parser.add_argument('--loop', action='store_true', help='Keep running, cleaning up every --interval seconds')
+        parser.add_argument('--interval', type=float, default=settings.CLEANUP_INTERVAL,
+                            help='Seconds between runs with --loop')
 
     def handle(self, *args, **options):
-        expired_tokens = DownloadToken.objects.filter(expires_at__lt=timezone.now())
-        count = expired_tokens.count()
-        expired_tokens.delete()
-        
-        self.stdout.write(self.style.SUCCESS(f'Successfully deleted {count} expired download tokens'))
+        if options['dry_run']:
+            for key, count in cleanup_counts().items():
+                self.stdout.write(f'Would clean up {count} {LABELS[key]}')
+            return
+
+        try:
+            while True:
+                counts = run_cleanup(options['batch_size'], options['sleep'])
+                self.stdout.write(self.style.SUCCESS(
+                    'Successfully deleted {expired_tokens} expired download tokens, {used_tokens} used download '
+                    'tokens, {expired_batch_tokens} expired batch download tokens and {expired_auth_tokens} expired '
+                    'login tokens, cleared {stale_verifications} stale email verification tokens, and removed '
+                    '{expired_upload_sessions} expired upload sessions and {orphaned_chunk_dirs} orphaned chunk '
+                    'directories'.format(**counts)
+                ))
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ImproperlyConfigured
+import time
+
+from file_sharing.compression import (
+    SUFFIXES, compress_pending, compression_report, configured_encoding, require_local_storage
+)
+from file_sharing.benchmarking import Timer
+
+class Command(BaseCommand):
+    help = 'Compress stored files that benefit from it, or report compression ratios per file type'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--encoding', choices=list(SUFFIXES), help='Encoding to store with (default COMPRESSION_ENCODING)')
+        parser.add_argument('--batch-size', type=int, help='Files per batch (default COMPRESSION_BATCH_SIZE)')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new uploads instead of exiting when done')
+        parser.add_argument('--interval', type=float, default=60, help='Seconds to sleep between polls with --loop')
+        parser.add_argument('--report', action='store_true', help='Only measure how well stored files compress')
+        parser.add_argument('--limit', type=int, help='Files measured by --report')
+        parser.add_argument('--level', type=int, help='Compression level measured by --report')
+
+    def handle(self, *args, **options):
+        if options['report']:
+            self.report(options['limit'], options['level'])
+            return
+
+        try:
+            require_local_storage()
+            encoding = configured_encoding(options['encoding'])
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        totals = {'compressed': 0, 'identity': 0, 'missing': 0}
+        try:
+            while True:
+                stats = compress_pending(options['batch_size'], encoding)
+                for key, value in stats.items():
+                    totals[key] += value
+                if any(stats.values()):
+                    self.stdout.write(
+                        f"Compressed {stats['compressed']}, kept {stats['identity']} uncompressed, "
+                        f"{stats['missing']} missing"
+                    )
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Successfully compressed {totals['compressed']} files with {encoding} "
+            f"({totals['identity']} did not compress enough, {totals['missing']} missing)"
+        ))
+
+    def report(self, limit, level):
+        with Timer() as timer:
+            try:
+                report = compression_report(limit, level)
+            except ImproperlyConfigured as e:
+                raise CommandError(str(e))
+        if not report:
+            self.stdout.write('No uncompressed files to measure')
+            return
+
+        encodings = [key for key in next(iter(report.values())) if key in SUFFIXES]
+        self.stdout.write(
+            f'{"type":>6} {"files":>7} {"size MB":>10} '
+            + ' '.join(f'{encoding + " ratio":>11}' for encoding in encodings)
+            + f' {"worthwhile":>11}'
+        )
+        for file_type, row in sorted(report.items()):
+            ratios = ' '.join(f'{row[encoding] / row["size"] if row["size"] else 1:>11.3f}' for encoding in encodings)
+            self.stdout.write(
+                f'{file_type:>6} {row["files"]:>7} {row["size"] / 1024 ** 2:>10.1f} {ratios} '
+                f'{row["worthwhile"]:>11}'
+            )
+        self.stdout.write(f'Measured in {timer.elapsed:.1f}s; ratio is compressed / original size')
@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from file_sharing.benchmarking import Timer
+from file_sharing.storage import STORAGE_BACKENDS, configured_storage
+from file_sharing.storage_migration import migrate_storage, pending_counts
+
+class Command(BaseCommand):
+    help = 'Move files stored under uploads/<username>/ into the sharded blob layout, and copy blobs to a remote backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', choices=STORAGE_BACKENDS,
+                            help='Backend to migrate to (default FILE_STORAGE_BACKEND); copying to a backend '
+                                 'that is not serving yet leaves the local files in place')
+        parser.add_argument('--batch-size', type=int, default=settings.STORAGE_MIGRATION_BATCH_SIZE,
+                            help='Distinct stored files per batch')
+        parser.add_argument('--sleep', type=float, default=settings.STORAGE_MIGRATION_SLEEP,
+                            help='Seconds to pause between batches')
+        parser.add_argument('--keep-source', action='store_true', help='Leave the migrated local files in place')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many files are left to migrate')
+
+    def handle(self, *args, **options):
+        try:
+            configured_storage(options['backend'])
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        if options['dry_run']:
+            counts = pending_counts(options['backend'])
+            self.stdout.write(f"{counts['legacy']} files to move into the blob layout")
+            if 'blobs' in counts:
+                self.stdout.write(f"{counts['blobs']} blobs to check against the remote backend")
+            return
+
+        def progress(after, stats):
+            self.stdout.write(
+                f"Resharded {stats['resharded']}, copied {stats['copied']}, {stats['missing']} missing (up to {after})"
+            )
+
+        with Timer() as timer:
+            try:
+                totals = migrate_storage(
+                    options['batch_size'], options['sleep'], options['backend'], options['keep_source'], progress
+                )
+            except KeyboardInterrupt:
+                # Every batch is consistent on its own; a rerun resumes with what is left
+                self.stdout.write('Interrupted')
+                return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Successfully resharded {totals['resharded']} files and copied {totals['copied']} blobs "
+            f"in {timer.elapsed:.1f}s ({totals['missing']} missing)"
+        ))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+import time
+
+from file_sharing.processing import process_pending, queue_stats
+
+class Command(BaseCommand):
+    help = 'Checksum, validate and extract metadata from new uploads over a pool of threads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Threads running jobs (default PROCESSING_WORKERS)')
+        parser.add_argument('--batch-size', type=int, help='Jobs per batch (default PROCESSING_BATCH_SIZE)')
+        parser.add_argument('--loop', action='store_true', help='Keep polling the queue instead of exiting when it is empty')
+        parser.add_argument('--interval', type=float, default=2, help='Seconds to sleep between polls with --loop')
+        parser.add_argument('--stats', action='store_true', help='Only print queue depth and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.write_stats()
+            return
+
+        totals = {'processed': 0, 'retried': 0, 'failed': 0}
+        try:
+            while True:
+                stats = process_pending(options['batch_size'], options['workers'])
+                for key, value in stats.items():
+                    totals[key] += value
+                if any(stats.values()):
+                    self.stdout.write(
+                        f"Processed {stats['processed']}, retrying {stats['retried']}, failed {stats['failed']}"
+                    )
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Successfully processed {totals['processed']} uploads "
+            f"({totals['retried']} to retry, {totals['failed']} failed)"
+        ))
+        self.write_stats()
+
+    def write_stats(self):
+        stats = queue_stats()
+        self.stdout.write(
+            f"Queue: {stats['queued']} queued, {stats['due']} due, {stats['failed']} failed, "
+            f"oldest {stats['oldest_age_seconds']:.0f}s; {stats['pending_files']} files pending"
+        )
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import shutil
+
+from file_sharing.profiling import list_profiles, load_profile, top_functions
+
+class Command(BaseCommand):
+    help = 'List captured request profiles or summarize one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('profile_id', nargs='?', help='Profile to summarize (default: list all)')
+        parser.add_argument('--limit', type=int, default=20, help='Functions and queries to show')
+        parser.add_argument('--sort', default='cumulative', help='pstats sort key, e.g. cumulative or tottime')
+        parser.add_argument('--slowest', action='store_true', help='Summarize the slowest stored profile')
+        parser.add_argument('--clear', action='store_true', help='Delete all stored profiles')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            shutil.rmtree(settings.PROFILING_DIR, ignore_errors=True)
+            self.stdout.write(self.style.SUCCESS('Deleted all profiles'))
+            return
+
+        profile_ids = list_profiles()
+        if options['slowest'] and profile_ids:
+            options['profile_id'] = max(profile_ids, key=lambda profile_id: load_profile(profile_id)['ms'])
+
+        if options['profile_id']:
+            if options['profile_id'] not in profile_ids:
+                raise CommandError(f'No profile {options["profile_id"]} in {settings.PROFILING_DIR}')
+            self.summarize(options['profile_id'], options['limit'], options['sort'])
+            return
+
+        self.stdout.write(f'{"id":<30} {"method":<6} {"status":>6} {"ms":>9} {"queries":>7} {"dupes":>5}  path')
+        for profile_id in profile_ids:
+            meta = load_profile(profile_id)
+            self.stdout.write(
+                f'{profile_id:<30} {meta["method"]:<6} {meta["status"]:>6} {meta["ms"]:>9.1f} '
+                f'{len(meta["queries"]):>7} {len(meta["duplicates"]):>5}  {meta["path"]}'
+            )
+
+    def summarize(self, profile_id, limit, sort):
+        meta = load_profile(profile_id)
+        query_ms = sum(query['ms'] for query in meta['queries'])
+        self.stdout.write(f'{meta["method"]} {meta["path"]} -> {meta["status"]} in {meta["ms"]:.1f} ms')
+        self.stdout.write(f'{len(meta["queries"])} queries taking {query_ms:.1f} ms\n')
+
+        if meta['duplicates']:
+            self.stdout.write(self.style.WARNING('Repeated queries (possible N+1):'))
+            for duplicate in meta['duplicates'][:limit]:
+                self.stdout.write(f'  {duplicate["count"]:>4}x {duplicate["ms"]:>8.1f} ms  {duplicate["sql"]}')
+            self.stdout.write('')
+
+        self.stdout.write('Slowest queries:')
+        for query in sorted(meta['queries'], key=lambda query: -query['ms'])[:limit]:
+            self.stdout.write(f'  {query["ms"]:>8.1f} ms  {query["sql"]}')
+
+        self.stdout.write('\nTop functions:')
+        self.stdout.write(top_functions(profile_id, limit, sort))
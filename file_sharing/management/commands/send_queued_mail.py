@@ -0,0 +1,49 @@
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+import time
+
+from file_sharing.mail import queue_stats, send_queued_mail
+
+class Command(BaseCommand):
+    help = 'Send queued outbound emails in batches over one connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Messages per batch (default MAIL_QUEUE_BATCH_SIZE)')
+        parser.add_argument('--loop', action='store_true', help='Keep polling the queue instead of exiting when it is empty')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to sleep between polls with --loop')
+        parser.add_argument('--stats', action='store_true', help='Only print queue depth and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.write_stats()
+            return
+
+        connection = get_connection()
+        totals = {'sent': 0, 'retried': 0, 'failed': 0}
+        try:
+            while True:
+                stats = send_queued_mail(options['batch_size'], connection=connection)
+                for key, value in stats.items():
+                    totals[key] += value
+                if any(stats.values()):
+                    self.stdout.write(
+                        f"Sent {stats['sent']}, retrying {stats['retried']}, failed {stats['failed']}"
+                    )
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Successfully sent {totals['sent']} emails ({totals['retried']} to retry, {totals['failed']} failed)"
+        ))
+        self.write_stats()
+
+    def write_stats(self):
+        stats = queue_stats()
+        self.stdout.write(
+            f"Queue: {stats['queued']} queued, {stats['due']} due, {stats['failed']} failed, "
+            f"oldest {stats['oldest_age_seconds']:.0f}s"
+        )
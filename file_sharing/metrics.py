@@ -0,0 +1,202 @@
+from django.conf import settings
+import functools
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'http_request_duration_seconds': (
+        'histogram', 'Time from receiving a request to returning its response',
+        (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    ),
+    'http_request_db_queries': (
+        'histogram', 'Database queries run per request',
+        (0, 1, 2, 3, 5, 10, 20, 50, 100),
+    ),
+    'http_request_db_seconds': (
+        'histogram', 'Time spent in database queries per request',
+        (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+    ),
+    'download_response_bytes': (
+        'histogram', 'Bytes of a download body streamed by Django, by whether the transfer completed',
+        (1024, 65536, 1048576, 10485760, 104857600, 1073741824),
+    ),
+    'download_offloaded_total': (
+        'counter', 'Download responses whose body is sent by a proxy, object storage or the WSGI server', None,
+    ),
+    'upload_size_bytes': (
+        'histogram', 'Size of stored uploads',
+        (1024, 65536, 1048576, 10485760, 104857600, 1073741824),
+    ),
+    'download_token_validations_total': (
+        'counter', 'Download link redemptions by outcome', None,
+    ),
+}
+
+HEADER_SIZE = 8
+INITIAL_SIZE = 64 * 1024
+
+
+class MetricsFile:
+    """A memory mapped, append-only map of sample keys to float values owned by one process"""
+
+    # Layout: a uint32 of bytes used, then entries of a uint32 key length, the
+    # UTF-8 key padded to 8 bytes and a float64 value. Other processes only read.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a+b')
+        if os.path.getsize(path) == 0:
+            self.file.truncate(INITIAL_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.used = struct.unpack_from('I', self.map, 0)[0] or HEADER_SIZE
+        self.offsets = {key: offset for key, _, offset in self.entries(self.map, self.used)}
+
+    @staticmethod
+    def entries(data, used):
+        """Yield the (key, value, value offset) of each entry"""
+        position = HEADER_SIZE
+        while position < used:
+            length = struct.unpack_from('I', data, position)[0]
+            key = bytes(data[position + 4:position + 4 + length]).decode()
+            offset = position + 4 + length + (-(4 + length) % 8)
+            yield key, struct.unpack_from('d', data, offset)[0], offset
+            position = offset + 8
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < HEADER_SIZE:
+            return {}
+        return {key: value for key, value, _ in cls.entries(data, struct.unpack_from('I', data, 0)[0])}
+
+    def add(self, key, amount):
+        with self.lock:
+            offset = self.offsets.get(key)
+            if offset is None:
+                offset = self.append(key)
+            value = struct.unpack_from('d', self.map, offset)[0]
+            struct.pack_into('d', self.map, offset, value + amount)
+
+    def append(self, key):
+        encoded = key.encode()
+        padded = 4 + len(encoded) + (-(4 + len(encoded)) % 8)
+        while self.used + padded + 8 > len(self.map):
+            self.map.close()
+            self.file.truncate(os.path.getsize(self.path) * 2)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+        struct.pack_into(f'I{len(encoded)}s', self.map, self.used, len(encoded), encoded)
+        offset = self.used + padded
+        self.used = offset + 8
+        # Publish the entry only after it is written
+        struct.pack_into('I', self.map, 0, self.used)
+        self.offsets[key] = offset
+        return offset
+
+
+_process_file = None
+
+
+def process_file():
+    """The metrics file of the current process, reopened after a fork"""
+    global _process_file
+    pid = os.getpid()
+    if _process_file is None or _process_file[0] != (pid, settings.METRICS_DIR):
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        _process_file = ((pid, settings.METRICS_DIR), MetricsFile(os.path.join(settings.METRICS_DIR, f'{pid}.db')))
+    return _process_file[1]
+
+
+def sample_key(name, labels):
+    return encode_key(name, tuple(sorted(labels.items())))
+
+
+@functools.lru_cache(maxsize=4096)
+def encode_key(name, labels):
+    # Series repeat on every request, so their keys are only serialized once
+    return json.dumps([name, labels], separators=(',', ':'))
+
+
+@functools.lru_cache(maxsize=4096)
+def histogram_keys(name, labels, le):
+    return (
+        encode_key(name + '_bucket', tuple(sorted(labels + (('le', le),)))),
+        encode_key(name + '_sum', labels),
+        encode_key(name + '_count', labels),
+    )
+
+
+def inc(name, amount=1, **labels):
+    """Increment a counter"""
+    if settings.METRICS_ENABLED:
+        process_file().add(sample_key(name, labels), amount)
+
+
+def observe(name, value, **labels):
+    """Record a value in a histogram"""
+    if not settings.METRICS_ENABLED:
+        return
+    # Count only the first matching bucket; export makes them cumulative
+    le = next((str(bound) for bound in METRICS[name][2] if value <= bound), '+Inf')
+    bucket_key, sum_key, count_key = histogram_keys(name, tuple(sorted(labels.items())), le)
+    metrics = process_file()
+    metrics.add(bucket_key, 1)
+    metrics.add(sum_key, value)
+    metrics.add(count_key, 1)
+
+
+def collect():
+    """Sum the samples of every process that has written to METRICS_DIR"""
+    totals = {}
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.db')):
+        for key, value in MetricsFile.read(path).items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def format_value(value):
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+def render():
+    """Render all metrics in the Prometheus text exposition format"""
+    samples = {}
+    for key, value in collect().items():
+        name, labels = json.loads(key)
+        samples.setdefault(name, []).append((tuple(map(tuple, labels)), value))
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for labels, value in sorted(samples.get(name, [])):
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+            continue
+
+        counts = {}
+        for labels, value in samples.get(name + '_bucket', []):
+            le = dict(labels).pop('le')
+            series = tuple(label for label in labels if label[0] != 'le')
+            counts.setdefault(series, {})[le] = value
+        sums = dict(samples.get(name + '_sum', []))
+        for series in sorted(counts):
+            cumulative = 0.0
+            for le in [*map(str, buckets), '+Inf']:
+                cumulative += counts[series].get(le, 0)
+                lines.append(f'{name}_bucket{format_labels(series + (("le", le),))} {format_value(cumulative)}')
+            lines.append(f'{name}_sum{format_labels(series)} {format_value(sums.get(series, 0.0))}')
+            lines.append(f'{name}_count{format_labels(series)} {format_value(cumulative)}')
+    return '\n'.join(lines) + '\n'
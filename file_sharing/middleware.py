@@ -0,0 +1,155 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.db.backends.signals import connection_created
+import time
+
+from . import metrics
+from .delivery import OFFLOAD_HEADERS
+from .profiling import RequestProfile, should_profile
+from .benchmarking import QueryCounter
+
+# Views whose responses are file downloads
+DOWNLOAD_VIEWS = {'secure_download'}
+# Counter of the async request being handled; the context follows its queries to the ORM's threads
+request_queries = ContextVar('request_queries', default=None)
+
+
+def count_request_queries(execute, sql, params, many, context):
+    counter = request_queries.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    return counter(execute, sql, params, many, context)
+
+
+def install_query_counter(sender=None, connection=connection, **kwargs):
+    """Add count_request_queries to a connection's execute wrappers once"""
+    if count_request_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_request_queries)
+
+
+def offloaded_via(request, response):
+    """What sends a download response's body instead of Django, or None when Django streams it"""
+    for backend, header in OFFLOAD_HEADERS.items():
+        if response.has_header(header):
+            return backend
+    if response.status_code in (301, 302, 303, 307, 308):
+        return 'redirect'
+    if getattr(response, 'file_to_stream', None) is not None and request.META.get('wsgi.file_wrapper'):
+        # The WSGI server sends the file itself, e.g. with os.sendfile under gunicorn
+        return 'sendfile'
+    return None
+
+
+def count_bytes(chunks, status):
+    """Yield the chunks of a response body, recording what was sent and whether it all was"""
+    sent = 0
+    outcome = 'aborted'
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+        outcome = 'complete'
+    finally:
+        metrics.observe('download_response_bytes', sent, status=status, outcome=outcome)
+
+
+async def acount_bytes(chunks, status):
+    """Async version of count_bytes"""
+    sent = 0
+    outcome = 'aborted'
+    try:
+        async for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+        outcome = 'complete'
+    finally:
+        metrics.observe('download_response_bytes', sent, status=status, outcome=outcome)
+
+
+class MetricsMiddleware:
+    """Record per-view latency, database work and download sizes in the shared metrics files"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+            # Async views run their queries on other threads, each with its own connection
+            install_query_counter()
+            connection_created.connect(install_query_counter, dispatch_uid='file_sharing.request_queries')
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, counter)
+        return response
+
+    async def __acall__(self, request):
+        counter = QueryCounter()
+        token = request_queries.set(counter)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_queries.reset(token)
+        self.record(request, response, time.perf_counter() - start, counter)
+        return response
+
+    def record(self, request, response, elapsed, counter):
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        labels = {'view': view, 'method': request.method, 'status': str(response.status_code)}
+        metrics.observe('http_request_duration_seconds', elapsed, **labels)
+        metrics.observe('http_request_db_queries', counter.count, view=view)
+        metrics.observe('http_request_db_seconds', counter.seconds, view=view)
+        if view in DOWNLOAD_VIEWS:
+            self.record_download(request, response)
+
+    def record_download(self, request, response):
+        status = str(response.status_code)
+        via = offloaded_via(request, response)
+        if via is not None:
+            # The bytes never pass through Django, so only the hand-off is counted
+            metrics.inc('download_offloaded_total', via=via, status=status)
+        elif response.status_code in (200, 206):
+            if not response.streaming:
+                metrics.observe('download_response_bytes', len(response.content), status=status, outcome='complete')
+            elif response.is_async:
+                response.streaming_content = acount_bytes(response.streaming_content, status)
+            else:
+                # Counted as the server pulls the body, so a client hanging up shows as aborted
+                response.streaming_content = count_bytes(response.streaming_content, status)
+
+
+class ProfilingMiddleware:
+    """Capture cProfile stats and SQL for requests chosen by header or sample rate"""
+
+    sync_capable = True
+    async_capable = False
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not should_profile(request):
+            return self.get_response(request)
+
+        with RequestProfile() as profile, connection.execute_wrapper(profile.recorder):
+            response = self.get_response(request)
+        response['X-Profile-Id'] = profile.save(request, response)
+        return response
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-18 03:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file_sharing', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadtoken',
+            name='etag',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='downloadtoken',
+            name='used_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
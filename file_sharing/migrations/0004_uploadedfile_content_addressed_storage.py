@@ -0,0 +1,25 @@
+# Generated by Django 5.2.3 on 2026-10-18 04:00
+
+import file_sharing.models
+import file_sharing.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file_sharing', '0003_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='file',
+            field=models.FileField(storage=file_sharing.storage.get_file_storage, upload_to=file_sharing.models.upload_to),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.3 on 2026-10-18 04:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file_sharing', '0004_uploadedfile_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['-uploaded_at', '-id'], name='uploadedfile_recent_idx'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+from django.db import migrations
+
+FTS_TABLE = 'file_sharing_uploadedfile_fts'
+
+SQLITE_FORWARD = [
+    f"""
+    CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        original_filename, username, tokenize = 'unicode61', prefix = '2 3'
+    )
+    """,
+    f"""
+    INSERT INTO {FTS_TABLE}(rowid, original_filename, username)
+    SELECT f.rowid, f.original_filename, u.username
+    FROM file_sharing_uploadedfile f JOIN file_sharing_user u ON u.id = f.uploaded_by_id
+    """,
+    # The triggers keeping the index in sync are created after migrate by
+    # file_sharing.search.restore_sqlite_index
+]
+
+SQLITE_REVERSE = [
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_username',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_update',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_delete',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_insert',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+]
+
+# Trigram indexes on UPPER(column) serve Django's icontains lookups
+POSTGRESQL_FORWARD = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS uploadedfile_filename_trgm_idx ON file_sharing_uploadedfile '
+    'USING gin (UPPER(original_filename) gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS user_username_trgm_idx ON file_sharing_user '
+    'USING gin (UPPER(username) gin_trgm_ops)',
+]
+
+POSTGRESQL_REVERSE = [
+    'DROP INDEX IF EXISTS user_username_trgm_idx',
+    'DROP INDEX IF EXISTS uploadedfile_filename_trgm_idx',
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file_sharing', '0005_uploadedfile_recent_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD}),
+            run_for_vendor({'sqlite': SQLITE_REVERSE, 'postgresql': POSTGRESQL_REVERSE}),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.3 on 2026-10-18 04:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('file_sharing', '0006_uploadedfile_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='downloadtoken',
+            index=models.Index(fields=['expires_at'], name='downloadtoken_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='downloadtoken',
+            index=models.Index(condition=models.Q(('is_used', False)), fields=['user', 'file', 'expires_at'], name='downloadtoken_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['file_type', '-uploaded_at', '-id'], name='uploadedfile_type_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('email_verification_token__isnull', False)), fields=['email_verification_token'], name='user_verification_token_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.3 on 2026-10-18 04:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('file_sharing', '0008_outboundemail'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='downloadtoken',
+            index=models.Index(condition=models.Q(('is_used', True)), fields=['used_at'], name='downloadtoken_used_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('email_verification_token__isnull', False)), fields=['date_joined'], name='user_unverified_joined_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.3 on 2026-10-18 04:23
+
+import django.db.models.deletion
+import hashlib
+from datetime import timedelta
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def hash_existing_tokens(apps, schema_editor):
+    """Carry rest_framework authtoken keys over as hashed, expiring tokens and drop the plain keys"""
+    Token = apps.get_model('authtoken', 'Token')
+    AuthToken = apps.get_model('file_sharing', 'AuthToken')
+    expires_at = timezone.now() + timedelta(hours=settings.AUTH_TOKEN_LIFETIME_HOURS)
+    AuthToken.objects.bulk_create([
+        AuthToken(key_hash=hashlib.sha256(key.encode()).hexdigest(), user_id=user_id, expires_at=expires_at)
+        for key, user_id in Token.objects.values_list('key', 'user_id').iterator()
+    ], batch_size=1000)
+    Token.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authtoken', '0004_alter_tokenproxy_options'),
+        ('file_sharing', '0009_cleanup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_hash', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='auth_tokens', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(hash_existing_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file_sharing', '0011_batchdownloadtoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='stored_encoding',
+            field=models.CharField(blank=True, default='', max_length=10),
+        ),
+    ]
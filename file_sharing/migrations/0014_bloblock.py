@@ -0,0 +1,21 @@
+# Generated by Django 5.2.3 on 2026-10-18 06:04
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file_sharing', '0013_upload_processing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlobLock',
+            fields=[
+                ('name', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('locked_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
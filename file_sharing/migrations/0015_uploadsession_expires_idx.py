@@ -0,0 +1,17 @@
+# Generated by Django 5.2.3 on 2026-10-18 06:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file_sharing', '0014_bloblock'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadsession',
+            index=models.Index(fields=['expires_at'], name='uploadsession_expires_idx'),
+        ),
+    ]
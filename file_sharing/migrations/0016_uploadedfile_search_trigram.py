@@ -0,0 +1,37 @@
+from django.db import migrations
+
+FTS_TABLE = 'file_sharing_uploadedfile_fts'
+
+
+def rebuild_index(tokenizer):
+    """Recreate the FTS5 table with a tokenizer; the triggers from 0006 refer to it by name and keep working"""
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor != 'sqlite':
+            return
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(original_filename, username, {tokenizer})'
+        )
+        schema_editor.execute(
+            f"""
+            INSERT INTO {FTS_TABLE}(rowid, original_filename, username)
+            SELECT f.rowid, f.original_filename, u.username
+            FROM file_sharing_uploadedfile f JOIN file_sharing_user u ON u.id = f.uploaded_by_id
+            """
+        )
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file_sharing', '0015_uploadsession_expires_idx'),
+    ]
+
+    # Trigrams match a term anywhere in a word, as icontains does on PostgreSQL
+    operations = [
+        migrations.RunPython(
+            rebuild_index("tokenize = 'trigram'"),
+            rebuild_index("tokenize = 'unicode61', prefix = '2 3'"),
+        ),
+    ]
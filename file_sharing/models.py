@@ -1,9 +1,14 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
+from django.core.files import File
 from django.utils import timezone
+from datetime import timedelta
 import uuid
 import os
 
+from .storage import blob_digest, blob_name, content_digest, get_file_storage
+
 class User(AbstractUser):
     USER_TYPES = (
         ('ops', 'Operations User'),
@@ -13,24 +18,101 @@ class User(AbstractUser):
     is_email_verified = models.BooleanField(default=False)
     email_verification_token = models.CharField(max_length=100, blank=True, null=True)
     
+    class Meta(AbstractUser.Meta):
+        swappable = 'AUTH_USER_MODEL'
+        indexes = [
+            # verify_email lookups; only unverified users carry a token
+            models.Index(
+                fields=['email_verification_token'],
+                name='user_verification_token_idx',
+                condition=models.Q(email_verification_token__isnull=False),
+            ),
+            # Stale verification links cleared by cleanup_expired_tokens
+            models.Index(
+                fields=['date_joined'],
+                name='user_unverified_joined_idx',
+                condition=models.Q(email_verification_token__isnull=False),
+            ),
+        ]
+    
     def __str__(self):
         return f"{self.username} ({self.user_type})"
 
+class AuthToken(models.Model):
+    # Only the SHA-256 of the key is stored; the key itself is shown once at login
+    key_hash = models.CharField(max_length=64, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='auth_tokens')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    
+    def is_expired(self):
+        return timezone.now() > self.expires_at
+    
+    def __str__(self):
+        return f"Auth token for {self.user.username}"
+
 def upload_to(instance, filename):
     return f'uploads/{instance.uploaded_by.username}/{filename}'
 
 class UploadedFile(models.Model):
+    PROCESSING_STATUSES = (
+        ('pending', 'Pending'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    )
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    file = models.FileField(upload_to=upload_to)
+    file = models.FileField(upload_to=upload_to, storage=get_file_storage)
     original_filename = models.CharField(max_length=255)
     uploaded_by = models.ForeignKey(User, on_delete=models.CASCADE)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     file_size = models.BigIntegerField()
     file_type = models.CharField(max_length=10)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    # How the blob is stored: 'identity', 'gzip' or 'zstd'; blank until compress_files has processed it
+    stored_encoding = models.CharField(max_length=10, blank=True, default='')
+    # Set by the post-upload processing jobs; the upload views store new files as pending
+    processing_status = models.CharField(max_length=10, choices=PROCESSING_STATUSES, default='ready')
+    processing_error = models.TextField(blank=True)
+    metadata = models.JSONField(default=dict, blank=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        indexes = [
+            # Keyset pagination of the newest-first file listing
+            models.Index(fields=['-uploaded_at', '-id'], name='uploadedfile_recent_idx'),
+            # The same listing filtered by file type
+            models.Index(fields=['file_type', '-uploaded_at', '-id'], name='uploadedfile_type_recent_idx'),
+        ]
+    
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            # Commit the file first so the content hash is known before the row is written
+            if self.file and not self.file._committed:
+                content = self.file.file
+                if not getattr(content, 'sha256', None):
+                    content.sha256 = content_digest(content if hasattr(content, 'chunks') else File(content))
+                # Until this row commits, a delete of the same blob waits and then sees it
+                BlobLock.acquire(blob_name(content.sha256))
+                self.file.save(self.file.name, content, save=False)
+            if not self.sha256:
+                self.sha256 = blob_digest(self.file.name) or ''
+            super().save(*args, **kwargs)
     
     def __str__(self):
         return f"{self.original_filename} by {self.uploaded_by.username}"
 
+class BlobLock(models.Model):
+    """A row per stored blob name, kept while the blob exists, that saves and deletes of the blob lock in turn"""
+    name = models.CharField(max_length=255, primary_key=True)
+    locked_at = models.DateTimeField(default=timezone.now)
+    
+    @classmethod
+    def acquire(cls, name):
+        """Lock a blob name until the surrounding transaction ends"""
+        cls.objects.bulk_create([cls(name=name)], ignore_conflicts=True)
+        # The update takes the row lock on PostgreSQL and the write lock on SQLite
+        cls.objects.filter(name=name).update(locked_at=timezone.now())
+
 class DownloadToken(models.Model):
     token = models.CharField(max_length=100, unique=True)
     file = models.ForeignKey(UploadedFile, on_delete=models.CASCADE)
@@ -38,9 +120,206 @@ class DownloadToken(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()
     is_used = models.BooleanField(default=False)
+    used_at = models.DateTimeField(blank=True, null=True)
+    etag = models.CharField(max_length=100, blank=True)
+    
+    class Meta:
+        indexes = [
+            # Range scans over expiry in cleanup_expired_tokens
+            models.Index(fields=['expires_at'], name='downloadtoken_expires_idx'),
+            # Active (unused) tokens of a user for a file
+            models.Index(
+                fields=['user', 'file', 'expires_at'],
+                name='downloadtoken_active_idx',
+                condition=models.Q(is_used=False),
+            ),
+            # Used tokens purged by cleanup_expired_tokens
+            models.Index(
+                fields=['used_at'],
+                name='downloadtoken_used_idx',
+                condition=models.Q(is_used=True),
+            ),
+        ]
     
     def is_expired(self):
         return timezone.now() > self.expires_at
     
+    def claim(self, etag):
+        """Atomically mark the token used for a transfer of the given file version"""
+        now = timezone.now()
+        claimed = DownloadToken.objects.filter(pk=self.pk, is_used=False).update(
+            is_used=True, used_at=now, etag=etag
+        )
+        if claimed:
+            self.is_used, self.used_at, self.etag = True, now, etag
+        else:
+            self.refresh_from_db(fields=['is_used', 'used_at', 'etag'])
+        return bool(claimed)
+    
+    def can_resume(self, etag):
+        """Whether a used token may serve further ranges of the same transfer"""
+        # Only for DOWNLOAD_RESUME_WINDOW seconds after the first request, so a used
+        # link cannot be replayed for as long as it has not expired
+        return (
+            self.is_used and self.etag == etag and self.used_at is not None
+            and timezone.now() <= self.used_at + timedelta(seconds=settings.DOWNLOAD_RESUME_WINDOW)
+        )
+    
+    async def aclaim(self, etag):
+        """Async version of claim"""
+        now = timezone.now()
+        claimed = await DownloadToken.objects.filter(pk=self.pk, is_used=False).aupdate(
+            is_used=True, used_at=now, etag=etag
+        )
+        if claimed:
+            self.is_used, self.used_at, self.etag = True, now, etag
+        else:
+            await self.arefresh_from_db(fields=['is_used', 'used_at', 'etag'])
+        return bool(claimed)
+    
+    async def acan_resume(self, etag):
+        return self.can_resume(etag)
+    
     def __str__(self):
         return f"Token for {self.file.original_filename}"
+
+class BatchDownloadToken(models.Model):
+    # One link for a set of files, delivered as a single streamed ZIP archive
+    token = models.CharField(max_length=100, unique=True)
+    files = models.ManyToManyField(UploadedFile, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    is_used = models.BooleanField(default=False)
+    used_at = models.DateTimeField(blank=True, null=True)
+    
+    def is_expired(self):
+        return timezone.now() > self.expires_at
+    
+    def claim(self):
+        """Atomically mark the token used; archives are not resumable, so only the first request succeeds"""
+        now = timezone.now()
+        claimed = BatchDownloadToken.objects.filter(pk=self.pk, is_used=False).update(is_used=True, used_at=now)
+        if claimed:
+            self.is_used, self.used_at = True, now
+        return bool(claimed)
+    
+    async def aclaim(self):
+        """Async version of claim"""
+        now = timezone.now()
+        claimed = await BatchDownloadToken.objects.filter(pk=self.pk, is_used=False).aupdate(is_used=True, used_at=now)
+        if claimed:
+            self.is_used, self.used_at = True, now
+        return bool(claimed)
+    
+    def __str__(self):
+        return f"Batch token for {self.user.username}"
+
+class UploadSession(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    file_size = models.BigIntegerField()
+    chunk_size = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    uploaded_file = models.OneToOneField(UploadedFile, on_delete=models.SET_NULL, blank=True, null=True)
+    
+    class Meta:
+        indexes = [
+            # Expired sessions removed by cleanup_expired_tokens
+            models.Index(fields=['expires_at'], name='uploadsession_expires_idx'),
+        ]
+    
+    @property
+    def total_chunks(self):
+        return max(1, -(-self.file_size // self.chunk_size))
+    
+    @property
+    def chunk_dir(self):
+        return os.path.join(settings.MEDIA_ROOT, settings.CHUNKED_UPLOAD_DIR, str(self.id))
+    
+    def chunk_path(self, index):
+        return os.path.join(self.chunk_dir, f'{index:06d}')
+    
+    def chunk_length(self, index):
+        """Expected size in bytes of the chunk at index"""
+        if index == self.total_chunks - 1:
+            return self.file_size - index * self.chunk_size
+        return self.chunk_size
+    
+    def received_chunks(self):
+        """Indexes of chunks that have been fully written"""
+        try:
+            names = os.listdir(self.chunk_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name) for name in names if name.isdigit())
+    
+    def is_expired(self):
+        return timezone.now() > self.expires_at
+    
+    def __str__(self):
+        return f"Upload of {self.filename} by {self.user.username}"
+
+class OutboundEmail(models.Model):
+    STATUSES = (
+        ('queued', 'Queued'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    )
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255, blank=True)
+    to = models.JSONField(default=list)
+    status = models.CharField(max_length=10, choices=STATUSES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        indexes = [
+            # Due messages picked up by send_queued_mail
+            models.Index(
+                fields=['next_attempt_at'],
+                name='outboundemail_due_idx',
+                condition=models.Q(status='queued'),
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.to)}"
+
+class ProcessingJob(models.Model):
+    # Stages run in this order; a retried job resumes at the stage that failed
+    STAGES = (
+        ('checksum', 'Checksum'),
+        ('validate', 'Validate'),
+        ('metadata', 'Metadata'),
+    )
+    STATUSES = (
+        ('queued', 'Queued'),
+        ('failed', 'Failed'),
+    )
+    file = models.ForeignKey(UploadedFile, on_delete=models.CASCADE, related_name='processing_jobs')
+    stage = models.CharField(max_length=20, choices=STAGES, default='checksum')
+    status = models.CharField(max_length=10, choices=STATUSES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        indexes = [
+            # Due jobs picked up by process_uploads
+            models.Index(
+                fields=['next_attempt_at'],
+                name='processingjob_due_idx',
+                condition=models.Q(status='queued'),
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.stage} job for {self.file_id}"
@@ -0,0 +1,60 @@
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+import base64
+import uuid
+
+
+class InvalidCursor(Exception):
+    """Raised when a pagination cursor cannot be decoded"""
+
+
+def encode_cursor(uploaded_file):
+    """Encode the (uploaded_at, id) position of a row as an opaque cursor"""
+    position = f'{uploaded_file.uploaded_at.isoformat()}|{uploaded_file.id}'
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor back into an (uploaded_at, id) position"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        uploaded_at, file_id = base64.urlsafe_b64decode(padded).decode().split('|')
+        uploaded_at = parse_datetime(uploaded_at)
+        if uploaded_at is None:
+            raise ValueError(cursor)
+        return uploaded_at, uuid.UUID(file_id)
+    except ValueError as e:
+        raise InvalidCursor(str(e)) from e
+
+
+def paginate_keyset(queryset, cursor, limit):
+    """Return one page of newest-first rows after cursor and the cursor of the next page"""
+    queryset = queryset.order_by('-uploaded_at', '-id')
+    if cursor:
+        uploaded_at, file_id = decode_cursor(cursor)
+        # The redundant upper bound lets the planner range-scan the index
+        queryset = queryset.filter(uploaded_at__lte=uploaded_at).filter(
+            Q(uploaded_at__lt=uploaded_at) | Q(id__lt=file_id)
+        )
+
+    # Fetch one extra row to learn whether another page exists without a COUNT
+    rows = list(queryset[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def approximate_count(queryset, filtered):
+    """Estimate the row count from planner statistics, counting exactly when that is not possible"""
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql' and not filtered:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                [queryset.model._meta.db_table]
+            )
+            row = cursor.fetchone()
+        # reltuples is -1 until the table has been analyzed
+        if row and row[0] >= 0:
+            return row[0]
+    return queryset.count()
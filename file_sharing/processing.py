@@ -0,0 +1,317 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+from datetime import timedelta
+from xml.etree import ElementTree
+import hashlib
+import posixpath
+import shutil
+import tempfile
+import zipfile
+
+from .compression import open_original, stored_blob
+from .models import ProcessingJob, UploadedFile
+
+# Content type of the main part of each Office Open XML package, by extension
+MAIN_CONTENT_TYPES = {
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml',
+    'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation.main+xml',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml',
+}
+
+NAMESPACES = {
+    'ct': 'http://schemas.openxmlformats.org/package/2006/content-types',
+    'cp': 'http://schemas.openxmlformats.org/package/2006/metadata/core-properties',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'dcterms': 'http://purl.org/dc/terms/',
+    'ep': 'http://schemas.openxmlformats.org/officeDocument/2006/extended-properties',
+    'p': 'http://schemas.openxmlformats.org/presentationml/2006/main',
+    's': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main',
+}
+
+# metadata key: element path of the document properties worth keeping, in docProps/core.xml
+CORE_PROPERTIES = {
+    'title': 'dc:title',
+    'creator': 'dc:creator',
+    'last_modified_by': 'cp:lastModifiedBy',
+    'created': 'dcterms:created',
+    'modified': 'dcterms:modified',
+}
+# and in docProps/app.xml with their type
+APP_PROPERTIES = {
+    'application': ('ep:Application', str),
+    'pages': ('ep:Pages', int),
+    'words': ('ep:Words', int),
+    'slides': ('ep:Slides', int),
+}
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ProcessingError(Exception):
+    """A file that can never pass processing, as opposed to a failure worth retrying"""
+
+
+def open_package(uploaded_file):
+    """Open the original bytes of an uploaded file as a seekable file for zipfile"""
+    name, encoding = stored_blob(uploaded_file)
+    if encoding is None:
+        return uploaded_file.file.storage.open(name, 'rb')
+    # Seeking backwards in a decompressed stream means decompressing again from the start
+    spooled = tempfile.TemporaryFile()
+    with open_original(uploaded_file) as f:
+        shutil.copyfileobj(f, spooled, HASH_CHUNK_SIZE)
+    spooled.seek(0)
+    return spooled
+
+
+def check_checksum(uploaded_file, package):
+    """Hash the stored bytes and check them against the recorded SHA-256"""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open_original(uploaded_file) as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha256.update(chunk)
+            size += len(chunk)
+    digest = sha256.hexdigest()
+    if uploaded_file.sha256 and digest != uploaded_file.sha256:
+        raise ProcessingError('Stored content does not match its checksum')
+    if size != uploaded_file.file_size:
+        raise ProcessingError(f'Stored content is {size} bytes, expected {uploaded_file.file_size}')
+    return {'sha256': digest}
+
+
+def read_part(package, name):
+    """Read a package part, refusing parts too large to parse in memory"""
+    info = package.getinfo(name)
+    if info.file_size > settings.PROCESSING_MAX_PART_SIZE:
+        raise ProcessingError(f'{name} is too large to parse')
+    try:
+        # The bundled expat refuses entity expansion attacks such as billion laughs
+        return ElementTree.fromstring(package.read(info))
+    except ElementTree.ParseError as e:
+        raise ProcessingError(f'{name} is not well-formed XML: {e}')
+
+
+def main_part(package, file_type):
+    """Name of the package's main part, located through [Content_Types].xml"""
+    if '[Content_Types].xml' not in package.NameToInfo:
+        raise ProcessingError('Not an Office Open XML package: [Content_Types].xml is missing')
+    content_types = read_part(package, '[Content_Types].xml')
+    for override in content_types.iterfind('ct:Override', NAMESPACES):
+        if override.get('ContentType') == MAIN_CONTENT_TYPES[file_type]:
+            name = override.get('PartName', '').lstrip('/')
+            if name not in package.NameToInfo:
+                raise ProcessingError(f'Main part {name} is missing')
+            return name
+    raise ProcessingError(f'Package is not a .{file_type} document')
+
+
+def check_structure(uploaded_file, package):
+    """Validate the zip container and the Office Open XML parts the extension promises"""
+    infos = package.infolist()
+    if len(infos) > settings.PROCESSING_MAX_ENTRIES:
+        raise ProcessingError(f'Package has more than {settings.PROCESSING_MAX_ENTRIES} entries')
+    # Declared sizes are checked before anything is inflated, so zip bombs cost nothing
+    if sum(info.file_size for info in infos) > settings.PROCESSING_MAX_UNCOMPRESSED_SIZE:
+        raise ProcessingError('Package expands beyond the allowed size')
+    for info in infos:
+        name = posixpath.normpath(info.filename)
+        if info.filename.startswith(('/', '\\')) or name == '..' or name.startswith('../'):
+            raise ProcessingError(f'Package entry {info.filename!r} escapes the package')
+    try:
+        bad = package.testzip()
+    except (zipfile.BadZipFile, EOFError, NotImplementedError) as e:
+        raise ProcessingError(f'Package is corrupt: {e}')
+    if bad is not None:
+        raise ProcessingError(f'Package entry {bad} is corrupt')
+    main_part(package, uploaded_file.file_type)
+    return {}
+
+
+def text(root, path):
+    element = root.find(path, NAMESPACES)
+    return element.text.strip() if element is not None and element.text else None
+
+
+def extract_metadata(uploaded_file, package):
+    """Collect document properties and page, slide or sheet counts"""
+    metadata = {}
+    if 'docProps/core.xml' in package.NameToInfo:
+        core = read_part(package, 'docProps/core.xml')
+        for key, path in CORE_PROPERTIES.items():
+            value = text(core, path)
+            if value:
+                metadata[key] = value
+    if 'docProps/app.xml' in package.NameToInfo:
+        app = read_part(package, 'docProps/app.xml')
+        for key, (path, cast) in APP_PROPERTIES.items():
+            value = text(app, path)
+            try:
+                if value:
+                    metadata[key] = cast(value)
+            except ValueError:
+                continue
+
+    # Counts from the main part are authoritative; app.xml is whatever the editor last wrote.
+    # A document's main part holds all of its text, so only the small workbook and
+    # presentation parts are parsed
+    if uploaded_file.file_type == 'xlsx':
+        main = read_part(package, main_part(package, 'xlsx'))
+        metadata['sheets'] = len(main.findall('s:sheets/s:sheet', NAMESPACES))
+    elif uploaded_file.file_type == 'pptx':
+        main = read_part(package, main_part(package, 'pptx'))
+        metadata['slides'] = len(main.findall('p:sldIdLst/p:sldId', NAMESPACES))
+    return {'metadata': metadata}
+
+
+# Stage name: function returning UploadedFile fields to update, in the order they run
+STAGES = {
+    'checksum': check_checksum,
+    'validate': check_structure,
+    'metadata': extract_metadata,
+}
+
+
+def enqueue_processing(uploaded_file):
+    """Queue the processing stages for a new upload, or reuse the results for content seen before"""
+    previous = (
+        UploadedFile.objects
+        .filter(sha256=uploaded_file.sha256, file_type=uploaded_file.file_type, processing_status='ready')
+        .exclude(pk=uploaded_file.pk).exclude(sha256='')
+        .only('metadata').first()
+    )
+    if previous is not None:
+        # Identical bytes with the same extension pass or fail identically
+        UploadedFile.objects.filter(pk=uploaded_file.pk).update(
+            processing_status='ready', metadata=previous.metadata, processed_at=timezone.now()
+        )
+        uploaded_file.processing_status = 'ready'
+        uploaded_file.metadata = previous.metadata
+        return None
+    return ProcessingJob.objects.create(file=uploaded_file)
+
+
+def retry_delay(attempts):
+    """Seconds to wait before the next attempt after the given number of failures"""
+    return settings.PROCESSING_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+def claim_jobs(batch_size):
+    """Lease up to batch_size due jobs so concurrent workers skip them"""
+    now = timezone.now()
+    with transaction.atomic():
+        due = (
+            ProcessingJob.objects
+            .select_for_update(skip_locked=True)
+            .filter(status='queued', next_attempt_at__lte=now)
+            .order_by('next_attempt_at')
+        )
+        jobs = list(due[:batch_size])
+        # A worker that dies mid-batch releases its jobs once the lease runs out
+        ProcessingJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            next_attempt_at=now + timedelta(seconds=settings.PROCESSING_LEASE_SECONDS)
+        )
+    return jobs
+
+
+def fail_file(uploaded_file, error):
+    UploadedFile.objects.filter(pk=uploaded_file.pk).update(
+        processing_status='failed', processing_error=error, processed_at=timezone.now()
+    )
+
+
+def run_job(job):
+    """Run the remaining stages of one job and return 'processed', 'retried' or 'failed'"""
+    uploaded_file = job.file
+    stages = list(STAGES)
+    job.attempts += 1
+    try:
+        with ExitStack() as stack:
+            package = None
+            for stage in stages[stages.index(job.stage):]:
+                job.stage = stage
+                if stage != 'checksum' and package is None:
+                    source = stack.enter_context(open_package(uploaded_file))
+                    try:
+                        package = stack.enter_context(zipfile.ZipFile(source))
+                    except zipfile.BadZipFile:
+                        raise ProcessingError('Not a zip package')
+                updates = STAGES[stage](uploaded_file, package)
+                for field, value in updates.items():
+                    setattr(uploaded_file, field, value)
+    except ProcessingError as e:
+        fail_file(uploaded_file, str(e))
+        job.delete()
+        return 'failed'
+    except Exception as e:
+        job.last_error = f'{type(e).__name__}: {e}'
+        if job.attempts >= settings.PROCESSING_MAX_ATTEMPTS:
+            fail_file(uploaded_file, f'Processing failed at the {job.stage} stage')
+            job.status = 'failed'
+            result = 'failed'
+        else:
+            job.next_attempt_at = timezone.now() + timedelta(seconds=retry_delay(job.attempts))
+            result = 'retried'
+        job.save(update_fields=['stage', 'status', 'attempts', 'last_error', 'next_attempt_at'])
+        return result
+
+    with transaction.atomic():
+        UploadedFile.objects.filter(pk=uploaded_file.pk).update(
+            sha256=uploaded_file.sha256, metadata=uploaded_file.metadata, processing_status='ready',
+            processing_error='', processed_at=timezone.now()
+        )
+        job.delete()
+    return 'processed'
+
+
+def run_job_in_thread(job):
+    try:
+        return run_job(job)
+    finally:
+        # Each pool thread has its own connection, which would otherwise leak
+        connection.close()
+
+
+def process_pending(batch_size=None, workers=None):
+    """Run one batch of due jobs over a pool of threads and return counts"""
+    jobs = claim_jobs(batch_size or settings.PROCESSING_BATCH_SIZE)
+    stats = {'processed': 0, 'retried': 0, 'failed': 0}
+    if not jobs:
+        return stats
+
+    # Fetch the files in one query instead of once per job
+    files = UploadedFile.objects.in_bulk([job.file_id for job in jobs])
+    # A file deleted since its job was claimed took the job with it
+    jobs = [job for job in jobs if job.file_id in files]
+    for job in jobs:
+        job.file = files[job.file_id]
+
+    workers = workers or settings.PROCESSING_WORKERS
+    if workers == 1:
+        results = [run_job(job) for job in jobs]
+    else:
+        # Hashing and inflating release the GIL, so threads overlap on multiple cores
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run_job_in_thread, jobs))
+    for result in results:
+        stats[result] += 1
+    return stats
+
+
+def queue_stats():
+    """Job queue depth by status plus the number of due jobs and the oldest one's age"""
+    now = timezone.now()
+    stats = ProcessingJob.objects.aggregate(
+        queued=Count('pk', filter=Q(status='queued')),
+        due=Count('pk', filter=Q(status='queued', next_attempt_at__lte=now)),
+        failed=Count('pk', filter=Q(status='failed')),
+        oldest=Min('created_at', filter=Q(status='queued')),
+    )
+    oldest = stats.pop('oldest')
+    stats['oldest_age_seconds'] = (now - oldest).total_seconds() if oldest else 0
+    stats['pending_files'] = UploadedFile.objects.filter(processing_status='pending').count()
+    return stats
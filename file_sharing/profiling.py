@@ -0,0 +1,166 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import re
+import shutil
+import time
+import uuid
+
+PROFILE_STATS = 'profile.prof'
+PROFILE_META = 'request.json'
+
+# Literals that differ between otherwise identical queries
+SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+# URL parameters that grant access and are replaced by their name in saved paths
+REDACTED_KWARGS = {'token'}
+
+
+class QueryRecorder:
+    """Database execute wrapper keeping the SQL and duration of every query"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({'sql': sql, 'params': param_types(params, many), 'ms': (time.perf_counter() - start) * 1000})
+
+
+def param_types(params, many):
+    """Types of query parameters; their values include password hashes, emails and token hashes"""
+    if many:
+        return f'{len(params)} rows' if hasattr(params, '__len__') else 'rows'
+    if isinstance(params, dict):
+        return {key: type(value).__name__ for key, value in params.items()}
+    return [type(value).__name__ for value in params or ()]
+
+
+def redacted_path(request):
+    """Request path without its query string and with token segments replaced by their name"""
+    path = request.path
+    match = request.resolver_match
+    for key, value in (match.kwargs.items() if match else ()):
+        if key in REDACTED_KWARGS:
+            path = path.replace(str(value), f'<{key}>')
+    return path
+
+
+def profiles_dir():
+    """Create PROFILING_DIR readable by this user only, refusing one somebody else created"""
+    os.makedirs(settings.PROFILING_DIR, mode=0o700, exist_ok=True)
+    if os.stat(settings.PROFILING_DIR).st_uid != os.getuid():
+        raise ImproperlyConfigured(f'PROFILING_DIR {settings.PROFILING_DIR} is owned by another user')
+    os.chmod(settings.PROFILING_DIR, 0o700)
+    return settings.PROFILING_DIR
+
+
+def normalize_sql(sql):
+    return SQL_LITERALS.sub('?', sql)
+
+
+def duplicate_queries(queries):
+    """Query shapes run more than once, most repeated first; a sign of N+1 lookups"""
+    counts = {}
+    for query in queries:
+        shape = normalize_sql(query['sql'])
+        count, ms = counts.get(shape, (0, 0.0))
+        counts[shape] = (count + 1, ms + query['ms'])
+    return sorted(
+        ({'sql': shape, 'count': count, 'ms': ms} for shape, (count, ms) in counts.items() if count > 1),
+        key=lambda duplicate: -duplicate['count'],
+    )
+
+
+class RequestProfile:
+    """cProfile stats and SQL queries captured for one request"""
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.recorder = QueryRecorder()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+        self.ms = (time.perf_counter() - self.start) * 1000
+
+    def save(self, request, response):
+        """Write the profile to PROFILING_DIR, drop the oldest beyond PROFILING_MAX_PROFILES and return its id"""
+        now = timezone.now()
+        match = request.resolver_match
+        profile_id = f'{now:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}'
+        path = os.path.join(profiles_dir(), profile_id)
+        os.makedirs(path, mode=0o700)
+
+        self.profiler.dump_stats(os.path.join(path, PROFILE_STATS))
+        os.chmod(os.path.join(path, PROFILE_STATS), 0o600)
+        meta = {
+            'id': profile_id,
+            'created_at': now.isoformat(),
+            'method': request.method,
+            'path': redacted_path(request),
+            'view': (match.url_name or match.view_name) if match else None,
+            'status': response.status_code,
+            'ms': self.ms,
+            'queries': self.recorder.queries,
+            'duplicates': duplicate_queries(self.recorder.queries),
+        }
+        fd = os.open(os.path.join(path, PROFILE_META), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with open(fd, 'w') as f:
+            json.dump(meta, f)
+
+        rotate_profiles()
+        return profile_id
+
+
+def should_profile(request):
+    """Whether to profile a request: asked for with the header, or picked by the sample rate"""
+    header = request.headers.get(settings.PROFILING_HEADER)
+    if header is not None:
+        # Without a secret anyone could make the server profile their requests
+        return bool(settings.PROFILING_SECRET) and hmac.compare_digest(header, settings.PROFILING_SECRET)
+    rate = settings.PROFILING_SAMPLE_RATE
+    return rate > 0 and int.from_bytes(os.urandom(4), 'big') < rate * 2 ** 32
+
+
+def list_profiles():
+    """Ids of stored profiles, oldest first"""
+    try:
+        return sorted(
+            name for name in os.listdir(settings.PROFILING_DIR)
+            if os.path.isfile(os.path.join(settings.PROFILING_DIR, name, PROFILE_META))
+        )
+    except FileNotFoundError:
+        return []
+
+
+def rotate_profiles():
+    profiles = list_profiles()
+    for profile_id in profiles[:max(0, len(profiles) - settings.PROFILING_MAX_PROFILES)]:
+        shutil.rmtree(os.path.join(settings.PROFILING_DIR, profile_id), ignore_errors=True)
+
+
+def load_profile(profile_id):
+    """Return the metadata of a stored profile"""
+    with open(os.path.join(settings.PROFILING_DIR, profile_id, PROFILE_META)) as f:
+        return json.load(f)
+
+
+def top_functions(profile_id, limit=20, sort='cumulative'):
+    """Render the top functions of a stored profile as pstats prints them"""
+    out = io.StringIO()
+    stats = pstats.Stats(os.path.join(settings.PROFILING_DIR, profile_id, PROFILE_STATS), stream=out)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
@@ -0,0 +1,153 @@
+from django.db import connections, transaction
+from django.db.models import FloatField, IntegerField, Q, Value
+from django.db.models.expressions import RawSQL
+import re
+
+FTS_TABLE = 'file_sharing_uploadedfile_fts'
+TERM_RE = re.compile(r'\w+')
+# The trigram tokenizer only matches terms of at least three characters
+MIN_MATCH_LENGTH = 3
+# Triggers keeping the FTS5 table in sync. They would break Django's table rebuilds for
+# schema changes (the username trigger names file_sharing_uploadedfile, which a rebuild
+# renames), and a rebuild renumbers the rowids the index is keyed on, so they are dropped
+# before migrations that touch this app and recreated, with the index refilled, after
+SQLITE_TRIGGERS = {
+    f'{FTS_TABLE}_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON file_sharing_uploadedfile BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, original_filename, username)
+            SELECT NEW.rowid, NEW.original_filename, username FROM file_sharing_user WHERE id = NEW.uploaded_by_id;
+        END
+    """,
+    f'{FTS_TABLE}_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON file_sharing_uploadedfile BEGIN
+            DELETE FROM {FTS_TABLE} WHERE rowid = OLD.rowid;
+        END
+    """,
+    f'{FTS_TABLE}_update': f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF original_filename, uploaded_by_id
+        ON file_sharing_uploadedfile BEGIN
+            UPDATE {FTS_TABLE} SET
+                original_filename = NEW.original_filename,
+                username = (SELECT username FROM file_sharing_user WHERE id = NEW.uploaded_by_id)
+            WHERE rowid = NEW.rowid;
+        END
+    """,
+    f'{FTS_TABLE}_username': f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_username AFTER UPDATE OF username ON file_sharing_user BEGIN
+            UPDATE {FTS_TABLE} SET username = NEW.username
+            WHERE rowid IN (SELECT rowid FROM file_sharing_uploadedfile WHERE uploaded_by_id = NEW.id);
+        END
+    """,
+}
+
+
+def search_terms(query):
+    """Split a search query into lowercase word terms"""
+    return TERM_RE.findall(query.lower())
+
+
+def search_files(queryset, query, rank=False):
+    """Filter files whose name or uploader contains every term of query, ignoring case
+
+    With rank=True each file is annotated with a search_rank, higher meaning
+    more relevant.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return queryset.none()
+
+    vendor = connections[queryset.db].vendor
+    if vendor == 'sqlite':
+        return _sqlite_search(queryset, terms, rank)
+    if vendor == 'postgresql':
+        return _postgresql_search(queryset, query, terms, rank)
+    return _substring_search(queryset, terms, rank)
+
+
+def _sqlite_search(queryset, terms, rank):
+    # The FTS5 table shares rowids with file_sharing_uploadedfile and is kept
+    # in sync by triggers (see migration 0006); its trigram tokenizer (0016)
+    # matches substrings like icontains does on the other backends
+    table = queryset.model._meta.db_table
+    long_terms = [term for term in terms if len(term) >= MIN_MATCH_LENGTH]
+    match = ' '.join(f'"{term}"' for term in long_terms)
+    conditions = [f'{FTS_TABLE} MATCH %s'] if long_terms else []
+    params = [match] if long_terms else []
+    for term in terms:
+        if len(term) < MIN_MATCH_LENGTH:
+            # Shorter terms are checked with LIKE over the index table instead
+            pattern = '%' + term.replace('_', '\\_') + '%'
+            conditions.append("(original_filename LIKE %s ESCAPE '\\' OR username LIKE %s ESCAPE '\\')")
+            params += [pattern, pattern]
+
+    queryset = queryset.alias(
+        fts_rowid=RawSQL(f'{table}.rowid', [], output_field=IntegerField())
+    ).filter(
+        fts_rowid__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {" AND ".join(conditions)}', params)
+    )
+    if rank:
+        if long_terms:
+            # Evaluated only for the matched rows; FTS5 seeks to each rowid rather than
+            # rerunning the whole query. FTS5 rank is lower for better matches.
+            search_rank = RawSQL(
+                f'SELECT -rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid = {table}.rowid',
+                [match], output_field=FloatField(),
+            )
+        else:
+            search_rank = Value(0.0, output_field=FloatField())
+        queryset = queryset.annotate(search_rank=search_rank)
+    return queryset
+
+
+def _postgresql_search(queryset, query, terms, rank):
+    # UPPER(...) LIKE '%term%' is served by the gin_trgm_ops indexes from migration 0006
+    queryset = _substring_search(queryset, terms, rank=False)
+    if rank:
+        from django.contrib.postgres.search import TrigramWordSimilarity
+
+        queryset = queryset.annotate(search_rank=TrigramWordSimilarity(query, 'original_filename'))
+    return queryset
+
+
+def _substring_search(queryset, terms, rank):
+    condition = Q()
+    for term in terms:
+        condition &= Q(original_filename__icontains=term) | Q(uploaded_by__username__icontains=term)
+    queryset = queryset.filter(condition)
+    if rank:
+        queryset = queryset.annotate(search_rank=Value(0.0, output_field=FloatField()))
+    return queryset
+
+
+def drop_sqlite_triggers(connection):
+    """Drop the search index triggers so migrations can rebuild the tables they are on"""
+    with connection.cursor() as cursor:
+        for name in SQLITE_TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+
+def restore_sqlite_index(connection):
+    """Recreate missing search index triggers and refill the index; return whether anything was missing"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')")
+        existing = {name for name, in cursor.fetchall()}
+        # Nothing to restore before migration 0006 or after unapplying it
+        if FTS_TABLE not in existing:
+            return False
+        missing = [name for name in SQLITE_TRIGGERS if name not in existing]
+        if not missing:
+            return False
+        with transaction.atomic(using=connection.alias):
+            for name in missing:
+                cursor.execute(SQLITE_TRIGGERS[name])
+            # Rows written while the triggers were gone and rowids renumbered by a rebuild
+            # are only fixed by indexing everything again
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            cursor.execute(
+                f"""
+                INSERT INTO {FTS_TABLE}(rowid, original_filename, username)
+                SELECT f.rowid, f.original_filename, u.username
+                FROM file_sharing_uploadedfile f JOIN file_sharing_user u ON u.id = f.uploaded_by_id
+                """
+            )
+    return True
@@ -1,8 +1,15 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth import authenticate
-from .models import User, UploadedFile
+from .models import User, UploadedFile, UploadSession
 import re
 
+ALLOWED_EXTENSIONS = ['.pptx', '.docx', '.xlsx']
+ALLOWED_EXTENSIONS_MESSAGE = 'Only .pptx, .docx, and .xlsx files are allowed'
+
+def has_allowed_extension(filename):
+    return f".{filename.lower().split('.')[-1]}" in ALLOWED_EXTENSIONS
+
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, min_length=8)
     confirm_password = serializers.CharField(write_only=True)
@@ -61,23 +68,81 @@ class FileUploadSerializer(serializers.ModelSerializer):
         fields = ['file']
     
     def validate_file(self, value):
-        allowed_extensions = ['.pptx', '.docx', '.xlsx']
-        file_extension = value.name.lower().split('.')[-1]
+        if not has_allowed_extension(value.name):
+            raise serializers.ValidationError(ALLOWED_EXTENSIONS_MESSAGE)
         
-        if f'.{file_extension}' not in allowed_extensions:
-            raise serializers.ValidationError(
-                'Only .pptx, .docx, and .xlsx files are allowed'
-            )
-        
-        # Check file size (10MB limit)
-        if value.size > 10 * 1024 * 1024:
-            raise serializers.ValidationError('File size cannot exceed 10MB')
+        if value.size > settings.UPLOAD_MAX_FILE_SIZE:
+            raise serializers.ValidationError(f'File size cannot exceed {settings.UPLOAD_MAX_FILE_SIZE} bytes')
         
         return value
 
 class UploadedFileSerializer(serializers.ModelSerializer):
     uploaded_by = serializers.StringRelatedField()
     
+    # Model columns needed to render each field, used to narrow queries with only()
+    COLUMNS = {
+        'id': ['id'],
+        'original_filename': ['original_filename'],
+        'uploaded_by': ['uploaded_by__username', 'uploaded_by__user_type'],
+        'uploaded_at': ['uploaded_at'],
+        'file_size': ['file_size'],
+        'file_type': ['file_type'],
+        'processing_status': ['processing_status'],
+    }
+    
     class Meta:
         model = UploadedFile
-        fields = ['id', 'original_filename', 'uploaded_by', 'uploaded_at', 'file_size', 'file_type']
+        fields = ['id', 'original_filename', 'uploaded_by', 'uploaded_at', 'file_size', 'file_type', 'processing_status']
+    
+    def __init__(self, *args, **kwargs):
+        # Optional subset of fields to render
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+    
+    @classmethod
+    def columns_for(cls, fields):
+        return [column for field in fields for column in cls.COLUMNS[field]]
+
+class BatchDownloadSerializer(serializers.Serializer):
+    file_ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False)
+    
+    def validate_file_ids(self, value):
+        # Keep the first occurrence of each id
+        value = list(dict.fromkeys(value))
+        if len(value) > settings.BATCH_DOWNLOAD_MAX_FILES:
+            raise serializers.ValidationError(
+                f'At most {settings.BATCH_DOWNLOAD_MAX_FILES} files can be downloaded at once'
+            )
+        return value
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    chunk_size = serializers.IntegerField(required=False)
+    
+    class Meta:
+        model = UploadSession
+        fields = ['filename', 'file_size', 'chunk_size']
+    
+    def validate_filename(self, value):
+        if not has_allowed_extension(value):
+            raise serializers.ValidationError(ALLOWED_EXTENSIONS_MESSAGE)
+        return value
+    
+    def validate_file_size(self, value):
+        if value <= 0:
+            raise serializers.ValidationError('File size must be positive')
+        if value > settings.CHUNKED_UPLOAD_MAX_FILE_SIZE:
+            raise serializers.ValidationError(
+                f'File size cannot exceed {settings.CHUNKED_UPLOAD_MAX_FILE_SIZE} bytes'
+            )
+        return value
+    
+    def validate_chunk_size(self, value):
+        if not settings.CHUNKED_UPLOAD_MIN_CHUNK_SIZE <= value <= settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE:
+            raise serializers.ValidationError(
+                f'Chunk size must be between {settings.CHUNKED_UPLOAD_MIN_CHUNK_SIZE} '
+                f'and {settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE} bytes'
+            )
+        return value
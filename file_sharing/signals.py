@@ -0,0 +1,64 @@
+from django.db import connections, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_migrate
+from django.dispatch import receiver
+
+from .authentication import token_cache
+from .compression import SUFFIXES, variant_name
+from .models import AuthToken, BlobLock, UploadedFile, User
+from .search import drop_sqlite_triggers, restore_sqlite_index
+
+
+@receiver(post_delete, sender=UploadedFile)
+def delete_unreferenced_blob(sender, instance, **kwargs):
+    """Remove a stored file once no UploadedFile row references it any more"""
+    name = instance.file.name
+    if not name:
+        return
+
+    def delete_if_unreferenced():
+        if instance.sha256:
+            references = UploadedFile.objects.filter(sha256=instance.sha256)
+        else:
+            references = UploadedFile.objects.filter(file=name)
+        # Uploads of the same content lock the blob too, so one either commits its row
+        # before the check below or saves the blob again after it is deleted
+        with transaction.atomic():
+            BlobLock.acquire(name)
+            if not references.exists():
+                instance.file.storage.delete(name)
+                for encoding in SUFFIXES:
+                    instance.file.storage.delete(variant_name(name, encoding))
+                # Held until commit, so a waiting upload recreates the row and saves the blob again
+                BlobLock.objects.filter(name=name).delete()
+
+    transaction.on_commit(delete_if_unreferenced)
+
+
+@receiver(post_delete, sender=AuthToken)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key_hash)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, created, **kwargs):
+    """Drop cached authentications of a user whenever the user changes, e.g. is deactivated"""
+    if created:
+        return
+    for key_hash in AuthToken.objects.filter(user_id=instance.pk).values_list('key_hash', flat=True):
+        token_cache.invalidate(key_hash)
+
+
+@receiver(pre_migrate)
+def drop_search_triggers(sender, using, plan=None, **kwargs):
+    """Let this app's migrations rebuild tables without the SQLite search triggers in the way"""
+    if sender.name != 'file_sharing' or connections[using].vendor != 'sqlite':
+        return
+    if any(migration.app_label == sender.label for migration, _ in plan or []):
+        drop_sqlite_triggers(connections[using])
+
+
+@receiver(post_migrate)
+def restore_search_index(sender, using, **kwargs):
+    """Recreate the SQLite search triggers and refill the index after they were dropped"""
+    if sender.name == 'file_sharing' and connections[using].vendor == 'sqlite':
+        restore_sqlite_index(connections[using])
@@ -0,0 +1,167 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.utils.http import content_disposition_header
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import uuid
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    # Optional; only needed for FILE_STORAGE_BACKEND=s3
+    boto3 = None
+
+BLOB_DIR = 'blobs'
+BLOB_NAME_RE = re.compile(rf'^{BLOB_DIR}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/([0-9a-f]{{64}})$')
+STORAGE_BACKENDS = ['local', 's3']
+# Objects read back from S3 are spooled to disk beyond this size
+S3_SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def blob_name(digest):
+    """Storage name of the blob with the given SHA-256 hex digest"""
+    return f'{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}'
+
+
+def blob_digest(name):
+    """SHA-256 hex digest encoded in a blob name, or None for other names"""
+    match = BLOB_NAME_RE.match(name or '')
+    return match.group(1) if match else None
+
+
+def content_digest(content):
+    """Compute the SHA-256 hex digest of a file by streaming its chunks"""
+    sha256 = hashlib.sha256()
+    for chunk in content.chunks():
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def is_local(storage):
+    """Whether a storage keeps files on the local filesystem, where they can be opened by path"""
+    return isinstance(storage, FileSystemStorage)
+
+
+async def aexists(storage, name):
+    """Check a storage name from async code; only remote storage needs the thread pool"""
+    if is_local(storage):
+        return storage.exists(name)
+    return await sync_to_async(storage.exists, thread_sensitive=False)(name)
+
+
+class ContentAddressedMixin:
+    """Storage that keeps each distinct file content once under its SHA-256, two directory levels deep"""
+
+    def save(self, name, content, max_length=None):
+        # The requested name is ignored: files are addressed by their content
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        # Streamed uploads were hashed as they arrived
+        name = blob_name(getattr(content, 'sha256', None) or content_digest(content))
+
+        if not self.exists(name):
+            self.store_blob(name, content)
+
+        return name
+
+
+class ContentAddressedStorage(ContentAddressedMixin, FileSystemStorage):
+    """Content addressed storage on the local filesystem under MEDIA_ROOT"""
+
+    def store_blob(self, name, content):
+        # Write under a unique temporary name and rename, so concurrent uploads
+        # of the same content never expose a partially written blob
+        tmp_name = self._save(f'{name}.{uuid.uuid4().hex}.tmp', content)
+        os.replace(self.path(tmp_name), self.path(name))
+
+
+class S3ContentAddressedStorage(ContentAddressedMixin, Storage):
+    """Content addressed storage in an S3 compatible bucket such as AWS S3 or MinIO"""
+
+    def __init__(self, bucket=None, prefix=None, endpoint_url=None, region=None, access_key=None,
+                 secret_key=None, url_expiry=None):
+        if boto3 is None:
+            raise ImproperlyConfigured('FILE_STORAGE_BACKEND=s3 requires the boto3 package')
+        self.bucket = bucket or settings.S3_BUCKET
+        if not self.bucket:
+            raise ImproperlyConfigured('FILE_STORAGE_BACKEND=s3 requires S3_BUCKET')
+        self.prefix = (prefix if prefix is not None else settings.S3_PREFIX).strip('/')
+        self.url_expiry = url_expiry or settings.S3_URL_EXPIRY
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url or settings.S3_ENDPOINT_URL or None,
+            region_name=region or settings.S3_REGION or None,
+            # Without explicit keys boto3 uses its usual credential chain
+            aws_access_key_id=access_key or settings.S3_ACCESS_KEY_ID or None,
+            aws_secret_access_key=secret_key or settings.S3_SECRET_ACCESS_KEY or None,
+        )
+
+    def key(self, name):
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+    def store_blob(self, name, content):
+        # Objects appear atomically once the (multipart) upload completes
+        content.seek(0)
+        self.client.upload_fileobj(content, self.bucket, self.key(name))
+
+    def _open(self, name, mode='rb'):
+        # zipfile and the processing stages need to seek, which a response body cannot
+        f = tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_SIZE)
+        self.client.download_fileobj(self.bucket, self.key(name), f)
+        f.seek(0)
+        return File(f, name)
+
+    def head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, name):
+        return self.head(name) is not None
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def size(self, name):
+        return self.head(name)['ContentLength']
+
+    def get_modified_time(self, name):
+        return self.head(name)['LastModified']
+
+    def url(self, name, filename=None):
+        """A presigned GET URL, served as an attachment named filename when given"""
+        params = {'Bucket': self.bucket, 'Key': self.key(name)}
+        if filename:
+            content_type, _ = mimetypes.guess_type(filename)
+            params['ResponseContentDisposition'] = content_disposition_header(True, filename)
+            params['ResponseContentType'] = content_type or 'application/octet-stream'
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.url_expiry)
+
+
+def configured_storage(backend=None):
+    """Build the storage for a backend name, FILE_STORAGE_BACKEND by default"""
+    backend = (backend or settings.FILE_STORAGE_BACKEND).lower()
+    if backend not in STORAGE_BACKENDS:
+        raise ImproperlyConfigured(
+            f'FILE_STORAGE_BACKEND must be one of {", ".join(STORAGE_BACKENDS)}, got {backend!r}'
+        )
+    if backend == 's3':
+        return S3ContentAddressedStorage()
+    return ContentAddressedStorage()
+
+
+file_storage = configured_storage()
+
+
+def get_file_storage():
+    return file_storage
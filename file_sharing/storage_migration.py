@@ -0,0 +1,143 @@
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
+import os
+import shutil
+import time
+import uuid
+
+from .compression import SUFFIXES, open_stored, variant_name
+from .models import BlobLock, UploadedFile
+from .storage import (
+    BLOB_DIR, ContentAddressedStorage, blob_digest, blob_name, configured_storage, content_digest, is_local
+)
+
+# Files written before content addressing live under uploads/<username>/<filename>;
+# resharding moves them to blobs/<aa>/<bb>/<sha256> under MEDIA_ROOT, and copying
+# uploads local blobs to a remote backend under the same names
+
+
+def find_stored(local, name):
+    """Locate the local bytes stored under a name and their encoding, (None, None) when missing"""
+    if local.exists(name):
+        return name, None
+    for encoding in SUFFIXES:
+        if local.exists(variant_name(name, encoding)):
+            return variant_name(name, encoding), encoding
+    return None, None
+
+
+def delete_stored(local, name):
+    """Delete a blob from local storage along with its compressed variants"""
+    for stored in [name] + [variant_name(name, encoding) for encoding in SUFFIXES]:
+        local.delete(stored)
+
+
+def reshard(local, name, keep_source=False):
+    """Move a file stored under a legacy name into the blob layout and return its blob name, None when missing"""
+    stored, encoding = find_stored(local, name)
+    if stored is None:
+        return None
+    with open_stored(local, stored, encoding) as f:
+        digest = content_digest(File(f))
+    new_name = blob_name(digest)
+
+    # Held like an upload, so a delete of the last row with this content cannot remove the blob in between
+    with transaction.atomic():
+        BlobLock.acquire(new_name)
+        if encoding is None:
+            with local.open(stored, 'rb') as content:
+                content.sha256 = digest
+                local.save(new_name, content)
+        else:
+            # A compressed legacy file keeps its variant; rows are switched with their encoding
+            variant = local.path(variant_name(new_name, encoding))
+            if not os.path.exists(variant):
+                os.makedirs(os.path.dirname(variant), exist_ok=True)
+                tmp_path = f'{variant}.{uuid.uuid4().hex}.tmp'
+                shutil.copyfile(local.path(stored), tmp_path)
+                os.replace(tmp_path, variant)
+
+        # The legacy file is removed only after every row points at the blob
+        UploadedFile.objects.filter(file=name).update(file=new_name, sha256=digest, stored_encoding=encoding or '')
+    if not keep_source and not UploadedFile.objects.filter(file=name).exists():
+        local.delete(stored)
+    return new_name
+
+
+def copy_blob(local, target, name, serving=False, keep_source=False):
+    """Upload a local blob to remote storage and return whether it was found anywhere"""
+    if not target.exists(name):
+        stored, encoding = find_stored(local, name)
+        if stored is None:
+            return False
+        # Remote storage holds the original bytes; compression is local only
+        with open_stored(local, stored, encoding) as f:
+            content = File(f, name)
+            content.sha256 = blob_digest(name)
+            target.save(name, content)
+
+    if serving:
+        UploadedFile.objects.filter(file=name).exclude(stored_encoding='').update(stored_encoding='')
+        if not keep_source:
+            delete_stored(local, name)
+    return True
+
+
+def migrate_batch(after='', batch_size=None, backend=None, keep_source=False):
+    """Migrate one batch of distinct storage names after a keyset position; return the last name (None when done) and counts"""
+    local = ContentAddressedStorage()
+    target = configured_storage(backend)
+    remote = not is_local(target)
+    # Copies to a backend that is not serving downloads yet leave the local files and rows alone
+    serving = remote and (backend or settings.FILE_STORAGE_BACKEND).lower() == settings.FILE_STORAGE_BACKEND.lower()
+
+    names = UploadedFile.objects.filter(file__gt=after)
+    if not remote:
+        names = names.filter(~Q(file__startswith=f'{BLOB_DIR}/'))
+    names = list(
+        names.order_by('file').values_list('file', flat=True).distinct()[:batch_size or settings.STORAGE_MIGRATION_BATCH_SIZE]
+    )
+
+    stats = {'resharded': 0, 'copied': 0, 'missing': 0}
+    for name in names:
+        if blob_digest(name) is None:
+            new_name = reshard(local, name, keep_source)
+            if new_name is None:
+                stats['missing'] += 1
+                continue
+            stats['resharded'] += 1
+            name = new_name
+        if remote:
+            if copy_blob(local, target, name, serving, keep_source):
+                stats['copied'] += 1
+            else:
+                stats['missing'] += 1
+    return (names[-1] if names else None), stats
+
+
+def migrate_storage(batch_size=None, sleep=None, backend=None, keep_source=False, progress=None):
+    """Run migrate_batch until every file is migrated, pausing between batches, and return totals"""
+    sleep = settings.STORAGE_MIGRATION_SLEEP if sleep is None else sleep
+    totals = {'resharded': 0, 'copied': 0, 'missing': 0}
+    after = ''
+    while True:
+        after, stats = migrate_batch(after, batch_size, backend, keep_source)
+        if after is None:
+            break
+        for key, value in stats.items():
+            totals[key] += value
+        if progress:
+            progress(after, stats)
+        time.sleep(sleep)
+    return totals
+
+
+def pending_counts(backend=None):
+    """Distinct storage names still to reshard, and blob names a remote backend may still need"""
+    names = UploadedFile.objects.order_by().values('file').distinct()
+    counts = {'legacy': names.filter(~Q(file__startswith=f'{BLOB_DIR}/')).count()}
+    if not is_local(configured_storage(backend)):
+        counts['blobs'] = names.filter(file__startswith=f'{BLOB_DIR}/').count()
+    return counts
@@ -1,15 +1,77 @@
-from django.test import TestCase
-from django.urls import reverse
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.uploadedfile import SimpleUploadedFile
-from rest_framework.test import APITestCase
+from django.http.multipartparser import MultiPartParser
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIRequestFactory, APITestCase
 from rest_framework import status
 from django.contrib.auth import get_user_model
-from .models import UploadedFile, DownloadToken
+from django.utils import timezone
+from datetime import timedelta
+from io import StringIO
+from asgiref.sync import async_to_sync, sync_to_async
+import base64
+import functools
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+import zipfile
+from unittest import mock
+from .mail import enqueue_email, queue_stats, send_queued_mail
+from .models import (
+    AuthToken, BatchDownloadToken, BlobLock, UploadedFile, DownloadToken, UploadSession, OutboundEmail, ProcessingJob
+)
+from .pagination import encode_cursor
+from .benchmarking import make_sparse_file
+from .delivery import archive_names, zip_stream
+from .compression import accepts_encoding, stored_file, zstandard
+from .processing import MAIN_CONTENT_TYPES, process_pending
+from .search import _substring_search, drop_sqlite_triggers, restore_sqlite_index, search_files, search_terms
+from .storage import S3ContentAddressedStorage, boto3, file_storage
+from .uploads import StreamingUploadHandler, assemble_chunks
+from .checks import check_replay_cache
+from .tokens import issue_download_token
+from . import async_views, crypto, metrics
+try:
+    import moto
+except ImportError:
+    moto = None
+from .middleware import MetricsMiddleware
+from .profiling import duplicate_queries, list_profiles, load_profile
+from .throttling import local_buckets, parse_rate
+from .authentication import CachedTokenAuthentication, TokenCache, hash_token, issue_auth_token, token_cache
+from .utils import decrypt_data, encrypt_data, generate_secure_token
 
 User = get_user_model()
 
+
+def shared_replay_cache(**kwargs):
+    # Stateless token modes need a cache with an atomic add; callers create its table
+    # with createcachetable once the override is enabled
+    caches = dict(settings.CACHES, replay={
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'test_replay_cache'
+    })
+    return override_settings(CACHES=caches, DOWNLOAD_REPLAY_CACHE='replay', **kwargs)
+
 class UserAuthTestCase(APITestCase):
     def setUp(self):
+        local_buckets.clear()
         self.ops_user = User.objects.create_user(
             username='opsuser',
             email='ops@test.com',
@@ -43,6 +105,10 @@ class UserAuthTestCase(APITestCase):
 
 class FileOperationsTestCase(APITestCase):
     def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
         self.ops_user = User.objects.create_user(
             username='opsuser',
             email='ops@test.com',
@@ -57,6 +123,10 @@ class FileOperationsTestCase(APITestCase):
             user_type='client',
             is_email_verified=True
         )
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
         
     def test_file_upload_by_ops_user(self):
         """Test file upload by operations user"""
@@ -111,3 +181,2347 @@ class FileOperationsTestCase(APITestCase):
         data = {'username': 'unverified', 'password': 'testpass123'}
         response = self.client.post(reverse('user_login'), data)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class SecureDownloadTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.ops_user = User.objects.create_user(
+            username='opsuser',
+            email='ops@test.com',
+            password='testpass123',
+            user_type='ops'
+        )
+        self.client_user = User.objects.create_user(
+            username='clientuser',
+            email='client@test.com',
+            password='testpass123',
+            user_type='client',
+            is_email_verified=True
+        )
+        self.content = b'0123456789' * 1000
+        self.uploaded_file = UploadedFile.objects.create(
+            file=SimpleUploadedFile('report.docx', self.content),
+            original_filename='report.docx',
+            uploaded_by=self.ops_user,
+            file_size=len(self.content),
+            file_type='docx'
+        )
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def create_token(self, **kwargs):
+        return DownloadToken.objects.create(
+            token=generate_secure_token(),
+            file=self.uploaded_file,
+            user=self.client_user,
+            expires_at=kwargs.pop('expires_at', timezone.now() + timedelta(hours=1)),
+            **kwargs
+        )
+
+    def test_secure_download_streams_file(self):
+        """Test that downloads are streamed rather than buffered"""
+        download_token = self.create_token()
+        response = self.client.get(reverse('secure_download', args=[download_token.token]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertIn('report.docx', response['Content-Disposition'])
+
+    @override_settings(DOWNLOAD_CHUNK_SIZE=1024)
+    def test_secure_download_uses_configured_chunk_size(self):
+        """Test that the configured chunk size bounds each streamed block"""
+        download_token = self.create_token()
+        response = self.client.get(reverse('secure_download', args=[download_token.token]))
+        chunks = list(response.streaming_content)
+        self.assertTrue(all(len(chunk) <= 1024 for chunk in chunks))
+        self.assertEqual(b''.join(chunks), self.content)
+
+    def test_secure_download_serves_byte_range(self):
+        """Test that a Range request returns 206 with the requested bytes"""
+        download_token = self.create_token()
+        response = self.client.get(
+            reverse('secure_download', args=[download_token.token]), HTTP_RANGE='bytes=10-19'
+        )
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(response['Content-Length'], '10')
+
+    def test_used_token_allows_resumed_ranges_only(self):
+        """Test that a used token keeps serving ranges of the same transfer"""
+        download_token = self.create_token()
+        url = reverse('secure_download', args=[download_token.token])
+        first = self.client.get(url)
+        etag = first['ETag']
+        first.close()
+
+        resumed = self.client.get(url, HTTP_RANGE='bytes=-100', HTTP_IF_RANGE=etag)
+        self.assertEqual(resumed.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(resumed.streaming_content), self.content[-100:])
+
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_410_GONE)
+        stale = self.client.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(stale.status_code, status.HTTP_410_GONE)
+
+    def test_used_token_cannot_replay_whole_file(self):
+        """Test that ranges from the first byte, and resumes after the window, are refused"""
+        download_token = self.create_token()
+        url = reverse('secure_download', args=[download_token.token])
+        etag = self.client.get(url)['ETag']
+
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=0-').status_code, status.HTTP_410_GONE)
+        self.assertEqual(
+            self.client.get(url, HTTP_RANGE='bytes=-20000', HTTP_IF_RANGE=etag).status_code, status.HTTP_410_GONE
+        )
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=10-').status_code, status.HTTP_206_PARTIAL_CONTENT)
+
+        DownloadToken.objects.filter(pk=download_token.pk).update(
+            used_at=timezone.now() - timedelta(seconds=settings.DOWNLOAD_RESUME_WINDOW + 1)
+        )
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=10-').status_code, status.HTTP_410_GONE)
+
+    def test_failed_precondition_does_not_use_token(self):
+        """Test that a 412 response is answered before the token is claimed"""
+        download_token = self.create_token()
+        response = self.client.get(
+            reverse('secure_download', args=[download_token.token]), HTTP_IF_MATCH='"other"'
+        )
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        download_token.refresh_from_db()
+        self.assertFalse(download_token.is_used)
+
+    def test_unsatisfiable_range_does_not_use_token(self):
+        """Test that a 416 response leaves the token unused"""
+        download_token = self.create_token()
+        response = self.client.get(
+            reverse('secure_download', args=[download_token.token]), HTTP_RANGE=f'bytes={len(self.content)}-'
+        )
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+        download_token.refresh_from_db()
+        self.assertFalse(download_token.is_used)
+
+    def test_if_none_match_returns_not_modified(self):
+        """Test that a matching If-None-Match returns 304 with validators"""
+        etag = self.client.get(reverse('secure_download', args=[self.create_token().token]))['ETag']
+        response = self.client.get(
+            reverse('secure_download', args=[self.create_token().token]), HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertIn('Last-Modified', response)
+
+    @override_settings(FILE_DELIVERY_BACKEND='x-accel-redirect', FILE_DELIVERY_ACCEL_PREFIX='/protected/')
+    def test_x_accel_redirect_delivery(self):
+        """Test that nginx offload emits an internal redirect and no body"""
+        download_token = self.create_token()
+        url = reverse('secure_download', args=[download_token.token])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{self.uploaded_file.file.name}')
+        self.assertEqual(response.content, b'')
+        self.assertIn('report.docx', response['Content-Disposition'])
+        self.assertNotIn('X-Sendfile', response)
+
+        # Ranges are left to nginx, but only one past the first byte resumes the transfer
+        resumed = self.client.get(url, HTTP_RANGE='bytes=100-')
+        self.assertEqual(resumed.status_code, status.HTTP_200_OK)
+        self.assertIn('X-Accel-Redirect', resumed)
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=0-').status_code, status.HTTP_410_GONE)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_410_GONE)
+
+    @override_settings(FILE_DELIVERY_BACKEND='x-accel-redirect')
+    def test_x_accel_redirect_resume_with_proxy_if_range(self):
+        """Test that a resume echoing nginx's own ETag in If-Range is handed to nginx to check"""
+        url = reverse('secure_download', args=[self.create_token().token])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+        # nginx ETags are "<mtime hex>-<size hex>", unlike the app's own validators
+        resumed = self.client.get(url, HTTP_RANGE='bytes=100-', HTTP_IF_RANGE='"6650a1b2-7d0"')
+        self.assertEqual(resumed.status_code, status.HTTP_200_OK)
+        self.assertIn('X-Accel-Redirect', resumed)
+        self.assertEqual(
+            self.client.get(url, HTTP_RANGE='bytes=0-', HTTP_IF_RANGE='"6650a1b2-7d0"').status_code,
+            status.HTTP_410_GONE,
+        )
+
+    @override_settings(FILE_DELIVERY_BACKEND='x-sendfile')
+    def test_x_sendfile_delivery(self):
+        """Test that Apache/lighttpd offload emits the absolute file path"""
+        download_token = self.create_token()
+        response = self.client.get(reverse('secure_download', args=[download_token.token]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Sendfile'], self.uploaded_file.file.path)
+        self.assertEqual(response.content, b'')
+        self.assertNotIn('X-Accel-Redirect', response)
+
+    @override_settings(FILE_DELIVERY_BACKEND='stream')
+    def test_stream_delivery_sends_no_offload_headers(self):
+        """Test that in-process streaming emits no offload headers"""
+        download_token = self.create_token()
+        response = self.client.get(reverse('secure_download', args=[download_token.token]))
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertNotIn('X-Sendfile', response)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    @override_settings(FILE_DELIVERY_BACKEND='bogus')
+    def test_unknown_delivery_backend_rejected(self):
+        """Test that an unknown delivery backend is a configuration error"""
+        download_token = self.create_token()
+        with self.assertRaises(ImproperlyConfigured):
+            self.client.get(reverse('secure_download', args=[download_token.token]))
+
+    def test_expired_download_link_rejected(self):
+        """Test that expired download links are rejected"""
+        download_token = self.create_token(expires_at=timezone.now() - timedelta(minutes=1))
+        response = self.client.get(reverse('secure_download', args=[download_token.token]))
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+@override_settings(CHUNKED_UPLOAD_MIN_CHUNK_SIZE=1)
+class ChunkedUploadTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.ops_user = User.objects.create_user(
+            username='opsuser',
+            email='ops@test.com',
+            password='testpass123',
+            user_type='ops'
+        )
+        self.client.force_authenticate(user=self.ops_user)
+        self.content = bytes(range(256)) * 10
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def start_upload(self, **data):
+        data = {'filename': 'deck.pptx', 'file_size': len(self.content), 'chunk_size': 1000, **data}
+        return self.client.post(reverse('start_chunked_upload'), data)
+
+    def put_chunk(self, upload_id, index, data):
+        return self.client.put(
+            reverse('upload_chunk', args=[upload_id, index]), data, content_type='application/octet-stream'
+        )
+
+    def test_chunked_upload_out_of_order(self):
+        """Test that chunks sent out of order assemble into the original file"""
+        response = self.start_upload()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        upload_id = response.data['upload_id']
+        self.assertEqual(response.data['total_chunks'], 3)
+
+        for index in (2, 0):
+            chunk = self.content[index * 1000:(index + 1) * 1000]
+            self.assertEqual(self.put_chunk(upload_id, index, chunk).status_code, status.HTTP_200_OK)
+
+        response = self.client.get(reverse('chunked_upload_status', args=[upload_id]))
+        self.assertEqual(response.data['received_chunks'], [0, 2])
+        self.assertEqual(response.data['missing_chunks'], [1])
+
+        response = self.client.post(reverse('complete_chunked_upload', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['missing_chunks'], [1])
+
+        self.put_chunk(upload_id, 1, self.content[1000:2000])
+        response = self.client.post(reverse('complete_chunked_upload', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        uploaded_file = UploadedFile.objects.get(id=response.data['file_id'])
+        self.assertEqual(uploaded_file.file_size, len(self.content))
+        self.assertEqual(uploaded_file.file_type, 'pptx')
+        with uploaded_file.file.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertFalse(os.path.exists(UploadSession.objects.get(id=upload_id).chunk_dir))
+
+        response = self.client.post(reverse('complete_chunked_upload', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_concurrent_completes_create_one_file(self):
+        """Test that a complete racing another one assembles its own copy and creates no second file"""
+        upload_id = self.start_upload().data['upload_id']
+        for index in range(3):
+            self.put_chunk(upload_id, index, self.content[index * 1000:(index + 1) * 1000])
+        url = reverse('complete_chunked_upload', args=[upload_id])
+        paths = []
+        responses = []
+
+        def complete_first(chunk_paths, path):
+            paths.append(path)
+            if len(paths) == 1:
+                # The other request completes the session before this one assembles
+                responses.append(self.client.post(url))
+            return assemble_chunks(chunk_paths, path)
+
+        with mock.patch('file_sharing.views.assemble_chunks', side_effect=complete_first):
+            responses.append(self.client.post(url))
+        self.assertEqual([r.status_code for r in responses], [status.HTTP_201_CREATED, status.HTTP_409_CONFLICT])
+        self.assertEqual(len(set(paths)), 2)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        uploaded_file = UploadedFile.objects.get()
+        self.assertEqual(UploadSession.objects.get(id=upload_id).uploaded_file, uploaded_file)
+        with uploaded_file.file.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+        # The other request claims the session after this one assembled
+        other_id = self.start_upload().data['upload_id']
+        for index in range(3):
+            self.put_chunk(other_id, index, self.content[index * 1000:(index + 1) * 1000])
+
+        winner = UploadedFile.objects.create(
+            file=uploaded_file.file.name, original_filename='deck.pptx', uploaded_by=self.ops_user,
+            file_size=len(self.content), file_type='pptx', sha256=uploaded_file.sha256
+        )
+
+        def claim_first(chunk_paths, path):
+            size = assemble_chunks(chunk_paths, path)
+            UploadSession.objects.filter(id=other_id).update(uploaded_file=winner)
+            return size
+
+        with mock.patch('file_sharing.views.assemble_chunks', side_effect=claim_first):
+            response = self.client.post(reverse('complete_chunked_upload', args=[other_id]))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertCountEqual(UploadedFile.objects.all(), [uploaded_file, winner])
+        with uploaded_file.file.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, settings.UPLOAD_STAGING_DIR)), [])
+
+    def test_chunk_with_wrong_size_rejected(self):
+        """Test that a chunk whose length does not match is rejected"""
+        upload_id = self.start_upload().data['upload_id']
+        response = self.put_chunk(upload_id, 0, b'short')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.put_chunk(upload_id, 5, self.content[:1000])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_chunked_upload_rejects_invalid_files(self):
+        """Test that disallowed extensions and oversized files are rejected up front"""
+        self.assertEqual(self.start_upload(filename='notes.pdf').status_code, status.HTTP_400_BAD_REQUEST)
+        with self.settings(CHUNKED_UPLOAD_MAX_FILE_SIZE=100):
+            self.assertEqual(self.start_upload().status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_chunked_upload_by_client_user_forbidden(self):
+        """Test that client users cannot start chunked uploads"""
+        client_user = User.objects.create_user(
+            username='clientuser',
+            email='client@test.com',
+            password='testpass123',
+            user_type='client'
+        )
+        self.client.force_authenticate(user=client_user)
+        self.assertEqual(self.start_upload().status_code, status.HTTP_403_FORBIDDEN)
+
+class ContentAddressedStorageTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.ops_user = User.objects.create_user(
+            username='opsuser',
+            email='ops@test.com',
+            password='testpass123',
+            user_type='ops'
+        )
+        self.client.force_authenticate(user=self.ops_user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def upload(self, name, content):
+        response = self.client.post(
+            reverse('upload_file'), {'file': SimpleUploadedFile(name, content)}, format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return UploadedFile.objects.get(id=response.data['file_id'])
+
+    def test_duplicate_uploads_share_one_blob(self):
+        """Test that identical content is stored once under its SHA-256"""
+        first = self.upload('report.docx', b'same content')
+        second = self.upload('report-copy.docx', b'same content')
+        other = self.upload('report.docx', b'other content')
+
+        digest = hashlib.sha256(b'same content').hexdigest()
+        self.assertEqual(first.sha256, digest)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(first.file.name, f'blobs/{digest[:2]}/{digest[2:4]}/{digest}')
+        self.assertNotEqual(first.file.name, other.file.name)
+        self.assertEqual(second.original_filename, 'report-copy.docx')
+        self.assertEqual(len(os.listdir(os.path.dirname(first.file.path))), 1)
+
+    def test_blob_deleted_with_last_reference(self):
+        """Test that a blob and its lock row are removed only when its last row is deleted"""
+        first = self.upload('report.docx', b'shared')
+        second = self.upload('report.pptx', b'shared')
+        path = first.file.path
+        lock = BlobLock.objects.filter(name=first.file.name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(lock.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(lock.exists())
+
+        third = self.upload('report.docx', b'shared')
+        self.assertTrue(os.path.exists(third.file.path))
+        self.assertTrue(lock.exists())
+
+    def test_delete_keeps_blob_uploaded_while_waiting_for_lock(self):
+        """Test that deleting the last row sees an upload of the same content that held the blob lock"""
+        first = self.upload('report.docx', b'racing')
+        path = first.file.path
+        self.assertTrue(BlobLock.objects.filter(name=first.file.name).exists())
+
+        def upload_first(name):
+            # The upload took the lock before the delete and committed its row
+            self.upload('report-again.docx', b'racing')
+            BlobLock.acquire(name)
+
+        with mock.patch('file_sharing.signals.BlobLock') as lock, self.captureOnCommitCallbacks(execute=True):
+            lock.acquire.side_effect = upload_first
+            first.delete()
+        lock.acquire.assert_called_once_with(first.file.name)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(UploadedFile.objects.get().file.path, path)
+
+class StorageLayoutMigrationTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.ops_user = User.objects.create_user(
+            username='opsuser',
+            email='ops@test.com',
+            password='testpass123',
+            user_type='ops'
+        )
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def legacy_file(self, filename, content):
+        """Create a row whose file is stored under the flat uploads/<username>/ layout"""
+        name = f'uploads/{self.ops_user.username}/{filename}'
+        os.makedirs(os.path.join(self.media_root, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(self.media_root, name), 'wb') as f:
+            f.write(content)
+        return UploadedFile.objects.create(
+            file=name,
+            original_filename=filename,
+            uploaded_by=self.ops_user,
+            file_size=len(content),
+            file_type=filename.rsplit('.', 1)[1]
+        )
+
+    def test_legacy_files_moved_into_blob_layout(self):
+        """Test that legacy files are moved to their sharded blob in batches and deduplicated"""
+        first = self.legacy_file('a.docx', b'shared content')
+        second = self.legacy_file('b.docx', b'shared content')
+        other = self.legacy_file('c.pptx', b'other content')
+        missing = UploadedFile.objects.create(
+            file='uploads/opsuser/gone.docx', original_filename='gone.docx', uploaded_by=self.ops_user,
+            file_size=1, file_type='docx'
+        )
+
+        out = StringIO()
+        call_command('migrate_storage_layout', batch_size=2, sleep=0, stdout=out)
+        self.assertIn('resharded 3 files', out.getvalue())
+        self.assertIn('1 missing', out.getvalue())
+
+        digest = hashlib.sha256(b'shared content').hexdigest()
+        for row in (first, second):
+            row.refresh_from_db()
+            self.assertEqual(row.file.name, f'blobs/{digest[:2]}/{digest[2:4]}/{digest}')
+            self.assertEqual(row.sha256, digest)
+        other.refresh_from_db()
+        with other.file.open('rb') as f:
+            self.assertEqual(f.read(), b'other content')
+        missing.refresh_from_db()
+        self.assertEqual(missing.file.name, 'uploads/opsuser/gone.docx')
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'uploads', 'opsuser')), [])
+
+        out = StringIO()
+        call_command('migrate_storage_layout', dry_run=True, stdout=out)
+        self.assertIn('1 files to move', out.getvalue())
+
+    def test_compressed_legacy_file_keeps_variant(self):
+        """Test that a compressed legacy file is moved with its encoding"""
+        row = self.legacy_file('a.docx', b'compressible ' * 1000)
+        call_command('compress_files', stdout=StringIO())
+        row.refresh_from_db()
+        self.assertEqual(row.stored_encoding, 'gzip')
+
+        call_command('migrate_storage_layout', sleep=0, stdout=StringIO())
+        row.refresh_from_db()
+        self.assertTrue(row.file.name.startswith('blobs/'))
+        self.assertEqual(row.stored_encoding, 'gzip')
+        path, encoding = stored_file(row)
+        self.assertTrue(path.endswith('.gz'))
+        with gzip.open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'compressible ' * 1000)
+
+@unittest.skipUnless(boto3 is not None and moto is not None, 'boto3 and moto are not installed')
+@override_settings(S3_BUCKET='uploads', S3_REGION='us-east-1', S3_ACCESS_KEY_ID='testing',
+                   S3_SECRET_ACCESS_KEY='testing')
+class S3StorageTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.mock_aws = moto.mock_aws()
+        self.mock_aws.start()
+
+        self.storage = S3ContentAddressedStorage(prefix='files')
+        self.storage.client.create_bucket(Bucket='uploads')
+        field = UploadedFile._meta.get_field('file')
+        self.storage_patch = mock.patch.object(field, 'storage', self.storage)
+
+        self.ops_user = User.objects.create_user(
+            username='opsuser',
+            email='ops@test.com',
+            password='testpass123',
+            user_type='ops'
+        )
+        self.client_user = User.objects.create_user(
+            username='clientuser',
+            email='client@test.com',
+            password='testpass123',
+            user_type='client',
+            is_email_verified=True
+        )
+
+    def tearDown(self):
+        self.mock_aws.stop()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def keys(self):
+        response = self.storage.client.list_objects_v2(Bucket='uploads')
+        return [item['Key'] for item in response.get('Contents', [])]
+
+    def test_blobs_stored_once_under_prefix(self):
+        """Test that the S3 backend deduplicates content under sharded keys"""
+        first = self.storage.save('ignored', io.BytesIO(b'same content'))
+        second = self.storage.save('other', io.BytesIO(b'same content'))
+
+        digest = hashlib.sha256(b'same content').hexdigest()
+        self.assertEqual(first, second)
+        self.assertEqual(first, f'blobs/{digest[:2]}/{digest[2:4]}/{digest}')
+        self.assertEqual(self.keys(), [f'files/{first}'])
+        self.assertTrue(self.storage.exists(first))
+        self.assertEqual(self.storage.size(first), len(b'same content'))
+        with self.storage.open(first) as f:
+            self.assertEqual(f.read(), b'same content')
+
+        self.storage.delete(first)
+        self.assertFalse(self.storage.exists(first))
+
+    def test_download_redirects_to_presigned_url(self):
+        """Test that downloads from remote storage redirect to a short lived attachment URL"""
+        with self.storage_patch:
+            uploaded_file = UploadedFile.objects.create(
+                file=SimpleUploadedFile('report.docx', b'remote content'),
+                original_filename='report.docx',
+                uploaded_by=self.ops_user,
+                file_size=len(b'remote content'),
+                file_type='docx'
+            )
+            download_token = DownloadToken.objects.create(
+                token=generate_secure_token(),
+                file=uploaded_file,
+                user=self.client_user,
+                expires_at=timezone.now() + timedelta(hours=1)
+            )
+            response = self.client.get(reverse('secure_download', args=[download_token.token]))
+
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertIn(f'files/{uploaded_file.file.name}', response['Location'])
+        self.assertIn('response-content-disposition=attachment', response['Location'])
+        self.assertIn('no-store', response['Cache-Control'])
+        download_token.refresh_from_db()
+        self.assertTrue(download_token.is_used)
+
+    async def test_async_download_redirects(self):
+        """Test that the async download view redirects to remote storage too"""
+        with self.storage_patch:
+            uploaded_file = await UploadedFile.objects.acreate(
+                file=SimpleUploadedFile('deck.pptx', b'remote deck'),
+                original_filename='deck.pptx',
+                uploaded_by=self.ops_user,
+                file_size=len(b'remote deck'),
+                file_type='pptx'
+            )
+            download_token = await DownloadToken.objects.acreate(
+                token=generate_secure_token(),
+                file=uploaded_file,
+                user=self.client_user,
+                expires_at=timezone.now() + timedelta(hours=1)
+            )
+            response = await async_views.secure_download(AsyncRequestFactory().get('/'), download_token.token)
+
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertIn('deck.pptx', response['Location'])
+
+    def test_migration_copies_blobs(self):
+        """Test that migrating to the S3 backend copies local blobs, leaving them while it is not serving"""
+        row = UploadedFile.objects.create(
+            file=SimpleUploadedFile('report.docx', b'local content'),
+            original_filename='report.docx',
+            uploaded_by=self.ops_user,
+            file_size=len(b'local content'),
+            file_type='docx'
+        )
+
+        with mock.patch('file_sharing.storage_migration.configured_storage', return_value=self.storage):
+            out = StringIO()
+            call_command('migrate_storage_layout', backend='s3', sleep=0, stdout=out)
+            self.assertIn('copied 1 blobs', out.getvalue())
+            self.assertEqual(self.keys(), [f'files/{row.file.name}'])
+            self.assertTrue(os.path.exists(row.file.path))
+
+            with override_settings(FILE_STORAGE_BACKEND='s3'):
+                call_command('migrate_storage_layout', sleep=0, stdout=StringIO())
+            self.assertFalse(os.path.exists(row.file.path))
+
+class StreamingUploadTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.ops_user = User.objects.create_user(username='opsuser', password='testpass123', user_type='ops')
+        self.client.force_authenticate(user=self.ops_user)
+        local_buckets.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def staged_files(self):
+        staging_dir = os.path.join(self.media_root, settings.UPLOAD_STAGING_DIR)
+        return os.listdir(staging_dir) if os.path.isdir(staging_dir) else []
+
+    def parse(self, filename, content):
+        """Run the multipart parser with a streaming handler and return it with the bytes read from the body"""
+        body = encode_multipart(BOUNDARY, {'file': SimpleUploadedFile(filename, content)})
+        stream = io.BytesIO(body)
+        request = APIRequestFactory().post('/', body, content_type=MULTIPART_CONTENT)
+        handler = StreamingUploadHandler(request)
+        try:
+            MultiPartParser(request.META, stream, [handler]).parse()
+        finally:
+            if hasattr(handler, 'file'):
+                handler.file.close()
+        return handler, stream.tell(), len(body)
+
+    def test_upload_is_hashed_while_streaming(self):
+        """Test that storage uses the digest computed on arrival and no staged copy is left behind"""
+        content = os.urandom(3 * 1024 * 1024)
+        with mock.patch('file_sharing.storage.content_digest') as content_digest:
+            response = self.client.post(
+                reverse('upload_file'), {'file': SimpleUploadedFile('deck.pptx', content)}, format='multipart'
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        content_digest.assert_not_called()
+
+        uploaded_file = UploadedFile.objects.get(id=response.data['file_id'])
+        self.assertEqual(uploaded_file.sha256, hashlib.sha256(content).hexdigest())
+        self.assertEqual(uploaded_file.file_size, len(content))
+        with open(uploaded_file.file.path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(self.staged_files(), [])
+
+        # A duplicate is not moved anywhere; its staged copy is removed
+        response = self.client.post(
+            reverse('upload_file'), {'file': SimpleUploadedFile('copy.pptx', content)}, format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.staged_files(), [])
+
+    def test_bad_extension_rejected_before_reading_body(self):
+        """Test that the parser stops at the file's part headers"""
+        handler, read, total = self.parse('malware.exe', b'x' * (4 * 1024 * 1024))
+        self.assertEqual(handler.error, 'Only .pptx, .docx, and .xlsx files are allowed')
+        self.assertLess(read, total // 2)
+        self.assertEqual(self.staged_files(), [])
+
+        response = self.client.post(
+            reverse('upload_file'), {'file': SimpleUploadedFile('malware.exe', b'x')}, format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['file'], ['Only .pptx, .docx, and .xlsx files are allowed'])
+
+    @override_settings(UPLOAD_MAX_FILE_SIZE=1024 * 1024)
+    def test_oversize_rejected_early(self):
+        """Test that oversize bodies are refused from Content-Length and oversize files mid-stream"""
+        handler, read, _ = self.parse('big.docx', b'x' * (2 * 1024 * 1024))
+        self.assertEqual(handler.error, f'File size cannot exceed {1024 * 1024} bytes')
+        self.assertEqual(read, 0)
+
+        # Within the multipart allowance the body is read, but only up to the limit
+        handler, read, total = self.parse('big.docx', b'x' * (1024 * 1024 + 32 * 1024))
+        self.assertIsNotNone(handler.error)
+        self.assertLessEqual(read, 1024 * 1024 + 2 * StreamingUploadHandler.chunk_size)
+        self.assertEqual(self.staged_files(), [])
+
+        response = self.client.post(
+            reverse('upload_file'), {'file': SimpleUploadedFile('big.docx', b'x' * (2 * 1024 * 1024))},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(UploadedFile.objects.exists())
+
+class FileListingTestCase(APITestCase):
+    def setUp(self):
+        self.ops_user = User.objects.create_user(
+            username='opsuser',
+            email='ops@test.com',
+            password='testpass123',
+            user_type='ops'
+        )
+        self.client_user = User.objects.create_user(
+            username='clientuser',
+            email='client@test.com',
+            password='testpass123',
+            user_type='client',
+            is_email_verified=True
+        )
+        for i in range(7):
+            UploadedFile.objects.create(
+                file=f'uploads/opsuser/file{i}.docx',
+                original_filename=f'file{i}.{"docx" if i % 2 else "pptx"}',
+                uploaded_by=self.ops_user,
+                file_size=100 + i,
+                file_type='docx' if i % 2 else 'pptx'
+            )
+        self.client.force_authenticate(user=self.client_user)
+
+    def test_cursor_pagination_walks_all_files(self):
+        """Test that following next_cursor returns every file once, newest first"""
+        seen = []
+        params = {'limit': 3}
+        while True:
+            response = self.client.get(reverse('list_files'), params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(f['original_filename'] for f in response.data['files'])
+            if not response.data['next_cursor']:
+                break
+            params['cursor'] = response.data['next_cursor']
+
+        expected = list(UploadedFile.objects.order_by('-uploaded_at', '-id').values_list('original_filename', flat=True))
+        self.assertEqual(seen, expected)
+        self.assertNotIn('count', response.data)
+
+    def test_listing_query_count_is_constant(self):
+        """Test that uploader names are joined rather than fetched per row"""
+        url = reverse('list_files')
+        response = self.client.get(url)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.data['files'][0]['uploaded_by'], str(self.ops_user))
+
+    def test_fields_projection_and_count(self):
+        """Test that ?fields= limits the payload and ?count= adds a total"""
+        response = self.client.get(reverse('list_files'), {'fields': 'id,file_type', 'file_type': 'docx', 'count': 'exact'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['files'][0]), {'id', 'file_type'})
+        self.assertEqual(response.data['count'], 3)
+        response = self.client.get(reverse('list_files'), {'count': 'approx'})
+        self.assertEqual(response.data['count'], 7)
+
+    def test_invalid_listing_parameters_rejected(self):
+        """Test that unknown fields and malformed cursors are rejected"""
+        response = self.client.get(reverse('list_files'), {'fields': 'id,password'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('list_files'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class FileSearchTestCase(APITestCase):
+    def setUp(self):
+        self.ops_user = User.objects.create_user(
+            username='opsuser',
+            email='ops@test.com',
+            password='testpass123',
+            user_type='ops'
+        )
+        self.analyst = User.objects.create_user(
+            username='analyst',
+            email='analyst@test.com',
+            password='testpass123',
+            user_type='ops'
+        )
+        client_user = User.objects.create_user(
+            username='clientuser',
+            email='client@test.com',
+            password='testpass123',
+            user_type='client',
+            is_email_verified=True
+        )
+        self.create_file('Quarterly Report 2024.docx', self.ops_user)
+        self.create_file('quarterly-budget.xlsx', self.ops_user)
+        self.create_file('Roadmap.pptx', self.analyst)
+        self.create_file('Report report report.docx', self.ops_user)
+        self.client.force_authenticate(user=client_user)
+
+    def create_file(self, name, user):
+        return UploadedFile.objects.create(
+            file=f'uploads/{user.username}/{name}',
+            original_filename=name,
+            uploaded_by=user,
+            file_size=100,
+            file_type=name.split('.')[-1]
+        )
+
+    def search(self, query, **params):
+        response = self.client.get(reverse('list_files'), {'search': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [f['original_filename'] for f in response.data['files']]
+
+    def test_search_matches_substrings(self):
+        """Test that every search term matches anywhere in the filename, ignoring case"""
+        self.assertCountEqual(self.search('quart'), ['Quarterly Report 2024.docx', 'quarterly-budget.xlsx'])
+        self.assertEqual(self.search('quart rep'), ['Quarterly Report 2024.docx'])
+        self.assertCountEqual(self.search('PORT'), ['Quarterly Report 2024.docx', 'Report report report.docx'])
+        self.assertEqual(self.search('map'), ['Roadmap.pptx'])
+        self.assertEqual(self.search('zzz'), [])
+
+    def test_search_matches_like_icontains(self):
+        """Test that the indexed search finds exactly what icontains on every term finds"""
+        self.create_file('budget_q3.xlsx', self.analyst)
+        base = UploadedFile.objects.all()
+        for query in ('port', 'rep 24', 'q', 'et_q', '_', 'x', 'ops', 'ly re', 'pptx lys', 'zzz'):
+            with self.subTest(query=query):
+                self.assertCountEqual(
+                    search_files(base, query).values_list('pk', flat=True),
+                    _substring_search(base, search_terms(query), rank=False).values_list('pk', flat=True),
+                )
+
+    def test_search_matches_uploader_username(self):
+        """Test that files can be found by their uploader's username"""
+        self.assertEqual(self.search('analy'), ['Roadmap.pptx'])
+        self.analyst.username = 'strategist'
+        self.analyst.save()
+        self.assertEqual(self.search('strat'), ['Roadmap.pptx'])
+        self.assertEqual(self.search('analy'), [])
+
+    def test_search_index_follows_renames_and_deletes(self):
+        """Test that the search index tracks filename changes and deleted files"""
+        roadmap = UploadedFile.objects.get(original_filename='Roadmap.pptx')
+        roadmap.original_filename = 'Strategy.pptx'
+        roadmap.save()
+        self.assertEqual(self.search('strategy'), ['Strategy.pptx'])
+        roadmap.delete()
+        self.assertEqual(self.search('strategy'), [])
+
+    def test_search_ordered_by_relevance(self):
+        """Test that ordering=relevance puts the best match first"""
+        results = self.search('report', ordering='relevance')
+        self.assertEqual(results[0], 'Report report report.docx')
+        self.assertCountEqual(results, ['Quarterly Report 2024.docx', 'Report report report.docx'])
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'SQLite search index triggers')
+    def test_search_index_restored_after_migrate(self):
+        """Test that dropped search triggers are recreated and the index refilled"""
+        drop_sqlite_triggers(connection)
+        roadmap = UploadedFile.objects.get(original_filename='Roadmap.pptx')
+        roadmap.original_filename = 'Strategy.pptx'
+        roadmap.save()
+        self.create_file('Forecast.xlsx', self.analyst)
+        self.assertEqual(self.search('strategy'), [])
+        self.assertTrue(restore_sqlite_index(connection))
+        self.assertEqual(self.search('strategy'), ['Strategy.pptx'])
+        self.assertEqual(self.search('forecast'), ['Forecast.xlsx'])
+        self.assertEqual(self.search('roadmap'), [])
+        self.assertFalse(restore_sqlite_index(connection))
+        self.create_file('Timeline.pptx', self.analyst)
+        self.assertEqual(self.search('timeline'), ['Timeline.pptx'])
+
+class QueryPlanTestCase(APITestCase):
+    def setUp(self):
+        self.ops_user = User.objects.create_user(
+            username='opsuser',
+            email='ops@test.com',
+            password='testpass123',
+            user_type='ops'
+        )
+        self.client_user = User.objects.create_user(
+            username='clientuser',
+            email='client@test.com',
+            password='testpass123',
+            user_type='client',
+            is_email_verified=True
+        )
+        self.uploaded_file = UploadedFile.objects.create(
+            file='uploads/opsuser/report.docx',
+            original_filename='report.docx',
+            uploaded_by=self.ops_user,
+            file_size=100,
+            file_type='docx'
+        )
+        if connection.vendor == 'postgresql':
+            # Tiny test tables would otherwise always be scanned sequentially
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(f'EXPLAIN {sql}')
+            else:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+    def full_scans(self, plan, allow_sort):
+        if connection.vendor == 'postgresql':
+            return [line for line in plan.splitlines() if 'Seq Scan' in line]
+        return [
+            line for line in plan.splitlines()
+            if (line.startswith('SCAN ') and 'USING' not in line and 'VIRTUAL TABLE' not in line)
+            or (not allow_sort and 'TEMP B-TREE FOR ORDER BY' in line)
+        ]
+
+    def assertIndexedQueries(self, func, allow_sort=False):
+        """EXPLAIN every query func runs and fail on full table scans or unindexed sorts"""
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        explained = 0
+        for query in queries.captured_queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            plan = self.explain(sql)
+            self.assertEqual(self.full_scans(plan, allow_sort), [], f'Full scan in plan for:\n{sql}\n{plan}')
+            explained += 1
+        self.assertGreater(explained, 0)
+
+    def test_list_files_queries_use_indexes(self):
+        """Test listing, filtering and paging the files through indexes"""
+        self.client.force_authenticate(user=self.client_user)
+        self.assertIndexedQueries(lambda: self.client.get(reverse('list_files')))
+        self.assertIndexedQueries(lambda: self.client.get(reverse('list_files'), {'file_type': 'docx', 'limit': 1}))
+        cursor = encode_cursor(self.uploaded_file)
+        self.assertIndexedQueries(lambda: self.client.get(reverse('list_files'), {'cursor': cursor}))
+        self.assertIndexedQueries(lambda: self.client.get(reverse('list_files'), {'file_type': 'docx', 'cursor': cursor}))
+        # Search matches come from the search index and are then sorted
+        self.assertIndexedQueries(lambda: self.client.get(reverse('list_files'), {'search': 'rep'}), allow_sort=True)
+
+    def test_download_token_queries_use_indexes(self):
+        """Test that redeeming and cleaning up download tokens avoids full scans"""
+        download_token = DownloadToken.objects.create(
+            token=generate_secure_token(),
+            file=self.uploaded_file,
+            user=self.client_user,
+            expires_at=timezone.now() - timedelta(minutes=1)
+        )
+        self.assertIndexedQueries(
+            lambda: self.client.get(reverse('secure_download', args=[download_token.token]))
+        )
+        self.assertIndexedQueries(
+            lambda: DownloadToken.objects.filter(
+                user=self.client_user, file=self.uploaded_file, is_used=False, expires_at__gt=timezone.now()
+            ).exists()
+        )
+        self.assertIndexedQueries(lambda: call_command('cleanup_expired_tokens', stdout=StringIO()))
+
+    def test_verify_email_query_uses_index(self):
+        """Test that the verification token lookup is indexed"""
+        self.assertIndexedQueries(lambda: self.client.get(reverse('verify_email'), {'token': 'missing'}))
+
+    def test_blob_reference_query_uses_index(self):
+        """Test that blob reference counting looks up rows by hash through an index"""
+        self.assertIndexedQueries(lambda: UploadedFile.objects.filter(sha256='0' * 64).exists())
+
+class StatelessDownloadTokenTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = shared_replay_cache(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        call_command('createcachetable', verbosity=0)
+        cache.clear()
+
+        self.ops_user = User.objects.create_user(
+            username='opsuser',
+            email='ops@test.com',
+            password='testpass123',
+            user_type='ops'
+        )
+        self.client_user = User.objects.create_user(
+            username='clientuser',
+            email='client@test.com',
+            password='testpass123',
+            user_type='client',
+            is_email_verified=True
+        )
+        self.content = b'stateless' * 100
+        self.uploaded_file = UploadedFile.objects.create(
+            file=SimpleUploadedFile('report.docx', self.content),
+            original_filename='report.docx',
+            uploaded_by=self.ops_user,
+            file_size=len(self.content),
+            file_type='docx'
+        )
+        self.client.force_authenticate(user=self.client_user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def download_link(self):
+        response = self.client.get(reverse('download_file', args=[self.uploaded_file.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['download_link']
+
+    def assertSingleUseLink(self, link):
+        self.assertFalse(DownloadToken.objects.exists())
+        response = self.client.get(link)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        resumed = self.client.get(link, HTTP_RANGE='bytes=1-8', HTTP_IF_RANGE=response['ETag'])
+        self.assertEqual(resumed.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(self.client.get(link, HTTP_RANGE='bytes=0-8').status_code, status.HTTP_410_GONE)
+        self.assertEqual(self.client.get(link).status_code, status.HTTP_410_GONE)
+
+    @override_settings(DOWNLOAD_TOKEN_MODE='signed')
+    def test_signed_download_link(self):
+        """Test that signed links work once without writing a DownloadToken row"""
+        self.assertSingleUseLink(self.download_link())
+
+    @override_settings(DOWNLOAD_TOKEN_MODE='encrypted')
+    def test_encrypted_download_link(self):
+        """Test that Fernet-encrypted links work once without writing a DownloadToken row"""
+        link = self.download_link()
+        self.assertNotIn(self.uploaded_file.id.hex, link)
+        self.assertSingleUseLink(link)
+
+    @override_settings(DOWNLOAD_TOKEN_MODE='signed')
+    def test_tampered_signed_link_rejected(self):
+        """Test that a modified signed link is rejected"""
+        link = self.download_link()
+        response = self.client.get(link.rstrip('/')[:-2] + 'xx/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_expired_stateless_link_rejected(self):
+        """Test that stateless links stop working after they expire"""
+        expires_at = timezone.now() - timedelta(seconds=5)
+        for mode in ('signed', 'encrypted'):
+            with self.settings(DOWNLOAD_TOKEN_MODE=mode):
+                token = issue_download_token(self.uploaded_file, self.client_user, expires_at)
+                response = self.client.get(reverse('secure_download', args=[token]))
+                self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+    def test_links_from_other_modes_stay_valid(self):
+        """Test that switching modes does not break links already handed out"""
+        with self.settings(DOWNLOAD_TOKEN_MODE='signed'):
+            link = self.download_link()
+        response = self.client.get(link)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response.close()
+
+    def test_unshared_replay_cache_refused(self):
+        """Test that stateless modes refuse a replay cache without a shared atomic add at startup and at use"""
+        with self.settings(DOWNLOAD_TOKEN_MODE='signed'):
+            link = self.download_link()
+            self.assertEqual(check_replay_cache(None), [])
+        for backend in ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache',
+                        'django.core.cache.backends.filebased.FileBasedCache'):
+            caches = {'default': {'BACKEND': backend, 'LOCATION': self.media_root}}
+            with self.settings(DOWNLOAD_TOKEN_MODE='signed', CACHES=caches, DOWNLOAD_REPLAY_CACHE='default'):
+                errors = check_replay_cache(None)
+                self.assertEqual([error.id for error in errors], ['file_sharing.E002'])
+                with self.assertRaises(ImproperlyConfigured):
+                    self.client.get(link)
+        with self.settings(DOWNLOAD_TOKEN_MODE='db', CACHES={'default': {'BACKEND': backend}}):
+            self.assertEqual(check_replay_cache(None), [])
+        with self.settings(DOWNLOAD_TOKEN_MODE='bogus'):
+            self.assertEqual([error.id for error in check_replay_cache(None)], ['file_sharing.E001'])
+
+class CryptoTestCase(TestCase):
+    def test_encrypt_data_round_trip_uses_cached_cipher(self):
+        """Test that the helpers round-trip and reuse one cipher per key set"""
+        token = encrypt_data('payload')
+        self.assertEqual(decrypt_data(token), 'payload')
+        self.assertIs(crypto.cipher_for(), crypto.cipher_for())
+        self.assertIsNone(decrypt_data('not-a-token'))
+
+    def test_key_derivation_matches_existing_tokens(self):
+        """Test that tokens from the previous per-call key derivation still decrypt"""
+        key = base64.urlsafe_b64encode(hashlib.sha256(settings.SECRET_KEY.encode()[:32]).digest())
+        legacy_token = Fernet(key).encrypt(b'legacy').decode()
+        self.assertEqual(decrypt_data(legacy_token), 'legacy')
+
+    def test_key_rotation(self):
+        """Test that old keys keep decrypting after rotation and rotate() re-encrypts"""
+        old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+        with self.settings(ENCRYPTION_KEYS=[old_key.decode()]):
+            token = encrypt_data('rotating')
+        with self.settings(ENCRYPTION_KEYS=[new_key.decode(), old_key.decode()]):
+            self.assertEqual(decrypt_data(token), 'rotating')
+            rotated = crypto.rotate(token)
+        with self.settings(ENCRYPTION_KEYS=[new_key.decode()]):
+            self.assertIsNone(decrypt_data(token))
+            self.assertEqual(decrypt_data(rotated), 'rotating')
+
+    def test_batch_encrypt_and_decrypt(self):
+        """Test the list based helpers"""
+        tokens = crypto.encrypt_many(['a', b'b', 'c'])
+        self.assertEqual(crypto.decrypt_many(tokens + ['bogus']), ['a', 'b', 'c', None])
+
+
+class FailingEmailBackend(LocmemEmailBackend):
+    """Email backend that refuses every message, standing in for an SMTP outage"""
+
+    def send_messages(self, messages):
+        raise ConnectionRefusedError('SMTP server unavailable')
+
+
+class OutboundEmailTestCase(APITestCase):
+    def setUp(self):
+        local_buckets.clear()
+
+    def test_signup_queues_verification_email(self):
+        """Test that signup queues the verification email instead of sending it inline"""
+        response = self.client.post(reverse('client_signup'), {
+            'username': 'clientuser',
+            'email': 'client@test.com',
+            'password': 'testpass123',
+            'confirm_password': 'testpass123',
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(mail.outbox), 0)
+
+        queued = OutboundEmail.objects.get()
+        self.assertEqual(queued.to, ['client@test.com'])
+        self.assertIn(response.data['verification_url'], queued.body)
+
+        out = StringIO()
+        call_command('send_queued_mail', stdout=out)
+        self.assertIn('Successfully sent 1 emails', out.getvalue())
+        self.assertEqual(mail.outbox[0].to, ['client@test.com'])
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, 'sent')
+        self.assertIsNotNone(queued.sent_at)
+
+    @override_settings(MAIL_QUEUE_ENABLED=False)
+    def test_signup_sends_inline_when_queue_disabled(self):
+        """Test the synchronous fallback"""
+        self.client.post(reverse('client_signup'), {
+            'username': 'clientuser',
+            'email': 'client@test.com',
+            'password': 'testpass123',
+            'confirm_password': 'testpass123',
+        })
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(OutboundEmail.objects.exists())
+
+    def test_batch_uses_one_connection(self):
+        """Test that a batch is sent over a single opened connection"""
+        for i in range(5):
+            enqueue_email('Hello', 'Body', [f'user{i}@test.com'])
+        opened = []
+        class CountingBackend(LocmemEmailBackend):
+            def open(self):
+                opened.append(self)
+                return super().open()
+        stats = send_queued_mail(batch_size=3, connection=CountingBackend())
+        self.assertEqual(stats, {'sent': 3, 'retried': 0, 'failed': 0})
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(queue_stats()['queued'], 2)
+
+    @override_settings(
+        EMAIL_BACKEND='file_sharing.tests.FailingEmailBackend',
+        MAIL_QUEUE_MAX_ATTEMPTS=2,
+        MAIL_QUEUE_RETRY_DELAY=60,
+    )
+    def test_failed_sends_back_off_then_give_up(self):
+        """Test retry scheduling and the final failed state"""
+        message = enqueue_email('Hello', 'Body', ['user@test.com'])
+
+        self.assertEqual(send_queued_mail(), {'sent': 0, 'retried': 1, 'failed': 0})
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'queued')
+        self.assertIn('SMTP server unavailable', message.last_error)
+        self.assertGreater(message.next_attempt_at, timezone.now() + timedelta(seconds=50))
+
+        # Not due yet, so nothing is attempted
+        self.assertEqual(send_queued_mail(), {'sent': 0, 'retried': 0, 'failed': 0})
+
+        OutboundEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(send_queued_mail(), {'sent': 0, 'retried': 0, 'failed': 1})
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'failed')
+        self.assertEqual(message.attempts, 2)
+        self.assertEqual(queue_stats()['failed'], 1)
+
+    def test_connection_reopened_after_failed_send(self):
+        """Test that the rest of a batch is sent over a reopened connection after a failure"""
+        for i in range(3):
+            enqueue_email('Hello', 'Body', [f'user{i}@test.com'])
+        events = []
+        class FlakyBackend(LocmemEmailBackend):
+            def open(self):
+                events.append('open')
+                self.broken = False
+                return super().open()
+            def close(self):
+                events.append('close')
+                self.broken = True
+            def send_messages(self, messages):
+                if self.broken:
+                    raise ConnectionResetError('connection closed')
+                if messages[0].to == ['user0@test.com']:
+                    self.broken = True
+                    raise ConnectionResetError('server hung up')
+                return super().send_messages(messages)
+        stats = send_queued_mail(batch_size=3, connection=FlakyBackend())
+        self.assertEqual(stats, {'sent': 2, 'retried': 1, 'failed': 0})
+        self.assertEqual(events, ['open', 'close', 'open', 'close'])
+        self.assertEqual([email.to for email in mail.outbox], [['user1@test.com'], ['user2@test.com']])
+
+
+class AsyncDownloadTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = shared_replay_cache(MEDIA_ROOT=self.media_root, DOWNLOAD_CHUNK_SIZE=1024)
+        self.settings_override.enable()
+        call_command('createcachetable', verbosity=0)
+
+        self.ops_user = User.objects.create_user(username='opsuser', password='testpass123', user_type='ops')
+        self.client_user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+        self.content = b'0123456789' * 1000
+        self.uploaded_file = UploadedFile.objects.create(
+            file=SimpleUploadedFile('report.docx', self.content),
+            original_filename='report.docx',
+            uploaded_by=self.ops_user,
+            file_size=len(self.content),
+            file_type='docx'
+        )
+        self.factory = AsyncRequestFactory()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    async def read_body(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    async def request_link(self, user):
+        key, _ = await sync_to_async(issue_auth_token)(user)
+        request = self.factory.get('/', headers={'Authorization': f'Token {key}'})
+        return await async_views.download_file(request, self.uploaded_file.id)
+
+    async def test_download_link_requires_token_auth(self):
+        """Test that the async link endpoint authenticates like the DRF view"""
+        response = await async_views.download_file(self.factory.get('/'), self.uploaded_file.id)
+        self.assertEqual(response.status_code, 401)
+
+        response = await self.request_link(self.ops_user)
+        self.assertEqual(response.status_code, 403)
+
+    async def test_secure_download_streams_async_body(self):
+        """Test that the async download serves the file from an async iterator once"""
+        response = await self.request_link(self.client_user)
+        self.assertEqual(response.status_code, 200)
+        token = json.loads(response.content)['download_link'].rstrip('/').rsplit('/', 1)[-1]
+
+        response = await async_views.secure_download(self.factory.get('/'), token)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(await self.read_body(response), self.content)
+
+        response = await async_views.secure_download(self.factory.get('/'), token)
+        self.assertEqual(response.status_code, 410)
+
+    @override_settings(DOWNLOAD_TOKEN_MODE='signed')
+    async def test_secure_download_resumes_range(self):
+        """Test that a claimed stateless token resumes with a Range request"""
+        token = issue_download_token(self.uploaded_file, self.client_user, timezone.now() + timedelta(hours=1))
+        first = await async_views.secure_download(self.factory.get('/'), token)
+        await self.read_body(first)
+
+        response = await async_views.secure_download(self.factory.get('/', headers={'Range': 'bytes=9000-'}), token)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 9000-9999/{len(self.content)}')
+        self.assertEqual(await self.read_body(response), self.content[9000:])
+
+    async def test_invalid_token(self):
+        """Test that unknown tokens are rejected"""
+        response = await async_views.secure_download(self.factory.get('/'), 'missing')
+        self.assertEqual(response.status_code, 404)
+
+
+class TokenCleanupTestCase(TestCase):
+    def setUp(self):
+        self.ops_user = User.objects.create_user(username='opsuser', password='testpass123', user_type='ops')
+        self.client_user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+        self.uploaded_file = UploadedFile.objects.create(
+            file='uploads/opsuser/report.docx',
+            original_filename='report.docx',
+            uploaded_by=self.ops_user,
+            file_size=100,
+            file_type='docx'
+        )
+
+    def create_tokens(self, count, **kwargs):
+        DownloadToken.objects.bulk_create([
+            DownloadToken(token=generate_secure_token(), file=self.uploaded_file, user=self.client_user, **kwargs)
+            for _ in range(count)
+        ])
+
+    def test_cleanup_in_batches(self):
+        """Test that expired, no longer resumable and stale verification tokens are cleaned up in batches"""
+        now = timezone.now()
+        self.create_tokens(5, expires_at=now - timedelta(minutes=1))
+        self.create_tokens(2, expires_at=now + timedelta(days=7), is_used=True, used_at=now - timedelta(days=2))
+        resumed_until = now - timedelta(seconds=settings.DOWNLOAD_RESUME_WINDOW + 60)
+        self.create_tokens(1, expires_at=now + timedelta(minutes=30), is_used=True, used_at=resumed_until)
+        self.create_tokens(2, expires_at=now + timedelta(hours=1))
+        self.create_tokens(1, expires_at=now + timedelta(hours=1), is_used=True, used_at=now)
+        stale = User.objects.create_user(username='stale', password='x', user_type='client',
+                                         email_verification_token='stale-token')
+        User.objects.filter(pk=stale.pk).update(date_joined=now - timedelta(days=2))
+        fresh = User.objects.create_user(username='fresh', password='x', user_type='client',
+                                         email_verification_token='fresh-token')
+
+        out = StringIO()
+        call_command('cleanup_expired_tokens', '--dry-run', stdout=out)
+        self.assertIn('Would clean up 5 expired download tokens', out.getvalue())
+        self.assertIn('Would clean up 3 used download tokens', out.getvalue())
+        self.assertIn('Would clean up 1 stale email verification tokens', out.getvalue())
+        self.assertEqual(DownloadToken.objects.count(), 11)
+
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('cleanup_expired_tokens', '--batch-size', '2', '--sleep', '0', stdout=out)
+        self.assertIn('deleted 5 expired download tokens, 3 used download tokens', out.getvalue())
+        self.assertEqual(DownloadToken.objects.count(), 3)
+        self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('DELETE')]), 5)
+
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertIsNone(stale.email_verification_token)
+        self.assertEqual(fresh.email_verification_token, 'fresh-token')
+
+    def test_cleanup_removes_expired_upload_sessions(self):
+        """Test that expired upload sessions and orphaned chunk directories are removed with their chunks"""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        now = timezone.now()
+        with self.settings(MEDIA_ROOT=media_root):
+            sessions = [
+                UploadSession.objects.create(user=self.ops_user, filename='report.docx', file_size=10, chunk_size=5,
+                                             expires_at=expires_at)
+                for expires_at in (now - timedelta(minutes=1), now + timedelta(hours=1))
+            ]
+            for session in sessions:
+                os.makedirs(session.chunk_dir)
+                with open(session.chunk_path(0), 'wb') as f:
+                    f.write(b'chunk')
+            orphan = os.path.join(media_root, settings.CHUNKED_UPLOAD_DIR, str(uuid.uuid4()))
+            os.makedirs(orphan)
+            old = (now - timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS + 1)).timestamp()
+            os.utime(orphan, (old, old))
+
+            out = StringIO()
+            call_command('cleanup_expired_tokens', '--dry-run', stdout=out)
+            self.assertIn('Would clean up 1 expired upload sessions', out.getvalue())
+            self.assertIn('Would clean up 1 orphaned chunk directories', out.getvalue())
+
+            out = StringIO()
+            call_command('cleanup_expired_tokens', '--sleep', '0', stdout=out)
+            self.assertIn('removed 1 expired upload sessions and 1 orphaned chunk directories', out.getvalue())
+            self.assertEqual(list(UploadSession.objects.all()), sessions[1:])
+            self.assertFalse(os.path.exists(sessions[0].chunk_dir))
+            self.assertFalse(os.path.exists(orphan))
+            self.assertEqual(sessions[1].received_chunks(), [0])
+
+
+class CachedTokenAuthenticationTestCase(APITestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+        self.key, self.token = issue_auth_token(self.user)
+        self.request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Token {self.key}')
+
+    def authenticate(self):
+        return CachedTokenAuthentication().authenticate(self.request)
+
+    def test_repeat_requests_skip_the_database(self):
+        """Test that only the first authentication of a token queries the database"""
+        with self.assertNumQueries(1):
+            user, token = self.authenticate()
+        with self.assertNumQueries(0):
+            cached_user, cached_token = self.authenticate()
+        self.assertEqual(cached_user.pk, self.user.pk)
+        self.assertEqual(cached_token.pk, self.token.pk)
+        self.assertEqual(token_cache.stats(), {'hits': 1, 'shared_hits': 0, 'misses': 1, 'size': 1})
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.key}')
+        self.assertEqual(self.client.get(reverse('list_files')).status_code, status.HTTP_200_OK)
+        self.assertEqual(token_cache.stats()['hits'], 2)
+
+    def test_deactivated_user_is_invalidated(self):
+        """Test that deactivating a user drops their cached authentication"""
+        self.authenticate()
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_deleted_token_is_invalidated(self):
+        """Test that deleting a token drops its cached authentication"""
+        self.authenticate()
+        self.token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    @override_settings(AUTH_TOKEN_CACHE_TTL=0)
+    def test_entries_expire(self):
+        """Test that entries older than the TTL are looked up again"""
+        self.authenticate()
+        with self.assertNumQueries(1):
+            self.authenticate()
+
+    @override_settings(AUTH_TOKEN_CACHE_BACKEND='default')
+    def test_shared_cache_tier(self):
+        """Test that another worker's in-process miss is served from the shared cache"""
+        self.authenticate()
+        with token_cache.lock:
+            token_cache.entries.clear()
+        with self.assertNumQueries(0):
+            user, _ = self.authenticate()
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(token_cache.stats()['shared_hits'], 1)
+        self.token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    @override_settings(AUTH_TOKEN_CACHE_BACKEND='default')
+    def test_invalidation_in_another_worker(self):
+        """Test that deleting, rotating or deactivating in another worker stops this worker's cached copy"""
+        def delete():
+            self.token.delete()
+
+        def rotate():
+            client = self.client_class()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {self.key}')
+            self.assertEqual(client.post(reverse('rotate_token')).status_code, status.HTTP_200_OK)
+
+        def deactivate():
+            self.user.is_active = False
+            self.user.save()
+
+        for change in (delete, rotate, deactivate):
+            with self.subTest(change=change.__name__):
+                cache.clear()
+                token_cache.clear()
+                self.user.is_active = True
+                self.user.save()
+                self.key, self.token = issue_auth_token(self.user)
+                self.request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Token {self.key}')
+                self.authenticate()
+                # The signal handlers of the other worker only clear its own in-process tier
+                with mock.patch('file_sharing.signals.token_cache', TokenCache()):
+                    change()
+                with self.assertRaises(AuthenticationFailed):
+                    self.authenticate()
+
+    def test_local_tier_is_stale_in_other_workers_without_shared_cache(self):
+        """Test that without a shared tier another worker's invalidation waits for the TTL"""
+        self.authenticate()
+        with mock.patch('file_sharing.signals.token_cache', TokenCache()):
+            self.token.delete()
+        user, _ = self.authenticate()
+        self.assertEqual(user.pk, self.user.pk)
+        expires = max(expires for expires, _ in token_cache.entries.values())
+        with mock.patch('file_sharing.authentication.time.monotonic', return_value=expires + 1):
+            with self.assertRaises(AuthenticationFailed):
+                self.authenticate()
+
+
+class AuthTokenTestCase(APITestCase):
+    def setUp(self):
+        token_cache.clear()
+        local_buckets.clear()
+        self.user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+
+    def login(self):
+        response = self.client.post(reverse('user_login'), {'username': 'clientuser', 'password': 'testpass123'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['token']
+
+    def test_login_stores_only_the_key_hash(self):
+        """Test that login issues an expiring token stored as a hash"""
+        key = self.login()
+        token = AuthToken.objects.get(user=self.user)
+        self.assertEqual(token.key_hash, hash_token(key))
+        self.assertNotIn(key, token.key_hash)
+        self.assertGreater(token.expires_at, timezone.now())
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+        self.assertEqual(self.client.get(reverse('list_files')).status_code, status.HTTP_200_OK)
+
+    def test_expired_token_is_rejected(self):
+        """Test that expired tokens stop authenticating"""
+        key = self.login()
+        AuthToken.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+        response = self.client.get(reverse('list_files'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.data['detail'], 'Token has expired.')
+
+    @override_settings(AUTH_TOKEN_LIFETIME_HOURS=10, AUTH_TOKEN_SLIDING=True)
+    def test_sliding_refresh(self):
+        """Test that a token past half its lifetime is extended on use, and only then"""
+        key = self.login()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+        expires_at = AuthToken.objects.get().expires_at
+        self.client.get(reverse('list_files'))
+        self.assertEqual(AuthToken.objects.get().expires_at, expires_at)
+
+        token_cache.clear()
+        AuthToken.objects.update(expires_at=timezone.now() + timedelta(hours=2))
+        self.client.get(reverse('list_files'))
+        self.assertGreater(AuthToken.objects.get().expires_at, timezone.now() + timedelta(hours=9))
+
+    def test_rotate_token(self):
+        """Test that rotation replaces the token used for the request"""
+        key = self.login()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+        response = self.client.post(reverse('rotate_token'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        new_key = response.data['token']
+        self.assertNotEqual(new_key, key)
+        self.assertEqual(list(AuthToken.objects.values_list('key_hash', flat=True)), [hash_token(new_key)])
+
+        self.assertEqual(self.client.get(reverse('list_files')).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {new_key}')
+        self.assertEqual(self.client.get(reverse('list_files')).status_code, status.HTTP_200_OK)
+
+    @override_settings(AUTH_TOKEN_MAX_PER_USER=2)
+    def test_tokens_per_user_are_bounded(self):
+        """Test that logging in keeps only the newest tokens of a user"""
+        keys = [self.login() for _ in range(3)]
+        self.assertEqual(
+            set(AuthToken.objects.values_list('key_hash', flat=True)), {hash_token(key) for key in keys[1:]}
+        )
+
+    def test_cleanup_purges_expired_tokens(self):
+        """Test the bulk purge of expired login tokens"""
+        self.login()
+        self.login()
+        AuthToken.objects.filter(pk=AuthToken.objects.earliest('pk').pk).update(
+            expires_at=timezone.now() - timedelta(days=1)
+        )
+        out = StringIO()
+        call_command('cleanup_expired_tokens', stdout=out)
+        self.assertIn('1 expired login tokens', out.getvalue())
+        self.assertEqual(AuthToken.objects.count(), 1)
+
+
+class ThrottleTestCase(APITestCase):
+    def setUp(self):
+        local_buckets.clear()
+        self.ops_user = User.objects.create_user(username='opsuser', password='testpass123', user_type='ops')
+        self.client_user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+        self.uploaded_file = UploadedFile.objects.create(
+            file='uploads/opsuser/report.docx',
+            original_filename='report.docx',
+            uploaded_by=self.ops_user,
+            file_size=100,
+            file_type='docx'
+        )
+
+    def test_parse_rate(self):
+        """Test that DRF rates become a refill rate and burst capacity"""
+        self.assertEqual(parse_rate('120/min'), (2.0, 120))
+        self.assertEqual(parse_rate('5/hour'), (5 / 3600, 5))
+
+    @override_settings(THROTTLE_MAX_KEYS=3)
+    def test_local_buckets_evict_least_recently_used(self):
+        """Test that the local store drops its least recently used bucket once full"""
+        for key in ('a', 'b', 'c'):
+            local_buckets.take(key, 1 / 60, 1)
+        self.assertGreater(local_buckets.take('a', 1 / 60, 1), 0)
+        local_buckets.take('d', 1 / 60, 1)
+        self.assertEqual(list(local_buckets.buckets), ['c', 'a', 'd'])
+        # 'a' kept its empty bucket; the evicted 'b' starts full again
+        self.assertGreater(local_buckets.take('a', 1 / 60, 1), 0)
+        self.assertEqual(local_buckets.take('b', 1 / 60, 1), 0)
+        self.assertEqual(list(local_buckets.buckets), ['d', 'a', 'b'])
+
+    def test_link_generation_is_throttled_per_user(self):
+        """Test that link generation is limited per user with a Retry-After header"""
+        rates = dict(settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'], links='2/min')
+        with self.settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES=rates)):
+            self.client.force_authenticate(user=self.client_user)
+            url = reverse('download_file', args=[self.uploaded_file.id])
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertEqual(response['Retry-After'], '30')
+            # The second request reused the first link and the throttled one created nothing
+            self.assertEqual(DownloadToken.objects.count(), 1)
+
+            other = User.objects.create_user(username='other', password='x', user_type='client')
+            self.client.force_authenticate(user=other)
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+    def test_login_is_throttled_per_address(self):
+        """Test that anonymous endpoints are limited per client address"""
+        rates = dict(settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'], login='1/min')
+        with self.settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES=rates)):
+            data = {'username': 'clientuser', 'password': 'testpass123'}
+            self.assertEqual(self.client.post(reverse('user_login'), data).status_code, status.HTTP_200_OK)
+            response = self.client.post(reverse('user_login'), data)
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertIn('Retry-After', response)
+            self.assertEqual(
+                self.client.post(reverse('user_login'), data, REMOTE_ADDR='10.0.0.2').status_code,
+                status.HTTP_200_OK
+            )
+
+    @override_settings(THROTTLE_BACKEND='default')
+    def test_cache_backend(self):
+        """Test that buckets can live in a shared Django cache"""
+        cache.clear()
+        rates = dict(settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'], links='1/min')
+        with self.settings(REST_FRAMEWORK=dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES=rates)):
+            self.client.force_authenticate(user=self.client_user)
+            url = reverse('download_file', args=[self.uploaded_file.id])
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(local_buckets.buckets, {})
+
+
+class MetricsTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.metrics_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, METRICS_DIR=self.metrics_dir)
+        self.settings_override.enable()
+
+        self.ops_user = User.objects.create_user(username='opsuser', password='testpass123', user_type='ops')
+        self.client_user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+        self.uploaded_file = UploadedFile.objects.create(
+            file=SimpleUploadedFile('report.docx', b'x' * 2000),
+            original_filename='report.docx',
+            uploaded_by=self.ops_user,
+            file_size=2000,
+            file_type='docx'
+        )
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def scrape(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.content.decode()
+
+    def download_token(self):
+        return DownloadToken.objects.create(
+            token=generate_secure_token(),
+            file=self.uploaded_file,
+            user=self.client_user,
+            expires_at=timezone.now() + timedelta(hours=1)
+        ).token
+
+    def test_request_and_download_metrics(self):
+        """Test that latency, query counts, download bytes and token outcomes are exported"""
+        self.client.force_authenticate(user=self.client_user)
+        self.client.get(reverse('list_files'))
+        token = self.download_token()
+        response = self.client.get(reverse('secure_download', args=[token]))
+        self.assertEqual(b''.join(response.streaming_content), b'x' * 2000)
+        self.client.get(reverse('secure_download', args=[token]))
+        self.client.get(reverse('secure_download', args=['missing']))
+
+        body = self.scrape()
+        self.assertIn('http_request_duration_seconds_count{method="GET",status="200",view="list_files"} 1', body)
+        self.assertIn('http_request_db_queries_count{view="list_files"} 1', body)
+        self.assertIn('download_response_bytes_bucket{outcome="complete",status="200",le="65536"} 1', body)
+        self.assertIn('download_response_bytes_sum{outcome="complete",status="200"} 2000', body)
+        self.assertIn('download_token_validations_total{outcome="claimed"} 1', body)
+        self.assertIn('download_token_validations_total{outcome="used"} 1', body)
+        self.assertIn('download_token_validations_total{outcome="invalid"} 1', body)
+
+    @override_settings(DOWNLOAD_CHUNK_SIZE=1024)
+    def test_aborted_download_is_not_complete(self):
+        """Test that a transfer the client abandons records the bytes it got as aborted"""
+        response = self.client.get(reverse('secure_download', args=[self.download_token()]))
+        self.assertEqual(len(next(iter(response.streaming_content))), 1024)
+        response.close()
+
+        body = self.scrape()
+        self.assertIn('download_response_bytes_sum{outcome="aborted",status="200"} 1024', body)
+        self.assertNotIn('outcome="complete"', body)
+
+    def test_offloaded_download_counted_separately(self):
+        """Test that proxy offloaded downloads are counted without claiming their bytes"""
+        with self.settings(FILE_DELIVERY_BACKEND='x-accel-redirect'):
+            response = self.client.get(reverse('secure_download', args=[self.download_token()]))
+        self.assertTrue(response.has_header('X-Accel-Redirect'))
+
+        body = self.scrape()
+        self.assertIn('download_offloaded_total{status="200",via="x-accel-redirect"} 1', body)
+        self.assertNotIn('download_response_bytes_count', body)
+
+    @override_settings(DOWNLOAD_CHUNK_SIZE=1024)
+    def test_async_requests_record_queries_and_bytes(self):
+        """Test that the async middleware path records database work and streamed bytes"""
+        token = self.download_token()
+        url = reverse('secure_download', args=[token])
+
+        async def get_response(request):
+            request.resolver_match = resolve(url)
+            return await async_views.secure_download(request, token)
+
+        middleware = MetricsMiddleware(get_response)
+
+        async def download():
+            response = await middleware(AsyncRequestFactory().get(url))
+            return b''.join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(async_to_sync(download)(), b'x' * 2000)
+        body = self.scrape()
+        self.assertIn('download_response_bytes_sum{outcome="complete",status="200"} 2000', body)
+        self.assertRegex(body, r'http_request_db_queries_sum\{view="secure_download"\} [1-9]')
+
+    def test_samples_are_summed_across_processes(self):
+        """Test that files written by other worker processes are aggregated"""
+        metrics.inc('download_token_validations_total', outcome='claimed')
+        other = metrics.MetricsFile(os.path.join(self.metrics_dir, 'other-worker.db'))
+        other.add(metrics.sample_key('download_token_validations_total', {'outcome': 'claimed'}), 2)
+        self.assertIn('download_token_validations_total{outcome="claimed"} 3', self.scrape())
+
+    def test_metrics_file_grows(self):
+        """Test that the memory mapped file is extended as new series appear"""
+        path = os.path.join(self.metrics_dir, 'grow.db')
+        metrics_file = metrics.MetricsFile(path)
+        for i in range(3000):
+            metrics_file.add(f'series-{i}', i)
+        self.assertGreater(os.path.getsize(path), metrics.INITIAL_SIZE)
+        values = metrics.MetricsFile.read(path)
+        self.assertEqual(len(values), 3000)
+        self.assertEqual(values['series-2999'], 2999)
+
+    @override_settings(METRICS_AUTH_TOKEN='secret')
+    def test_metrics_token(self):
+        """Test that /metrics can require a bearer token"""
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ProfilingTestCase(APITestCase):
+    def setUp(self):
+        self.profiling_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            PROFILING_ENABLED=True, PROFILING_SECRET='let-me-profile', PROFILING_DIR=self.profiling_dir
+        )
+        self.settings_override.enable()
+        self.client_user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+        self.client.force_authenticate(user=self.client_user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.profiling_dir, ignore_errors=True)
+
+    def test_header_profiles_request(self):
+        """Test that the profiling header with the secret captures stats and SQL"""
+        response = self.client.get(reverse('list_files'), HTTP_X_PROFILE='let-me-profile')
+        profile = load_profile(response['X-Profile-Id'])
+        self.assertEqual(profile['view'], 'list_files')
+        self.assertEqual(profile['status'], 200)
+        self.assertTrue(profile['queries'])
+
+        out = StringIO()
+        call_command('profiles', response['X-Profile-Id'], stdout=out)
+        self.assertIn('Slowest queries:', out.getvalue())
+        self.assertIn('Top functions:', out.getvalue())
+
+    def test_saved_profile_is_redacted_and_private(self):
+        """Test that tokens, query strings and query parameters stay out of saved profiles"""
+        response = self.client.get(
+            reverse('secure_download', args=['secret-token-value']) + '?token=other-secret',
+            HTTP_X_PROFILE='let-me-profile'
+        )
+        profile_id = response['X-Profile-Id']
+        profile = load_profile(profile_id)
+        self.assertEqual(profile['path'], '/api/secure-download/<token>/')
+        self.assertTrue(profile['queries'])
+        saved = json.dumps(profile)
+        self.assertNotIn('secret-token-value', saved)
+        self.assertNotIn('other-secret', saved)
+        self.assertEqual(profile['queries'][0]['params'], ['str'])
+
+        self.assertEqual(os.stat(self.profiling_dir).st_mode & 0o777, 0o700)
+        profile_dir = os.path.join(self.profiling_dir, profile_id)
+        self.assertEqual(os.stat(profile_dir).st_mode & 0o777, 0o700)
+        for name in os.listdir(profile_dir):
+            self.assertEqual(os.stat(os.path.join(profile_dir, name)).st_mode & 0o777, 0o600)
+
+    def test_wrong_secret_or_no_header_is_not_profiled(self):
+        """Test that requests are only profiled when asked for correctly"""
+        self.assertNotIn('X-Profile-Id', self.client.get(reverse('list_files'), HTTP_X_PROFILE='guess'))
+        self.assertNotIn('X-Profile-Id', self.client.get(reverse('list_files')))
+        self.assertEqual(list_profiles(), [])
+
+    @override_settings(PROFILING_SAMPLE_RATE=1.0, PROFILING_MAX_PROFILES=2)
+    def test_sampling_and_rotation(self):
+        """Test that sampled profiles are kept up to the configured maximum"""
+        ids = [self.client.get(reverse('list_files'))['X-Profile-Id'] for _ in range(3)]
+        self.assertEqual(list_profiles(), sorted(ids)[1:])
+
+        out = StringIO()
+        call_command('profiles', stdout=out)
+        self.assertEqual(out.getvalue().count('/api/files/'), 2)
+
+    def test_duplicate_queries_flag_n_plus_one(self):
+        """Test that queries differing only in literals are grouped as duplicates"""
+        queries = [
+            {'sql': f'SELECT * FROM "file_sharing_user" WHERE "id" = {pk}', 'ms': 1.0} for pk in range(3)
+        ] + [{'sql': 'SELECT COUNT(*) FROM "file_sharing_uploadedfile"', 'ms': 2.0}]
+        self.assertEqual(duplicate_queries(queries), [
+            {'sql': 'SELECT * FROM "file_sharing_user" WHERE "id" = ?', 'count': 3, 'ms': 3.0}
+        ])
+
+
+class DownloadLinksTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.ops_user = User.objects.create_user(username='opsuser', password='testpass123', user_type='ops')
+        self.client_user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+        local_buckets.clear()
+        self.files = [
+            UploadedFile.objects.create(
+                file=SimpleUploadedFile(f'report{i}.docx', f'report {i}'.encode()),
+                original_filename=f'report{i}.docx',
+                uploaded_by=self.ops_user,
+                file_size=8,
+                file_type='docx'
+            )
+            for i in range(3)
+        ]
+        self.client.force_authenticate(user=self.client_user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def single_link(self, uploaded_file):
+        response = self.client.get(reverse('download_file', args=[uploaded_file.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['download_link']
+
+    def test_bulk_links_use_one_insert(self):
+        """Test that links for many files are created with a single INSERT and each redeems its own file"""
+        file_ids = [str(f.id) for f in self.files]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('download_links'), {'file_ids': file_ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(DownloadToken.objects.count(), 3)
+
+        links = response.data['links']
+        self.assertEqual([str(link['file_id']) for link in links], file_ids)
+        for i, link in enumerate(links):
+            download = self.client.get(link['download_link'])
+            self.assertEqual(download.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(download.streaming_content), f'report {i}'.encode())
+
+    def test_unused_link_is_reused(self):
+        """Test that a client asking again for a file gets its unused link back until it is redeemed"""
+        first = self.single_link(self.files[0])
+        self.assertEqual(self.single_link(self.files[0]), first)
+        self.assertEqual(DownloadToken.objects.count(), 1)
+
+        # Reused in bulk too; only the other files get new rows
+        response = self.client.post(
+            reverse('download_links'), {'file_ids': [str(f.id) for f in self.files]}, format='json'
+        )
+        self.assertEqual(response.data['links'][0]['download_link'], first)
+        self.assertEqual(DownloadToken.objects.count(), 3)
+
+        self.client.get(first)
+        self.assertNotEqual(self.single_link(self.files[0]), first)
+
+        other = User.objects.create_user(username='other', password='x', user_type='client')
+        self.client.force_authenticate(user=other)
+        self.assertNotEqual(self.single_link(self.files[1]), response.data['links'][1]['download_link'])
+
+    def test_links_close_to_expiry_are_not_reused(self):
+        """Test that reuse is skipped for links about to expire, and when disabled"""
+        first = self.single_link(self.files[0])
+        DownloadToken.objects.update(expires_at=timezone.now() + timedelta(seconds=60))
+        self.assertNotEqual(self.single_link(self.files[0]), first)
+
+        with override_settings(DOWNLOAD_TOKEN_REUSE=False):
+            second = self.single_link(self.files[0])
+            self.assertNotEqual(self.single_link(self.files[0]), second)
+        self.assertEqual(DownloadToken.objects.count(), 4)
+
+    def test_bulk_links_rejects_missing_files(self):
+        """Test that unknown and failed files are reported without creating any links"""
+        missing = '00000000-0000-0000-0000-000000000000'
+        response = self.client.post(
+            reverse('download_links'), {'file_ids': [str(self.files[0].id), missing]}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data['missing'], [missing])
+
+        UploadedFile.objects.filter(id=self.files[1].id).update(processing_status='failed')
+        response = self.client.post(reverse('download_links'), {'file_ids': [str(self.files[1].id)]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertFalse(DownloadToken.objects.exists())
+
+        self.client.force_authenticate(user=self.ops_user)
+        response = self.client.post(reverse('download_links'), {'file_ids': [str(self.files[0].id)]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+class BatchDownloadTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.ops_user = User.objects.create_user(username='opsuser', password='testpass123', user_type='ops')
+        self.client_user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+        local_buckets.clear()
+        self.files = [
+            self.create_file('report.docx', b'report ' * 1000),
+            self.create_file('report.docx', b'other report ' * 1000),
+            self.create_file('budget.xlsx', b'budget ' * 1000),
+        ]
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def create_file(self, filename, content):
+        return UploadedFile.objects.create(
+            file=SimpleUploadedFile(filename, content),
+            original_filename=filename,
+            uploaded_by=self.ops_user,
+            file_size=len(content),
+            file_type=filename.rsplit('.', 1)[-1]
+        )
+
+    def request_link(self, file_ids, user=None):
+        self.client.force_authenticate(user=user or self.client_user)
+        response = self.client.post(reverse('download_batch'), {'file_ids': file_ids}, format='json')
+        self.client.force_authenticate(user=None)
+        return response
+
+    def test_batch_download_streams_zip(self):
+        """Test that one link streams every file as a stored ZIP entry, once"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.request_link([str(f.id) for f in self.files])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['file_count'], 3)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "file_sharing_')]
+        self.assertEqual(len(inserts), 2)
+
+        token = response.data['download_link'].rstrip('/').rsplit('/', 1)[-1]
+        response = self.client.get(reverse('secure_download_batch', args=[token]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertFalse(response.has_header('Content-Length'))
+
+        with zipfile.ZipFile(SimpleUploadedFile('files.zip', b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.namelist(), ['budget.xlsx', 'report.docx', 'report (2).docx'])
+            self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist()))
+            self.assertEqual(archive.read('budget.xlsx'), b'budget ' * 1000)
+            self.assertCountEqual(
+                [archive.read('report.docx'), archive.read('report (2).docx')],
+                [b'report ' * 1000, b'other report ' * 1000],
+            )
+
+        response = self.client.get(reverse('secure_download_batch', args=[token]))
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+    def test_batch_link_validation(self):
+        """Test that only clients can request batches of existing files within the limit"""
+        self.assertEqual(self.request_link([str(self.files[0].id)], self.ops_user).status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.request_link([]).status_code, status.HTTP_400_BAD_REQUEST)
+
+        missing = '00000000-0000-0000-0000-000000000000'
+        response = self.request_link([str(self.files[0].id), missing])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.data['missing'], [missing])
+
+        with override_settings(BATCH_DOWNLOAD_MAX_FILES=2):
+            self.assertEqual(self.request_link([str(f.id) for f in self.files]).status_code, status.HTTP_400_BAD_REQUEST)
+            # Repeated ids count once
+            response = self.request_link([str(self.files[0].id)] * 3 + [str(self.files[1].id)])
+            self.assertEqual(response.data['file_count'], 2)
+        self.assertEqual(BatchDownloadToken.objects.count(), 1)
+
+    def test_expired_batch_link(self):
+        """Test that expired batch links are refused and purged by cleanup"""
+        response = self.request_link([str(f.id) for f in self.files])
+        BatchDownloadToken.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        token = response.data['download_link'].rstrip('/').rsplit('/', 1)[-1]
+        response = self.client.get(reverse('secure_download_batch', args=[token]))
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+        call_command('cleanup_expired_tokens', '--sleep', '0', stdout=StringIO())
+        self.assertFalse(BatchDownloadToken.objects.exists())
+        self.assertFalse(BatchDownloadToken.files.through.objects.exists())
+        self.assertEqual(UploadedFile.objects.count(), 3)
+
+    def test_archive_streams_in_bounded_chunks(self):
+        """Test that a large archive is produced in chunks no bigger than the read size"""
+        path = os.path.join(self.media_root, 'large.pptx')
+        make_sparse_file(path, 8 * 1024 * 1024)
+        opener = functools.partial(open, path, 'rb')
+        chunks = zip_stream([(opener, 'large.pptx', 'pptx', 8 * 1024 * 1024, timezone.now())], 64 * 1024)
+        sizes = [len(chunk) for chunk in chunks]
+        self.assertGreater(len(sizes), 100)
+        self.assertLessEqual(max(sizes), 64 * 1024 + 1024)
+
+    def test_archive_names(self):
+        """Test that repeated names are numbered case-insensitively"""
+        self.assertEqual(
+            archive_names(['a.docx', 'A.docx', 'a.docx', 'b.xlsx']),
+            ['a.docx', 'A (2).docx', 'a (3).docx', 'b.xlsx'],
+        )
+
+    async def test_async_batch_download(self):
+        """Test that the async view streams the archive from an async iterator"""
+        response = await sync_to_async(self.request_link)([str(f.id) for f in self.files])
+        token = response.data['download_link'].rstrip('/').rsplit('/', 1)[-1]
+
+        response = await async_views.secure_download_batch(AsyncRequestFactory().get('/'), token)
+        self.assertTrue(response.is_async)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        with zipfile.ZipFile(SimpleUploadedFile('files.zip', body)) as archive:
+            self.assertEqual(len(archive.namelist()), 3)
+
+        response = await async_views.secure_download_batch(AsyncRequestFactory().get('/'), token)
+        self.assertEqual(response.status_code, 410)
+
+
+class StorageCompressionTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.ops_user = User.objects.create_user(username='opsuser', password='testpass123', user_type='ops')
+        self.client_user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+        local_buckets.clear()
+        self.content = b'quarterly report line\n' * 5000
+        self.compressible = self.create_file('report.docx', self.content)
+        self.incompressible = self.create_file('photos.pptx', os.urandom(20000))
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def create_file(self, filename, content):
+        return UploadedFile.objects.create(
+            file=SimpleUploadedFile(filename, content),
+            original_filename=filename,
+            uploaded_by=self.ops_user,
+            file_size=len(content),
+            file_type=filename.rsplit('.', 1)[-1]
+        )
+
+    def download(self, **headers):
+        download_token = DownloadToken.objects.create(
+            token=generate_secure_token(), file=self.compressible, user=self.client_user,
+            expires_at=timezone.now() + timedelta(hours=1)
+        )
+        return self.client.get(reverse('secure_download', args=[download_token.token]), **headers)
+
+    def test_compresses_only_when_it_saves_space(self):
+        """Test that compressible blobs are replaced by a variant and others are kept as they are"""
+        out = StringIO()
+        call_command('compress_files', stdout=out)
+        self.assertIn('Successfully compressed 1 files with gzip (1 did not compress enough', out.getvalue())
+
+        self.compressible.refresh_from_db()
+        self.incompressible.refresh_from_db()
+        self.assertEqual(self.compressible.stored_encoding, 'gzip')
+        self.assertEqual(self.incompressible.stored_encoding, 'identity')
+        self.assertFalse(file_storage.exists(self.compressible.file.name))
+        path, encoding = stored_file(self.compressible)
+        self.assertEqual((path, encoding), (file_storage.path(self.compressible.file.name + '.gz'), 'gzip'))
+        self.assertLess(os.path.getsize(path), len(self.content) // 10)
+        self.assertEqual(stored_file(self.incompressible), (self.incompressible.file.path, None))
+
+        # A later upload of the same content shares the variant
+        duplicate = self.create_file('report-copy.docx', self.content)
+        call_command('compress_files', stdout=StringIO())
+        duplicate.refresh_from_db()
+        self.assertEqual(duplicate.stored_encoding, 'gzip')
+        self.assertFalse(file_storage.exists(duplicate.file.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.compressible.delete()
+            duplicate.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_serves_stored_variant_to_accepting_clients(self):
+        """Test that clients accepting the encoding receive the compressed bytes"""
+        call_command('compress_files', stdout=StringIO())
+        response = self.download(HTTP_ACCEPT_ENCODING='br, gzip;q=0.8')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        body = b''.join(response.streaming_content)
+        self.assertEqual(response['Content-Length'], str(len(body)))
+        self.assertEqual(gzip.decompress(body), self.content)
+
+    def test_decompresses_for_other_clients(self):
+        """Test that clients without the encoding get the original bytes as a stream"""
+        call_command('compress_files', stdout=StringIO())
+        response = self.download(HTTP_ACCEPT_ENCODING='gzip;q=0, identity', HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Accept-Ranges'], 'none')
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    async def test_async_download_decompresses(self):
+        """Test that the async view decompresses from an async iterator"""
+        await sync_to_async(call_command)('compress_files', stdout=StringIO())
+        download_token = await DownloadToken.objects.acreate(
+            token=generate_secure_token(), file=self.compressible, user=self.client_user,
+            expires_at=timezone.now() + timedelta(hours=1)
+        )
+        response = await async_views.secure_download(AsyncRequestFactory().get('/'), download_token.token)
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), self.content)
+
+    def test_batch_archive_holds_original_bytes(self):
+        """Test that compressed files go into batch archives decompressed"""
+        call_command('compress_files', stdout=StringIO())
+        self.client.force_authenticate(user=self.client_user)
+        response = self.client.post(reverse('download_batch'), {'file_ids': [str(self.compressible.id)]}, format='json')
+        token = response.data['download_link'].rstrip('/').rsplit('/', 1)[-1]
+        response = self.client.get(reverse('secure_download_batch', args=[token]))
+        with zipfile.ZipFile(SimpleUploadedFile('files.zip', b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.read('report.docx'), self.content)
+
+    def test_accept_encoding_parsing(self):
+        """Test that q-values and wildcards are honoured"""
+        request = APIRequestFactory().get('/', HTTP_ACCEPT_ENCODING='deflate, *;q=0.5')
+        self.assertTrue(accepts_encoding(request, 'gzip'))
+        request = APIRequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip;q=0, *')
+        self.assertFalse(accepts_encoding(request, 'gzip'))
+        self.assertFalse(accepts_encoding(APIRequestFactory().get('/'), 'gzip'))
+
+    @unittest.skipUnless(zstandard, 'zstandard is not installed')
+    def test_zstd(self):
+        """Test compressing with zstd and decompressing on the fly"""
+        call_command('compress_files', '--encoding', 'zstd', stdout=StringIO())
+        self.compressible.refresh_from_db()
+        self.assertEqual(self.compressible.stored_encoding, 'zstd')
+        response = self.download()
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_report(self):
+        """Test that the report lists compression ratios per file type"""
+        out = StringIO()
+        call_command('compress_files', '--report', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertIn('gzip ratio', lines[0])
+        self.assertTrue(any(line.split()[0] == 'docx' for line in lines[1:]))
+        self.assertTrue(any(line.split()[0] == 'pptx' for line in lines[1:]))
+
+
+def make_package(file_type, main_part='xl/workbook.xml', main_xml='<workbook/>', extra=None):
+    """Build an Office Open XML package with docProps and the given main part"""
+    buffer = tempfile.SpooledTemporaryFile()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as package:
+        package.writestr('[Content_Types].xml', (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            f'<Override PartName="/{main_part}" ContentType="{MAIN_CONTENT_TYPES[file_type]}"/></Types>'
+        ))
+        package.writestr(main_part, main_xml)
+        package.writestr('docProps/core.xml', (
+            '<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Budget</dc:title>'
+            '<dc:creator>Finance</dc:creator></cp:coreProperties>'
+        ))
+        package.writestr('docProps/app.xml', (
+            '<Properties xmlns="http://schemas.openxmlformats.org/officeDocument/2006/extended-properties">'
+            '<Application>Microsoft Excel</Application></Properties>'
+        ))
+        for name, data in (extra or {}).items():
+            package.writestr(name, data)
+    buffer.seek(0)
+    return buffer.read()
+
+
+WORKBOOK_XML = (
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheets>'
+    '<sheet name="Q1"/><sheet name="Q2"/><sheet name="Q3"/></sheets></workbook>'
+)
+
+
+class UploadProcessingTestCase(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.ops_user = User.objects.create_user(username='opsuser', password='testpass123', user_type='ops')
+        self.client_user = User.objects.create_user(
+            username='clientuser', password='testpass123', user_type='client', is_email_verified=True
+        )
+        local_buckets.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def upload(self, filename, content):
+        self.client.force_authenticate(user=self.ops_user)
+        response = self.client.post(
+            reverse('upload_file'), {'file': SimpleUploadedFile(filename, content)}, format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response
+
+    def process(self, filename, content):
+        """Upload a file, run the queue inline and return the file"""
+        response = self.upload(filename, content)
+        process_pending(workers=1)
+        return UploadedFile.objects.get(id=response.data['file_id'])
+
+    def test_upload_is_pending_until_processed(self):
+        """Test that uploads return at once and the worker extracts metadata later"""
+        response = self.upload('budget.xlsx', make_package('xlsx', main_xml=WORKBOOK_XML))
+        self.assertEqual(response.data['processing_status'], 'pending')
+        self.assertTrue(response.data['status_url'].endswith(f"/api/files/{response.data['file_id']}/status/"))
+        self.assertEqual(ProcessingJob.objects.count(), 1)
+
+        out = StringIO()
+        call_command('process_uploads', '--workers', '1', stdout=out)
+        self.assertIn('Successfully processed 1 uploads', out.getvalue())
+        self.assertFalse(ProcessingJob.objects.exists())
+
+        self.client.force_authenticate(user=self.client_user)
+        response = self.client.get(reverse('file_status', args=[response.data['file_id']]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['processing_status'], 'ready')
+        self.assertEqual(response.data['metadata'], {
+            'title': 'Budget', 'creator': 'Finance', 'application': 'Microsoft Excel', 'sheets': 3
+        })
+        self.assertIsNotNone(response.data['processed_at'])
+
+    def test_invalid_packages_fail(self):
+        """Test that content not matching its extension is marked failed with a reason"""
+        cases = {
+            'notzip.docx': (b'file_content', 'Not a zip package'),
+            'wrongtype.docx': (make_package('xlsx'), 'Package is not a .docx document'),
+            'missing.xlsx': (make_package('xlsx', main_part='xl/workbook.xml').replace(
+                b'xl/workbook.xml', b'xl/workbook.xmz'), 'is missing'),
+            'escape.xlsx': (make_package('xlsx', extra={'../evil.txt': 'x'}), 'escapes the package'),
+        }
+        for filename, (content, error) in cases.items():
+            uploaded_file = self.process(filename, content)
+            self.assertEqual(uploaded_file.processing_status, 'failed', filename)
+            self.assertIn(error, uploaded_file.processing_error)
+        self.assertFalse(ProcessingJob.objects.exists())
+
+    @override_settings(PROCESSING_MAX_UNCOMPRESSED_SIZE=1024)
+    def test_zip_bomb_rejected_before_inflating(self):
+        """Test that the declared uncompressed size is limited"""
+        uploaded_file = self.process('bomb.xlsx', make_package('xlsx', extra={'padding.xml': '0' * 100000}))
+        self.assertEqual(uploaded_file.processing_status, 'failed')
+        self.assertIn('expands beyond', uploaded_file.processing_error)
+
+    def test_links_refused_for_failed_files(self):
+        """Test that failed files cannot be downloaded, singly or in a batch"""
+        failed = self.process('broken.docx', b'file_content')
+        self.client.force_authenticate(user=self.client_user)
+        response = self.client.get(reverse('download_file', args=[failed.id]))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.client.post(reverse('download_batch'), {'file_ids': [str(failed.id)]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['failed'], [str(failed.id)])
+
+    def test_duplicate_content_reuses_results(self):
+        """Test that re-uploading processed content is ready without a job"""
+        content = make_package('xlsx', main_xml=WORKBOOK_XML)
+        first = self.process('budget.xlsx', content)
+        response = self.upload('budget copy.xlsx', content)
+        self.assertEqual(response.data['processing_status'], 'ready')
+        self.assertFalse(ProcessingJob.objects.exists())
+        self.assertEqual(UploadedFile.objects.get(id=response.data['file_id']).metadata, first.metadata)
+
+    @override_settings(PROCESSING_MAX_ATTEMPTS=2)
+    def test_transient_errors_retry(self):
+        """Test that unexpected errors are retried with backoff before the file is failed"""
+        response = self.upload('budget.xlsx', make_package('xlsx'))
+        uploaded_file = UploadedFile.objects.get(id=response.data['file_id'])
+        os.remove(uploaded_file.file.path)
+
+        self.assertEqual(process_pending(workers=1), {'processed': 0, 'retried': 1, 'failed': 0})
+        job = ProcessingJob.objects.get()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn('FileNotFoundError', job.last_error)
+        self.assertGreater(job.next_attempt_at, timezone.now())
+
+        ProcessingJob.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(process_pending(workers=1), {'processed': 0, 'retried': 0, 'failed': 1})
+        self.assertEqual(ProcessingJob.objects.get().status, 'failed')
+        uploaded_file.refresh_from_db()
+        self.assertEqual(uploaded_file.processing_status, 'failed')
+
+    @override_settings(PROCESSING_ENABLED=False)
+    def test_disabled(self):
+        """Test that uploads are ready at once when processing is disabled"""
+        response = self.upload('budget.xlsx', b'file_content')
+        self.assertEqual(response.data['processing_status'], 'ready')
+        self.assertFalse(ProcessingJob.objects.exists())
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+import threading
+import time
+
+
+def refill(state, rate, capacity, now):
+    """Take one token from a bucket state and return the new state and the seconds to wait"""
+    tokens, stamp = state[:2] if state is not None else (capacity, now)
+    tokens = min(capacity, tokens + (now - stamp) * rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0.0
+    return (tokens, now), (1 - tokens) / rate
+
+
+class LocalBuckets:
+    """Token buckets held in this process, least recently used first"""
+
+    # Past THROTTLE_MAX_KEYS the least recently used bucket is dropped, in constant
+    # time; at the default size it has long been idle and would be full again anyway
+
+    def __init__(self):
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, capacity):
+        now = time.monotonic()
+        with self.lock:
+            state, wait = refill(self.buckets.get(key), rate, capacity, now)
+            self.buckets[key] = state
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > settings.THROTTLE_MAX_KEYS:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class CacheBuckets:
+    """Token buckets in a Django cache shared by all workers"""
+
+    # Reads and writes are not atomic, so bursts racing across workers may
+    # exceed the rate slightly
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def take(self, key, rate, capacity):
+        # time.time() rather than monotonic since workers compare timestamps
+        state, wait = refill(self.cache.get(key), rate, capacity, time.time())
+        self.cache.set(key, state, int(capacity / rate) + 1)
+        return wait
+
+
+local_buckets = LocalBuckets()
+
+
+def bucket_backend():
+    """Return the bucket store for THROTTLE_BACKEND: 'local' or a cache alias"""
+    if settings.THROTTLE_BACKEND == 'local':
+        return local_buckets
+    return CacheBuckets(settings.THROTTLE_BACKEND)
+
+
+def parse_rate(rate):
+    """Parse a DRF rate such as 10/min into (tokens per second, bucket capacity)"""
+    num_requests, duration = SimpleRateThrottle.parse_rate(None, rate)
+    return num_requests / duration, num_requests
+
+
+def throttle_wait(scope, ident):
+    """Take a token for ident from the scope's bucket and return the seconds to wait, 0 if allowed"""
+    rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope)
+    if rate is None:
+        return 0.0
+    per_second, capacity = parse_rate(rate)
+    return bucket_backend().take(f'throttle:{scope}:{ident}', per_second, capacity)
+
+
+class TokenBucketThrottle(SimpleRateThrottle):
+    """DRF throttle allowing bursts of the scope's request count, refilled at its rate"""
+
+    def __init__(self):
+        # Rates are looked up on each request by throttle_wait
+        self.wait_seconds = 0.0
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            return f'user-{request.user.pk}'
+        return f'ip-{self.get_ident(request)}'
+
+    def allow_request(self, request, view):
+        self.wait_seconds = throttle_wait(self.scope, self.get_cache_key(request, view))
+        return self.wait_seconds == 0
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class UploadThrottle(TokenBucketThrottle):
+    scope = 'uploads'
+
+
+class LinkThrottle(TokenBucketThrottle):
+    scope = 'links'
+
+
+class LoginThrottle(TokenBucketThrottle):
+    scope = 'login'
+
+
+class SignupThrottle(TokenBucketThrottle):
+    scope = 'signup'
@@ -0,0 +1,222 @@
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.utils import timezone
+import json
+import secrets
+import time
+
+from .models import DownloadToken, UploadedFile
+from .utils import decrypt_data, encrypt_data, generate_secure_token
+
+TOKEN_MODES = ['db', 'signed', 'encrypted']
+SIGNED_PREFIX = 's.'
+ENCRYPTED_PREFIX = 'e.'
+SIGNING_SALT = 'file_sharing.download'
+REPLAY_KEY_PREFIX = 'download-nonce:'
+# Cache backends that keep entries in each worker's own memory, or nowhere
+# Backends that cannot make a nonce single use across workers: per-process ones, and the
+# file cache, whose add checks and writes the file without any lock between processes
+UNSHARED_CACHE_BACKENDS = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.filebased.FileBasedCache',
+}
+
+
+class InvalidDownloadToken(Exception):
+    """Raised when a download token is unknown, malformed or has a bad signature"""
+
+
+class StatelessDownloadToken:
+    """A download token carried entirely in the link, redeemed through the replay cache"""
+
+    def __init__(self, file, user_id, expires_at, nonce):
+        self.file = file
+        self.user_id = user_id
+        self.expires_at = expires_at
+        self.nonce = nonce
+
+    def is_expired(self):
+        return timezone.now() > self.expires_at
+
+    def claim(self, etag):
+        """Record the nonce as used; only the first redemption succeeds"""
+        timeout = max(1, int((self.expires_at - timezone.now()).total_seconds()) + 1)
+        return replay_cache().add(REPLAY_KEY_PREFIX + self.nonce, (etag, time.time()), timeout)
+
+    def can_resume(self, etag):
+        return self._resumable(replay_cache().get(REPLAY_KEY_PREFIX + self.nonce), etag)
+
+    async def aclaim(self, etag):
+        timeout = max(1, int((self.expires_at - timezone.now()).total_seconds()) + 1)
+        return await replay_cache().aadd(REPLAY_KEY_PREFIX + self.nonce, (etag, time.time()), timeout)
+
+    async def acan_resume(self, etag):
+        return self._resumable(await replay_cache().aget(REPLAY_KEY_PREFIX + self.nonce), etag)
+
+    @staticmethod
+    def _resumable(claimed, etag):
+        # The cache holds the ETag and time of the first redemption, like DownloadToken.etag and used_at
+        # Entries written before the claim time was recorded hold the bare ETag and no longer resume
+        if not isinstance(claimed, tuple):
+            return False
+        claimed_etag, used_at = claimed
+        return claimed_etag == etag and time.time() <= used_at + settings.DOWNLOAD_RESUME_WINDOW
+
+
+def replay_cache_problem():
+    """Why DOWNLOAD_REPLAY_CACHE cannot enforce single use across workers, or None"""
+    alias = settings.DOWNLOAD_REPLAY_CACHE
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    if backend is None:
+        return f'DOWNLOAD_REPLAY_CACHE {alias!r} is not a configured cache'
+    if backend in UNSHARED_CACHE_BACKENDS:
+        # Every worker, or every racing request, could accept a stateless link once
+        return (
+            f'Stateless download tokens need DOWNLOAD_REPLAY_CACHE {alias!r} to be shared by all workers '
+            f'with an atomic add, not {backend.rsplit(".", 1)[-1]}'
+        )
+    return None
+
+
+def replay_cache():
+    # Single use is only enforced across workers when this cache is shared
+    problem = replay_cache_problem()
+    if problem:
+        raise ImproperlyConfigured(problem)
+    return caches[settings.DOWNLOAD_REPLAY_CACHE]
+
+
+def token_mode():
+    mode = settings.DOWNLOAD_TOKEN_MODE.lower()
+    if mode not in TOKEN_MODES:
+        raise ImproperlyConfigured(f'DOWNLOAD_TOKEN_MODE must be one of {", ".join(TOKEN_MODES)}, got {mode!r}')
+    return mode
+
+
+def issue_download_token(uploaded_file, user, expires_at):
+    """Create a download token for the configured DOWNLOAD_TOKEN_MODE"""
+    mode = token_mode()
+    if mode == 'db':
+        token = generate_secure_token()
+        DownloadToken.objects.create(token=token, file=uploaded_file, user=user, expires_at=expires_at)
+        return token
+    return _stateless_download_token(uploaded_file, user, expires_at, mode)
+
+
+def reusable_tokens_query(user, file_ids):
+    # Served by the partial downloadtoken_active_idx; a link is only handed out again
+    # while it has DOWNLOAD_TOKEN_REUSE_MIN_SECONDS left, so clients have time to use it
+    cutoff = timezone.now() + timedelta(seconds=settings.DOWNLOAD_TOKEN_REUSE_MIN_SECONDS)
+    return (
+        DownloadToken.objects.filter(user=user, file_id__in=file_ids, is_used=False, expires_at__gt=cutoff)
+        .order_by('expires_at').values_list('file_id', 'token', 'expires_at')
+    )
+
+
+def issue_download_tokens(files, user, expires_at, reuse=None):
+    """Download tokens for several files with at most one lookup and one insert; returns {file id: (token, expires_at)}"""
+    mode = token_mode()
+    if mode != 'db':
+        return {f.id: (_stateless_download_token(f, user, expires_at, mode), expires_at) for f in files}
+
+    issued = {}
+    if settings.DOWNLOAD_TOKEN_REUSE if reuse is None else reuse:
+        # The latest expiring active token of each file wins
+        for file_id, token, token_expires_at in reusable_tokens_query(user, [f.id for f in files]):
+            issued[file_id] = (token, token_expires_at)
+    created = [
+        DownloadToken(token=generate_secure_token(), file=f, user=user, expires_at=expires_at)
+        for f in files if f.id not in issued
+    ]
+    DownloadToken.objects.bulk_create(created)
+    issued.update((download_token.file_id, (download_token.token, expires_at)) for download_token in created)
+    return issued
+
+
+async def aissue_download_tokens(files, user, expires_at, reuse=None):
+    """Async version of issue_download_tokens"""
+    mode = token_mode()
+    if mode != 'db':
+        return {f.id: (_stateless_download_token(f, user, expires_at, mode), expires_at) for f in files}
+
+    issued = {}
+    if settings.DOWNLOAD_TOKEN_REUSE if reuse is None else reuse:
+        async for file_id, token, token_expires_at in reusable_tokens_query(user, [f.id for f in files]):
+            issued[file_id] = (token, token_expires_at)
+    created = [
+        DownloadToken(token=generate_secure_token(), file=f, user=user, expires_at=expires_at)
+        for f in files if f.id not in issued
+    ]
+    await DownloadToken.objects.abulk_create(created)
+    issued.update((download_token.file_id, (download_token.token, expires_at)) for download_token in created)
+    return issued
+
+
+def _stateless_download_token(uploaded_file, user, expires_at, mode):
+    payload = {
+        'f': uploaded_file.id.hex,
+        'u': user.id,
+        'e': int(expires_at.timestamp()),
+        'n': secrets.token_urlsafe(9),
+    }
+    if mode == 'signed':
+        return SIGNED_PREFIX + signing.dumps(payload, salt=SIGNING_SALT, compress=True)
+    return ENCRYPTED_PREFIX + encrypt_data(json.dumps(payload, separators=(',', ':')))
+
+
+def resolve_download_token(token):
+    """Look up or verify a download token of any mode"""
+    payload = _stateless_payload(token)
+    if payload is None:
+        try:
+            return DownloadToken.objects.select_related('file').get(token=token)
+        except DownloadToken.DoesNotExist:
+            raise InvalidDownloadToken(token)
+
+    try:
+        uploaded_file = UploadedFile.objects.get(id=payload['f'])
+    except UploadedFile.DoesNotExist:
+        raise InvalidDownloadToken(payload['f'])
+    return _stateless_token(uploaded_file, payload)
+
+
+async def aresolve_download_token(token):
+    """Async version of resolve_download_token"""
+    payload = _stateless_payload(token)
+    if payload is None:
+        try:
+            return await DownloadToken.objects.select_related('file').aget(token=token)
+        except DownloadToken.DoesNotExist:
+            raise InvalidDownloadToken(token)
+
+    try:
+        uploaded_file = await UploadedFile.objects.aget(id=payload['f'])
+    except UploadedFile.DoesNotExist:
+        raise InvalidDownloadToken(payload['f'])
+    return _stateless_token(uploaded_file, payload)
+
+
+def _stateless_payload(token):
+    """Verify and decode a signed or encrypted token, or return None for a db token"""
+    if token.startswith(SIGNED_PREFIX):
+        try:
+            return signing.loads(token[len(SIGNED_PREFIX):], salt=SIGNING_SALT)
+        except signing.BadSignature:
+            raise InvalidDownloadToken(token)
+
+    if token.startswith(ENCRYPTED_PREFIX):
+        decrypted = decrypt_data(token[len(ENCRYPTED_PREFIX):])
+        if decrypted is None:
+            raise InvalidDownloadToken(token)
+        return json.loads(decrypted)
+
+    return None
+
+
+def _stateless_token(uploaded_file, payload):
+    expires_at = datetime.fromtimestamp(payload['e'], tz=dt_timezone.utc)
+    return StatelessDownloadToken(uploaded_file, payload['u'], expires_at, payload['n'])
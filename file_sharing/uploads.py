@@ -0,0 +1,168 @@
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+import hashlib
+import os
+import shutil
+import uuid
+
+from .serializers import ALLOWED_EXTENSIONS_MESSAGE, has_allowed_extension
+
+COPY_BUFFER_SIZE = 1024 * 1024
+# Allowance for the multipart boundaries, part headers and small form fields around the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class AssembledFile(File):
+    """A file already on disk that storage can move into place instead of copying"""
+
+    def __init__(self, path, name):
+        super().__init__(open(path, 'rb'), name=name)
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+    def close(self):
+        try:
+            return self.file.close()
+        finally:
+            # Storage moves the file into place; anything left is a duplicate
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def write_chunk(stream, path, length):
+    """Write exactly length bytes from stream to path, returning the bytes read"""
+    # Unique per write; parallel PUTs of one chunk can share a process when workers are threaded
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    received = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            while received < length:
+                data = stream.read(min(COPY_BUFFER_SIZE, length - received))
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+        if received == length:
+            # Retried or parallel PUTs of the same chunk replace each other atomically
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return received
+
+
+def append_file(src, dst):
+    """Append the contents of file object src to dst without buffering it in Python"""
+    size = os.fstat(src.fileno()).st_size
+    copied = 0
+    try:
+        while copied < size:
+            sent = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+            if sent == 0:
+                break
+            copied += sent
+    except (AttributeError, OSError):
+        # Kernel copy unavailable (non-Linux or cross-device): fall back to a bounded buffer
+        src.seek(copied)
+        dst.seek(0, os.SEEK_END)
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+def assemble_chunks(chunk_paths, path):
+    """Concatenate chunk files in order into path and return its size"""
+    with open(path, 'wb') as out:
+        for chunk_path in chunk_paths:
+            with open(chunk_path, 'rb') as chunk:
+                append_file(chunk, out)
+    return os.path.getsize(path)
+
+
+class StreamedUploadFile(UploadedFile):
+    """An upload written to a staging file under MEDIA_ROOT, with its size and SHA-256 known"""
+
+    def __init__(self, name, content_type, charset, content_type_extra=None):
+        staging_dir = os.path.join(settings.MEDIA_ROOT, settings.UPLOAD_STAGING_DIR)
+        os.makedirs(staging_dir, exist_ok=True)
+        self.path = os.path.join(staging_dir, f'{uuid.uuid4().hex}.tmp')
+        super().__init__(open(self.path, 'w+b'), name, content_type, 0, charset, content_type_extra)
+        self.sha256 = None
+
+    def temporary_file_path(self):
+        return self.path
+
+    def close(self):
+        try:
+            return self.file.close()
+        finally:
+            # Storage moves the file into place; anything left is a duplicate or an aborted upload
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class StreamingUploadHandler(FileUploadHandler):
+    """Write an upload straight to the storage filesystem, hashing and checking it as it arrives"""
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.error = None
+
+    def reject(self, error):
+        self.error = error
+        # Stop without reading the rest of the body
+        raise StopUpload(connection_reset=True)
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > settings.UPLOAD_MAX_FILE_SIZE + MULTIPART_OVERHEAD:
+            self.error = f'File size cannot exceed {settings.UPLOAD_MAX_FILE_SIZE} bytes'
+            # Returning the parsed data means the body is never read
+            return QueryDict(), MultiValueDict()
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        if not has_allowed_extension(self.file_name):
+            self.reject(ALLOWED_EXTENSIONS_MESSAGE)
+        self.file = StreamedUploadFile(self.file_name, self.content_type, self.charset, self.content_type_extra)
+        self.sha256 = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > settings.UPLOAD_MAX_FILE_SIZE:
+            self.reject(f'File size cannot exceed {settings.UPLOAD_MAX_FILE_SIZE} bytes')
+        self.sha256.update(raw_data)
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.file.flush()
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.sha256 = self.sha256.hexdigest()
+        return self.file
+
+    def upload_interrupted(self):
+        # Django closes handler.file on StopUpload, so it is only set once a file has started
+        if hasattr(self, 'file'):
+            self.file.close()
+
+
+def stream_uploads(request):
+    """Install a StreamingUploadHandler for the request, or return None if its body was already parsed"""
+    handler = StreamingUploadHandler(request)
+    try:
+        request.upload_handlers = [handler]
+    except AttributeError:
+        # Session authentication reads the form for its CSRF check before the view runs
+        return None
+    return handler
@@ -1,12 +1,25 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+# Under ASGI the download endpoints run as native async views
+download_views = async_views if settings.ASYNC_VIEWS else views
 
 urlpatterns = [
     path('signup/', views.client_signup, name='client_signup'),
     path('verify-email/', views.verify_email, name='verify_email'),
     path('login/', views.user_login, name='user_login'),
+    path('token/rotate/', views.rotate_token, name='rotate_token'),
     path('upload/', views.upload_file, name='upload_file'),
+    path('uploads/', views.start_chunked_upload, name='start_chunked_upload'),
+    path('uploads/<uuid:upload_id>/', views.chunked_upload_status, name='chunked_upload_status'),
+    path('uploads/<uuid:upload_id>/chunks/<int:index>/', views.upload_chunk, name='upload_chunk'),
+    path('uploads/<uuid:upload_id>/complete/', views.complete_chunked_upload, name='complete_chunked_upload'),
     path('files/', views.list_files, name='list_files'),
-    path('download-file/<uuid:file_id>/', views.download_file, name='download_file'),
-    path('secure-download/<str:token>/', views.secure_download, name='secure_download'),
+    path('files/<uuid:file_id>/status/', views.file_status, name='file_status'),
+    path('download-file/<uuid:file_id>/', download_views.download_file, name='download_file'),
+    path('secure-download/<str:token>/', download_views.secure_download, name='secure_download'),
+    path('download-links/', views.download_links, name='download_links'),
+    path('download-batch/', views.download_batch, name='download_batch'),
+    path('secure-download-batch/<str:token>/', download_views.secure_download_batch, name='secure_download_batch'),
 ]
@@ -4,8 +4,9 @@ from django.core.mail import send_mail
 from django.utils import timezone
 from datetime import timedelta
 import secrets
-import base64
-import hashlib
+
+from . import crypto
+from .mail import enqueue_email
 
 def generate_encryption_key():
     """Generate a key for encryption"""
@@ -13,26 +14,11 @@ def generate_encryption_key():
 
 def encrypt_data(data, key=None):
     """Encrypt data using Fernet encryption"""
-    if key is None:
-        key = settings.SECRET_KEY.encode()[:32]
-        key = base64.urlsafe_b64encode(hashlib.sha256(key).digest())
-    
-    f = Fernet(key)
-    encrypted_data = f.encrypt(data.encode())
-    return encrypted_data.decode()
+    return crypto.encrypt(data, key)
 
 def decrypt_data(encrypted_data, key=None):
     """Decrypt data using Fernet encryption"""
-    if key is None:
-        key = settings.SECRET_KEY.encode()[:32]
-        key = base64.urlsafe_b64encode(hashlib.sha256(key).digest())
-    
-    f = Fernet(key)
-    try:
-        decrypted_data = f.decrypt(encrypted_data.encode())
-        return decrypted_data.decode()
-    except:
-        return None
+    return crypto.decrypt(encrypted_data, key)
 
 def generate_secure_token():
     """Generate a secure random token"""
@@ -53,6 +39,11 @@ def send_verification_email(user, verification_url):
     File Sharing Team
     '''
     
+    if settings.MAIL_QUEUE_ENABLED:
+        # Delivered by the send_queued_mail worker so SMTP latency stays out of the request
+        enqueue_email(subject, message, [user.email], settings.EMAIL_HOST_USER)
+        return
+    
     send_mail(
         subject,
         message,
@@ -1,26 +1,53 @@
 from rest_framework import status, permissions
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.response import Response
-from rest_framework.authtoken.models import Token
+from django.conf import settings
 from django.contrib.auth import login
-from django.http import HttpResponse, Http404
+from django.db import transaction
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from datetime import timedelta
+import hmac
 import os
-import mimetypes
+import shutil
+import tempfile
 
-from .models import User, UploadedFile, DownloadToken
+from .authentication import issue_auth_token
+from .models import AuthToken, BatchDownloadToken, User, UploadedFile, UploadSession
 from .serializers import (
     UserRegistrationSerializer, 
     LoginSerializer, 
     FileUploadSerializer,
-    UploadedFileSerializer
+    UploadedFileSerializer,
+    UploadSessionSerializer,
+    BatchDownloadSerializer
 )
 from .utils import generate_secure_token, encrypt_data, decrypt_data, send_verification_email
+from . import metrics
+from .search import search_files
+from .throttling import LinkThrottle, LoginThrottle, SignupThrottle, UploadThrottle
+from .tokens import InvalidDownloadToken, issue_download_tokens, resolve_download_token
+from .pagination import InvalidCursor, approximate_count, paginate_keyset
+from .uploads import AssembledFile, assemble_chunks, stream_uploads, write_chunk
+from .compression import stored_blob
+from .processing import enqueue_processing
+from .delivery import (
+    DownloadPlan,
+    RangeNotSatisfiable,
+    archive_entries,
+    archive_filename,
+    batch_files,
+    claim_download,
+    download_link_data,
+    range_not_satisfiable,
+    refusal,
+    stream_archive
+)
 
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
+@throttle_classes([SignupThrottle])
 def client_signup(request):
     """Client user registration"""
     serializer = UserRegistrationSerializer(data=request.data)
@@ -68,6 +95,7 @@ def verify_email(request):
 
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
+@throttle_classes([LoginThrottle])
 def user_login(request):
     """User login for both ops and client users"""
     serializer = LoginSerializer(data=request.data)
@@ -80,10 +108,11 @@ def user_login(request):
                 'error': 'Please verify your email before logging in'
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        token, created = Token.objects.get_or_create(user=user)
+        key, token = issue_auth_token(user)
         
         return Response({
-            'token': token.key,
+            'token': key,
+            'expires_at': token.expires_at,
             'user_type': user.user_type,
             'username': user.username,
             'message': 'Login successful'
@@ -93,6 +122,22 @@ def user_login(request):
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
+def rotate_token(request):
+    """Replace the token used for this request with a new one"""
+    if isinstance(request.auth, AuthToken):
+        request.auth.delete()
+    
+    key, token = issue_auth_token(request.user)
+    
+    return Response({
+        'token': key,
+        'expires_at': token.expires_at,
+        'message': 'Token rotated'
+    }, status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+@throttle_classes([UploadThrottle])
 def upload_file(request):
     """File upload for ops users only"""
     if request.user.user_type != 'ops':
@@ -100,53 +145,296 @@ def upload_file(request):
             'error': 'Only Operations users can upload files'
         }, status=status.HTTP_403_FORBIDDEN)
     
+    # Stream the file into storage as it arrives; bad uploads are refused before the body is read
+    handler = stream_uploads(request._request)
     serializer = FileUploadSerializer(data=request.data)
+    if handler is not None and handler.error:
+        return Response({'file': [handler.error]}, status=status.HTTP_400_BAD_REQUEST)
+    if serializer.is_valid():
+        with transaction.atomic():
+            uploaded_file = serializer.save(
+                uploaded_by=request.user,
+                original_filename=request.FILES['file'].name,
+                file_size=request.FILES['file'].size,
+                file_type=request.FILES['file'].name.split('.')[-1].lower(),
+                processing_status=initial_processing_status()
+            )
+            start_processing(uploaded_file)
+        metrics.observe('upload_size_bytes', uploaded_file.file_size, method='single')
+        
+        return upload_response(request, uploaded_file)
+    
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+def initial_processing_status():
+    return 'pending' if settings.PROCESSING_ENABLED else 'ready'
+
+def start_processing(uploaded_file):
+    """Queue post-upload processing for a file stored as pending"""
+    if uploaded_file.processing_status == 'pending':
+        enqueue_processing(uploaded_file)
+
+def upload_response(request, uploaded_file):
+    """Response to a stored upload; processing continues in the background"""
+    return Response({
+        'message': 'File uploaded successfully',
+        'file_id': uploaded_file.id,
+        'filename': uploaded_file.original_filename,
+        'processing_status': uploaded_file.processing_status,
+        'status_url': request.build_absolute_uri(f'/api/files/{uploaded_file.id}/status/')
+    }, status=status.HTTP_201_CREATED)
+
+def get_upload_session(request, upload_id):
+    """Fetch an upload session owned by the requesting ops user or return an error response"""
+    if request.user.user_type != 'ops':
+        return None, Response({
+            'error': 'Only Operations users can upload files'
+        }, status=status.HTTP_403_FORBIDDEN)
+    
+    try:
+        session = UploadSession.objects.get(id=upload_id, user=request.user)
+    except UploadSession.DoesNotExist:
+        return None, Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    if session.uploaded_file_id:
+        return None, Response({'error': 'Upload has already been completed'}, status=status.HTTP_409_CONFLICT)
+    
+    if session.is_expired():
+        return None, Response({'error': 'Upload session has expired'}, status=status.HTTP_410_GONE)
+    
+    return session, None
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+@throttle_classes([UploadThrottle])
+def start_chunked_upload(request):
+    """Start a resumable chunked upload for ops users"""
+    if request.user.user_type != 'ops':
+        return Response({
+            'error': 'Only Operations users can upload files'
+        }, status=status.HTTP_403_FORBIDDEN)
+    
+    serializer = UploadSessionSerializer(data=request.data)
     if serializer.is_valid():
-        uploaded_file = serializer.save(
-            uploaded_by=request.user,
-            original_filename=request.FILES['file'].name,
-            file_size=request.FILES['file'].size,
-            file_type=request.FILES['file'].name.split('.')[-1].lower()
+        session = serializer.save(
+            user=request.user,
+            chunk_size=serializer.validated_data.get('chunk_size', settings.CHUNKED_UPLOAD_CHUNK_SIZE),
+            expires_at=timezone.now() + timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS)
         )
         
         return Response({
-            'message': 'File uploaded successfully',
-            'file_id': uploaded_file.id,
-            'filename': uploaded_file.original_filename
+            'upload_id': session.id,
+            'chunk_size': session.chunk_size,
+            'total_chunks': session.total_chunks,
+            'expires_at': session.expires_at
         }, status=status.HTTP_201_CREATED)
     
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def chunked_upload_status(request, upload_id):
+    """Report which chunks of an upload have been received"""
+    session, error = get_upload_session(request, upload_id)
+    if error:
+        return error
+    
+    received = session.received_chunks()
+    received_set = set(received)
+    
+    return Response({
+        'upload_id': session.id,
+        'chunk_size': session.chunk_size,
+        'total_chunks': session.total_chunks,
+        'received_chunks': received,
+        'missing_chunks': [i for i in range(session.total_chunks) if i not in received_set],
+        'expires_at': session.expires_at
+    }, status=status.HTTP_200_OK)
+
+@api_view(['PUT'])
+@permission_classes([permissions.IsAuthenticated])
+def upload_chunk(request, upload_id, index):
+    """Store one chunk of a chunked upload; chunks may arrive in any order"""
+    session, error = get_upload_session(request, upload_id)
+    if error:
+        return error
+    
+    if index >= session.total_chunks:
+        return Response({'error': 'Chunk index out of range'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    # Reject wrongly sized chunks before reading the body
+    expected = session.chunk_length(index)
+    if request.META.get('CONTENT_LENGTH') != str(expected):
+        return Response({
+            'error': f'Chunk {index} must be exactly {expected} bytes'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    os.makedirs(session.chunk_dir, exist_ok=True)
+    received = write_chunk(request.stream, session.chunk_path(index), expected)
+    if received != expected:
+        return Response({
+            'error': f'Chunk {index} was truncated after {received} bytes'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    return Response({'index': index, 'size': received}, status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def complete_chunked_upload(request, upload_id):
+    """Assemble the received chunks into an uploaded file"""
+    session, error = get_upload_session(request, upload_id)
+    if error:
+        return error
+    
+    received = set(session.received_chunks())
+    missing = [i for i in range(session.total_chunks) if i not in received]
+    if missing:
+        return Response({
+            'error': 'Upload is missing chunks',
+            'missing_chunks': missing
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(pk=session.pk)
+        if session.uploaded_file_id:
+            return Response({'error': 'Upload has already been completed'}, status=status.HTTP_409_CONFLICT)
+        
+        # select_for_update is a no-op on SQLite, so concurrent completes can get here
+        # together. Each assembles its own file, outside the chunk directory the first
+        # to finish removes, and only one claims the session below
+        staging_dir = os.path.join(settings.MEDIA_ROOT, settings.UPLOAD_STAGING_DIR)
+        os.makedirs(staging_dir, exist_ok=True)
+        fd, assembled_path = tempfile.mkstemp(prefix='assembled-', suffix='.tmp', dir=staging_dir)
+        os.close(fd)
+        chunk_paths = [session.chunk_path(i) for i in range(session.total_chunks)]
+        try:
+            assembled_size = assemble_chunks(chunk_paths, assembled_path)
+        except FileNotFoundError:
+            # The chunks were removed by a complete that finished first
+            os.remove(assembled_path)
+            return Response({'error': 'Upload has already been completed'}, status=status.HTTP_409_CONFLICT)
+        if assembled_size != session.file_size:
+            os.remove(assembled_path)
+            return Response({'error': 'Assembled file size does not match'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Storage moves the assembled file into place rather than copying it
+        assembled = AssembledFile(assembled_path, name=session.filename)
+        try:
+            uploaded_file = UploadedFile.objects.create(
+                file=assembled,
+                original_filename=session.filename,
+                uploaded_by=request.user,
+                file_size=session.file_size,
+                file_type=session.filename.split('.')[-1].lower(),
+                processing_status=initial_processing_status()
+            )
+        finally:
+            assembled.close()
+        start_processing(uploaded_file)
+        
+        claimed = UploadSession.objects.filter(pk=session.pk, uploaded_file__isnull=True).update(
+            uploaded_file=uploaded_file
+        )
+        if not claimed:
+            # Another complete won; its file has the same content, so the blob is shared
+            transaction.set_rollback(True)
+            return Response({'error': 'Upload has already been completed'}, status=status.HTTP_409_CONFLICT)
+        metrics.observe('upload_size_bytes', uploaded_file.file_size, method='chunked')
+    
+    shutil.rmtree(session.chunk_dir, ignore_errors=True)
+    
+    return upload_response(request, uploaded_file)
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def file_status(request, file_id):
+    """Report the post-upload processing status and extracted metadata of a file"""
+    try:
+        uploaded_file = UploadedFile.objects.only(
+            'id', 'original_filename', 'sha256', 'processing_status', 'processing_error', 'metadata', 'processed_at'
+        ).get(id=file_id)
+    except UploadedFile.DoesNotExist:
+        return Response({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    return Response({
+        'file_id': uploaded_file.id,
+        'filename': uploaded_file.original_filename,
+        'processing_status': uploaded_file.processing_status,
+        'processing_error': uploaded_file.processing_error,
+        'sha256': uploaded_file.sha256,
+        'metadata': uploaded_file.metadata,
+        'processed_at': uploaded_file.processed_at
+    }, status=status.HTTP_200_OK)
+
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def list_files(request):
-    """List all uploaded files for client users with pagination and filtering"""
+    """List uploaded files for client users, newest first, with keyset pagination and filtering"""
     if request.user.user_type != 'client':
         return Response({
             'error': 'Only Client users can list files'
         }, status=status.HTTP_403_FORBIDDEN)
     
-    files = UploadedFile.objects.all().order_by('-uploaded_at')
+    fields = UploadedFileSerializer.Meta.fields
+    if request.query_params.get('fields'):
+        fields = [name.strip() for name in request.query_params['fields'].split(',') if name.strip()]
+        unknown = set(fields) - set(UploadedFileSerializer.Meta.fields)
+        if unknown:
+            return Response({
+                'error': f"Unknown fields: {', '.join(sorted(unknown))}"
+            }, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        limit = int(request.query_params.get('limit', settings.FILES_PAGE_SIZE))
+    except ValueError:
+        return Response({'error': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    limit = max(1, min(limit, settings.FILES_MAX_PAGE_SIZE))
+    
+    # Load only the columns the requested fields need, joining the uploader
+    # in the same query instead of once per row
+    files = UploadedFile.objects.only('id', 'uploaded_at', *UploadedFileSerializer.columns_for(fields))
+    if 'uploaded_by' in fields:
+        files = files.select_related('uploaded_by')
     
     # Filter by file type if provided
     file_type = request.query_params.get('file_type', None)
     if file_type:
         files = files.filter(file_type=file_type)
     
-    # Search by filename
+    # Search by filename and uploader through the search index
     search = request.query_params.get('search', None)
+    by_relevance = bool(search) and request.query_params.get('ordering') == 'relevance'
     if search:
-        files = files.filter(original_filename__icontains=search)
+        files = search_files(files, search, rank=by_relevance)
     
-    serializer = UploadedFileSerializer(files, many=True)
+    if by_relevance:
+        # Ranked results are a single top-N page
+        page = list(files.order_by('-search_rank', '-uploaded_at', '-id')[:limit])
+        next_cursor = None
+    else:
+        try:
+            page, next_cursor = paginate_keyset(files, request.query_params.get('cursor'), limit)
+        except InvalidCursor:
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
     
-    return Response({
+    serializer = UploadedFileSerializer(page, many=True, fields=fields)
+    data = {
         'files': serializer.data,
-        'count': files.count()
-    }, status=status.HTTP_200_OK)
+        'next_cursor': next_cursor
+    }
+    
+    # Counting is opt-in since it costs a full scan of the matching rows
+    count = request.query_params.get('count')
+    if count == 'exact':
+        data['count'] = files.count()
+    elif count == 'approx':
+        data['count'] = approximate_count(files, filtered=bool(file_type or search))
+    
+    return Response(data, status=status.HTTP_200_OK)
 
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
+@throttle_classes([LinkThrottle])
 def download_file(request, file_id):
     """Generate secure download link for client users"""
     if request.user.user_type != 'client':
@@ -159,59 +447,155 @@ def download_file(request, file_id):
     except UploadedFile.DoesNotExist:
         return Response({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
     
-    # Generate secure download token
-    download_token = generate_secure_token()
+    if uploaded_file.processing_status == 'failed':
+        return Response({'error': 'File failed validation'}, status=status.HTTP_409_CONFLICT)
+    
+    # Generate secure download token, or hand out the client's unused one
     expires_at = timezone.now() + timedelta(hours=1)  # Token expires in 1 hour
+    download_token, expires_at = issue_download_tokens([uploaded_file], request.user, expires_at)[uploaded_file.id]
+    
+    return Response(download_link_data(request, download_token, expires_at), status=status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+@throttle_classes([LinkThrottle])
+def download_links(request):
+    """Generate secure download links for several files at once"""
+    if request.user.user_type != 'client':
+        return Response({
+            'error': 'Only Client users can download files'
+        }, status=status.HTTP_403_FORBIDDEN)
+    
+    serializer = BatchDownloadSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    file_ids = serializer.validated_data['file_ids']
+    files = {f.id: f for f in UploadedFile.objects.filter(id__in=file_ids).only('id', 'processing_status')}
+    missing = [str(file_id) for file_id in file_ids if file_id not in files]
+    if missing:
+        return Response({'error': 'File not found', 'missing': missing}, status=status.HTTP_404_NOT_FOUND)
+    failed = [str(file_id) for file_id in file_ids if files[file_id].processing_status == 'failed']
+    if failed:
+        return Response({'error': 'File failed validation', 'failed': failed}, status=status.HTTP_409_CONFLICT)
+    
+    # One lookup of reusable links and one bulk insert, however many files there are
+    expires_at = timezone.now() + timedelta(hours=1)
+    issued = issue_download_tokens([files[file_id] for file_id in file_ids], request.user, expires_at)
+    base_url = request.build_absolute_uri('/api/secure-download/')
+    
+    return Response({
+        'links': [
+            {'file_id': file_id, 'download_link': f'{base_url}{issued[file_id][0]}/', 'expires_at': issued[file_id][1]}
+            for file_id in file_ids
+        ],
+        'message': 'success'
+    }, status=status.HTTP_200_OK)
+
+def refuse(outcome):
+    return Response(*refusal(outcome))
+
+@api_view(['GET'])
+@permission_classes([permissions.AllowAny])
+def secure_download(request, token):
+    """Secure file download endpoint with Range and conditional request support"""
+    try:
+        download_token = resolve_download_token(token)
+    except InvalidDownloadToken:
+        return refuse('invalid')
     
-    DownloadToken.objects.create(
-        token=download_token,
-        file=uploaded_file,
-        user=request.user,
-        expires_at=expires_at
-    )
+    # Check if token is expired
+    if download_token.is_expired():
+        return refuse('expired')
     
-    download_url = request.build_absolute_uri(f'/api/secure-download/{download_token}/')
+    uploaded_file = download_token.file
+    name, encoding = stored_blob(uploaded_file)
+    if not uploaded_file.file.storage.exists(name):
+        return refuse('missing_file')
+    
+    try:
+        plan = DownloadPlan(request, uploaded_file, name, encoding)
+    except RangeNotSatisfiable as e:
+        return range_not_satisfiable(e.size)
+    
+    # Failed preconditions are answered before the link is used up
+    response = plan.precondition_response(request)
+    if response is not None:
+        return response
+    
+    if not claim_download(download_token, plan):
+        return refuse('used')
+    
+    return plan.response()
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+@throttle_classes([LinkThrottle])
+def download_batch(request):
+    """Generate one secure download link for a ZIP archive of several files"""
+    if request.user.user_type != 'client':
+        return Response({
+            'error': 'Only Client users can download files'
+        }, status=status.HTTP_403_FORBIDDEN)
+    
+    serializer = BatchDownloadSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    file_ids = serializer.validated_data['file_ids']
+    found = dict(UploadedFile.objects.filter(id__in=file_ids).values_list('id', 'processing_status'))
+    missing = [str(file_id) for file_id in file_ids if file_id not in found]
+    if missing:
+        return Response({'error': 'File not found', 'missing': missing}, status=status.HTTP_404_NOT_FOUND)
+    failed = [str(file_id) for file_id in file_ids if found[file_id] == 'failed']
+    if failed:
+        return Response({'error': 'File failed validation', 'failed': failed}, status=status.HTTP_409_CONFLICT)
+    
+    # One token row and one bulk insert of its files, however many files there are
+    expires_at = timezone.now() + timedelta(hours=1)
+    with transaction.atomic():
+        batch_token = BatchDownloadToken.objects.create(
+            token=generate_secure_token(), user=request.user, expires_at=expires_at
+        )
+        BatchDownloadToken.files.through.objects.bulk_create([
+            BatchDownloadToken.files.through(batchdownloadtoken_id=batch_token.pk, uploadedfile_id=file_id)
+            for file_id in file_ids
+        ])
+    
+    download_url = request.build_absolute_uri(f'/api/secure-download-batch/{batch_token.token}/')
     
     return Response({
         'download_link': download_url,
+        'file_count': len(file_ids),
         'message': 'success',
         'expires_at': expires_at
     }, status=status.HTTP_200_OK)
 
 @api_view(['GET'])
 @permission_classes([permissions.AllowAny])
-def secure_download(request, token):
-    """Secure file download endpoint"""
+def secure_download_batch(request, token):
+    """Stream the files of a batch download link as a ZIP archive"""
     try:
-        download_token = DownloadToken.objects.get(token=token)
-        
-        # Check if token is expired
-        if download_token.is_expired():
-            return Response({'error': 'Download link has expired'}, status=status.HTTP_410_GONE)
-        
-        # Check if token is already used
-        if download_token.is_used:
-            return Response({'error': 'Download link has already been used'}, status=status.HTTP_410_GONE)
-        
-        # Mark token as used
-        download_token.is_used = True
-        download_token.save()
-        
-        # Get the file
-        uploaded_file = download_token.file
-        
-        if not os.path.exists(uploaded_file.file.path):
-            return Response({'error': 'File not found on server'}, status=status.HTTP_404_NOT_FOUND)
-        
-        # Serve the file
-        with open(uploaded_file.file.path, 'rb') as f:
-            file_data = f.read()
-        
-        content_type, _ = mimetypes.guess_type(uploaded_file.file.path)
-        response = HttpResponse(file_data, content_type=content_type)
-        response['Content-Disposition'] = f'attachment; filename="{uploaded_file.original_filename}"'
-        
-        return response
-        
-    except DownloadToken.DoesNotExist:
-        return Response({'error': 'Invalid download link'}, status=status.HTTP_404_NOT_FOUND)
+        batch_token = BatchDownloadToken.objects.get(token=token)
+    except BatchDownloadToken.DoesNotExist:
+        return refuse('invalid')
+    
+    if batch_token.is_expired():
+        return refuse('expired')
+    
+    entries = archive_entries(list(batch_files(batch_token)))
+    if entries is None:
+        return refuse('missing_file')
+    
+    if not batch_token.claim():
+        return refuse('used')
+    metrics.inc('download_token_validations_total', outcome='claimed')
+    
+    return stream_archive(entries, archive_filename())
+
+def metrics_endpoint(request):
+    """Prometheus metrics aggregated over all worker processes"""
+    token = settings.METRICS_AUTH_TOKEN
+    if token and not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
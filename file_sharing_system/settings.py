@@ -12,7 +12,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
-from decouple import config
+import tempfile
+from decouple import Csv, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -27,6 +28,10 @@ SECRET_KEY = config('SECRET_KEY', default='django-insecure-change-me')
 DEBUG = config('DEBUG', default=True, cast=bool)
 ALLOWED_HOSTS = config('ALLOWED_HOSTS', default='localhost,127.0.0.1').split(',')
 
+# Fernet keys for encrypt_data/decrypt_data, newest first; older keys still
+# decrypt so they can be rotated out. Derived from SECRET_KEY when unset.
+ENCRYPTION_KEYS = config('ENCRYPTION_KEYS', default='', cast=Csv())
+
 
 # Application definition
 
@@ -44,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'file_sharing.middleware.MetricsMiddleware',
+    'file_sharing.middleware.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -121,21 +128,55 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'file_sharing.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    # Token bucket rates per scope (see file_sharing.throttling); bursts up to the count are allowed
+    'DEFAULT_THROTTLE_RATES': {
+        'uploads': config('THROTTLE_RATE_UPLOADS', default='60/min'),
+        'links': config('THROTTLE_RATE_LINKS', default='120/min'),
+        'login': config('THROTTLE_RATE_LOGIN', default='10/min'),
+        'signup': config('THROTTLE_RATE_SIGNUP', default='5/hour'),
+    },
+}
+
+# Cache Settings
+# The default in-memory cache is private to each worker process. Stateless download
+# tokens need a shared one, e.g. CACHE_BACKEND=django.core.cache.backends.redis.RedisCache
+# with CACHE_LOCATION=redis://127.0.0.1:6379/0
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    }
 }
 
+# 'local' keeps throttle buckets in each process; a cache alias shares them between workers
+THROTTLE_BACKEND = config('THROTTLE_BACKEND', default='local')
+# The least recently used buckets are dropped once the local store holds this many keys
+THROTTLE_MAX_KEYS = config('THROTTLE_MAX_KEYS', default=100000, cast=int)
 
 
+# Login tokens expire after this many hours; sliding tokens are extended once half of it has passed
+AUTH_TOKEN_LIFETIME_HOURS = config('AUTH_TOKEN_LIFETIME_HOURS', default=168, cast=int)
+AUTH_TOKEN_SLIDING = config('AUTH_TOKEN_SLIDING', default=True, cast=bool)
+# Older tokens of a user are deleted when a new login exceeds this
+AUTH_TOKEN_MAX_PER_USER = config('AUTH_TOKEN_MAX_PER_USER', default=10, cast=int)
+# In-process LRU of authenticated tokens; entries live AUTH_TOKEN_CACHE_TTL seconds
+AUTH_TOKEN_CACHE_SIZE = config('AUTH_TOKEN_CACHE_SIZE', default=10000, cast=int)
+AUTH_TOKEN_CACHE_TTL = config('AUTH_TOKEN_CACHE_TTL', default=60, cast=int)
+# Optional cache alias shared by all workers, checked after the in-process LRU; it also
+# carries revocation markers so invalidating a token reaches every worker at once
+AUTH_TOKEN_CACHE_BACKEND = config('AUTH_TOKEN_CACHE_BACKEND', default='')
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.2/topics/i18n/
 
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+MEDIA_ROOT = config('MEDIA_ROOT', default=os.path.join(BASE_DIR, 'media'))
 
 LANGUAGE_CODE = 'en-us'
 
@@ -165,14 +206,141 @@ EMAIL_USE_TLS = config('EMAIL_USE_TLS', default=True, cast=bool)
 EMAIL_HOST_USER = config('EMAIL_HOST_USER', default='')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD', default='')
 
+# Verification links stop working after this many hours
+EMAIL_VERIFICATION_EXPIRY_HOURS = config('EMAIL_VERIFICATION_EXPIRY_HOURS', default=24, cast=int)
+
+# Outgoing mail is queued in the database and sent by `manage.py send_queued_mail`
+MAIL_QUEUE_ENABLED = config('MAIL_QUEUE_ENABLED', default=True, cast=bool)
+MAIL_QUEUE_BATCH_SIZE = config('MAIL_QUEUE_BATCH_SIZE', default=100, cast=int)
+MAIL_QUEUE_MAX_ATTEMPTS = config('MAIL_QUEUE_MAX_ATTEMPTS', default=5, cast=int)
+# Seconds before the first retry, doubled after each failure up to the maximum
+MAIL_QUEUE_RETRY_DELAY = config('MAIL_QUEUE_RETRY_DELAY', default=60, cast=int)
+MAIL_QUEUE_MAX_RETRY_DELAY = config('MAIL_QUEUE_MAX_RETRY_DELAY', default=3600, cast=int)
+# How long a worker holds a claimed batch before other workers may retry it
+MAIL_QUEUE_LEASE_SECONDS = config('MAIL_QUEUE_LEASE_SECONDS', default=300, cast=int)
+
 CORS_ALLOW_ALL_ORIGINS = True
 
 
 # File Upload Settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = config('FILE_UPLOAD_MAX_MEMORY_SIZE', default=10485760, cast=int)
 DATA_UPLOAD_MAX_MEMORY_SIZE = config('DATA_UPLOAD_MAX_MEMORY_SIZE', default=10485760, cast=int)
+# Largest file accepted by the single-request upload endpoint
+UPLOAD_MAX_FILE_SIZE = config('UPLOAD_MAX_FILE_SIZE', default=10485760, cast=int)
+# The upload endpoint streams files into this directory under MEDIA_ROOT, from
+# where storage renames them into place without copying
+UPLOAD_STAGING_DIR = config('UPLOAD_STAGING_DIR', default='incoming')
+
+# Chunked Upload Settings
+# Chunks are staged under MEDIA_ROOT so the assembled file can be moved into place
+CHUNKED_UPLOAD_DIR = config('CHUNKED_UPLOAD_DIR', default='chunks')
+CHUNKED_UPLOAD_CHUNK_SIZE = config('CHUNKED_UPLOAD_CHUNK_SIZE', default=8388608, cast=int)
+CHUNKED_UPLOAD_MIN_CHUNK_SIZE = config('CHUNKED_UPLOAD_MIN_CHUNK_SIZE', default=262144, cast=int)
+CHUNKED_UPLOAD_MAX_CHUNK_SIZE = config('CHUNKED_UPLOAD_MAX_CHUNK_SIZE', default=33554432, cast=int)
+CHUNKED_UPLOAD_MAX_FILE_SIZE = config('CHUNKED_UPLOAD_MAX_FILE_SIZE', default=2147483648, cast=int)
+CHUNKED_UPLOAD_EXPIRY_HOURS = config('CHUNKED_UPLOAD_EXPIRY_HOURS', default=24, cast=int)
+
+# File Listing Settings
+FILES_PAGE_SIZE = config('FILES_PAGE_SIZE', default=50, cast=int)
+FILES_MAX_PAGE_SIZE = config('FILES_MAX_PAGE_SIZE', default=500, cast=int)
+
+# File Download Settings
+# Route the download endpoints to the async views; enable when serving with an ASGI server such as uvicorn
+ASYNC_VIEWS = config('ASYNC_VIEWS', default=False, cast=bool)
+DOWNLOAD_CHUNK_SIZE = config('DOWNLOAD_CHUNK_SIZE', default=65536, cast=int)
+DOWNLOAD_USE_SENDFILE = config('DOWNLOAD_USE_SENDFILE', default=True, cast=bool)
+# 'stream' serves files from Django; 'x-accel-redirect' (nginx) and 'x-sendfile'
+# (Apache/lighttpd) only emit a header and let the front proxy send the bytes
+FILE_DELIVERY_BACKEND = config('FILE_DELIVERY_BACKEND', default='stream')
+# Internal nginx location that aliases MEDIA_ROOT, used by x-accel-redirect
+FILE_DELIVERY_ACCEL_PREFIX = config('FILE_DELIVERY_ACCEL_PREFIX', default='/protected/')
+# A used link serves further ranges (starting past the first byte) of the same transfer
+# for this many seconds after its first request, then refuses them
+DOWNLOAD_RESUME_WINDOW = config('DOWNLOAD_RESUME_WINDOW', default=900, cast=int)
+# 'db' stores a DownloadToken row per link; 'signed' and 'encrypted' carry a
+# signed (or Fernet-encrypted) payload in the link and track single use in a cache
+DOWNLOAD_TOKEN_MODE = config('DOWNLOAD_TOKEN_MODE', default='db')
+# Cache alias for used stateless token nonces; must be shared by all workers with an atomic
+# add, so the signed and encrypted modes refuse the locmem, dummy and file caches
+DOWNLOAD_REPLAY_CACHE = config('DOWNLOAD_REPLAY_CACHE', default='default')
+# Hand out a client's existing unused link for a file instead of creating another token row
+DOWNLOAD_TOKEN_REUSE = config('DOWNLOAD_TOKEN_REUSE', default=True, cast=bool)
+# Only links valid for at least this many more seconds are handed out again
+DOWNLOAD_TOKEN_REUSE_MIN_SECONDS = config('DOWNLOAD_TOKEN_REUSE_MIN_SECONDS', default=600, cast=int)
+# Most files one batch download link (or one /download-links/ request) may cover
+BATCH_DOWNLOAD_MAX_FILES = config('BATCH_DOWNLOAD_MAX_FILES', default=100, cast=int)
+
+# File Storage Settings
+# Uploads are stored once per distinct content under blobs/<aa>/<bb>/<sha256>;
+# 'local' keeps them under MEDIA_ROOT, 's3' in an S3 compatible bucket (requires boto3)
+FILE_STORAGE_BACKEND = config('FILE_STORAGE_BACKEND', default='local')
+S3_BUCKET = config('S3_BUCKET', default='')
+# Key prefix within the bucket
+S3_PREFIX = config('S3_PREFIX', default='')
+# Set for MinIO and other S3 compatible services; empty uses AWS
+S3_ENDPOINT_URL = config('S3_ENDPOINT_URL', default='')
+S3_REGION = config('S3_REGION', default='')
+# Empty uses boto3's default credential chain (environment, instance profile, ...)
+S3_ACCESS_KEY_ID = config('S3_ACCESS_KEY_ID', default='')
+S3_SECRET_ACCESS_KEY = config('S3_SECRET_ACCESS_KEY', default='')
+# Lifetime in seconds of the presigned URLs downloads are redirected to
+S3_URL_EXPIRY = config('S3_URL_EXPIRY', default=300, cast=int)
+# Rows and pause between batches of `manage.py migrate_storage_layout`
+STORAGE_MIGRATION_BATCH_SIZE = config('STORAGE_MIGRATION_BATCH_SIZE', default=200, cast=int)
+STORAGE_MIGRATION_SLEEP = config('STORAGE_MIGRATION_SLEEP', default=0.1, cast=float)
+
+# Storage Compression Settings
+# Encoding compress_files stores uploads with: 'gzip', or 'zstd' with the zstandard package installed
+COMPRESSION_ENCODING = config('COMPRESSION_ENCODING', default='gzip')
+# Compression level; 0 uses the encoding's default (gzip 6, zstd 3)
+COMPRESSION_LEVEL = config('COMPRESSION_LEVEL', default=0, cast=int)
+# Keep the compressed variant only when it is at least this fraction smaller
+COMPRESSION_MIN_SAVINGS = config('COMPRESSION_MIN_SAVINGS', default=0.1, cast=float)
+COMPRESSION_BATCH_SIZE = config('COMPRESSION_BATCH_SIZE', default=100, cast=int)
+
+# Upload Processing Settings
+# Uploads are checksummed, validated and have their metadata extracted by
+# `manage.py process_uploads`; when disabled they are ready as soon as they are stored
+PROCESSING_ENABLED = config('PROCESSING_ENABLED', default=True, cast=bool)
+# Threads running jobs in each process_uploads process
+PROCESSING_WORKERS = config('PROCESSING_WORKERS', default=4, cast=int)
+PROCESSING_BATCH_SIZE = config('PROCESSING_BATCH_SIZE', default=50, cast=int)
+PROCESSING_MAX_ATTEMPTS = config('PROCESSING_MAX_ATTEMPTS', default=3, cast=int)
+# Seconds before the first retry, doubled after each failure
+PROCESSING_RETRY_DELAY = config('PROCESSING_RETRY_DELAY', default=30, cast=int)
+# How long a worker holds a claimed batch before other workers may retry it
+PROCESSING_LEASE_SECONDS = config('PROCESSING_LEASE_SECONDS', default=600, cast=int)
+# Limits on the zip packages of uploads, checked before anything is inflated
+PROCESSING_MAX_ENTRIES = config('PROCESSING_MAX_ENTRIES', default=10000, cast=int)
+PROCESSING_MAX_UNCOMPRESSED_SIZE = config('PROCESSING_MAX_UNCOMPRESSED_SIZE', default=1024 * 1024 * 1024, cast=int)
+# Largest XML part parsed for metadata
+PROCESSING_MAX_PART_SIZE = config('PROCESSING_MAX_PART_SIZE', default=10 * 1024 * 1024, cast=int)
+
+# Token Cleanup Settings (manage.py cleanup_expired_tokens)
+CLEANUP_BATCH_SIZE = config('CLEANUP_BATCH_SIZE', default=1000, cast=int)
+CLEANUP_BATCH_SLEEP = config('CLEANUP_BATCH_SLEEP', default=0.05, cast=float)
+CLEANUP_INTERVAL = config('CLEANUP_INTERVAL', default=3600, cast=int)
+
+# Metrics Settings
+# Each worker process writes its samples to a memory mapped file in METRICS_DIR and
+# /metrics sums them; clear the directory when the server (not a worker) starts
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+METRICS_DIR = config('METRICS_DIR', default=os.path.join(tempfile.gettempdir(), 'file_sharing_metrics'))
+# When set, /metrics requires an "Authorization: Bearer <token>" header
+METRICS_AUTH_TOKEN = config('METRICS_AUTH_TOKEN', default='')
+
+# Profiling Settings
+# Requests are profiled when they carry PROFILING_HEADER set to PROFILING_SECRET, or at
+# random with probability PROFILING_SAMPLE_RATE; see `manage.py profiles`
+PROFILING_ENABLED = config('PROFILING_ENABLED', default=False, cast=bool)
+PROFILING_HEADER = config('PROFILING_HEADER', default='X-Profile')
+PROFILING_SECRET = config('PROFILING_SECRET', default='')
+PROFILING_SAMPLE_RATE = config('PROFILING_SAMPLE_RATE', default=0.0, cast=float)
+PROFILING_DIR = config('PROFILING_DIR', default=os.path.join(tempfile.gettempdir(), 'file_sharing_profiles'))
+PROFILING_MAX_PROFILES = config('PROFILING_MAX_PROFILES', default=100, cast=int)
 
 # Security Settings
 SECURE_SSL_REDIRECT = config('SECURE_SSL_REDIRECT', default=False, cast=bool)
 SECURE_BROWSER_XSS_FILTER = config('SECURE_BROWSER_XSS_FILTER', default=True, cast=bool)
 SECURE_CONTENT_TYPE_NOSNIFF = config('SECURE_CONTENT_TYPE_NOSNIFF', default=True, cast=bool)
+
@@ -18,10 +18,12 @@ from django.contrib import admin
 from django.urls import path,include
 from django.conf.urls.static import static
 from django.conf import settings
+from file_sharing.views import metrics_endpoint
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('file_sharing.urls')),
+    path('metrics', metrics_endpoint, name='metrics'),
 ]
 
 if settings.DEBUG: